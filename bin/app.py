@@ -29,6 +29,11 @@ from jira import JIRA
 # Initiating a Flask App
 app = Flask(__name__)
 
+# The webhook diagnoses the same projects again and again, and answering fast
+# matters more than the freshness of every resource: serve stale cached
+# resources while they are refreshed in the background.
+lint_command.dict_with_vals['cache_serve_stale'] = True
+
 resource_map = {
     "Apigee": ["apigee"], "Big Data": ["bigquery", "composer", "dataproc"], "App Engine": ["gae"],
     "CI/CD": ["gcb"], "Integration": ["gcb"], "Compute Engine": ["gce"], "Cloud Functions": ["gcf"],
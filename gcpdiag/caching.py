@@ -15,49 +15,293 @@
 # Lint as: python3
 """Persistent caching using diskcache."""
 
+import array
 import atexit
+import bisect
 import collections
-import contextlib
+import collections.abc
+import concurrent.futures
 import functools
 import hashlib
+import json
 import logging
+import mmap
+import os
 import pickle
-import shutil
+import struct
 import tempfile
 import threading
-from typing import List
+import time
+import zlib
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, NamedTuple,
+                    Optional, Tuple)
 
 import diskcache
+import googleapiclient.errors
 
-from gcpdiag import config
+from gcpdiag import call_audit, config, deadlines, tracing, utils
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
 
 _cache = None
+_memory_cache = None
+_negative_cache = None
+# While use_isolated_cache() is in effect: the shared cache of
+# config.CACHE_DIR (if it was opened), and the directory of the isolated cache.
+_shared_cache = None
+_isolated_cache_dir: Optional[tempfile.TemporaryDirectory] = None
+_serializer = None
 
 
-def _clean_cache():
-  """Remove all cached items with tag 'tmp'.
+class MemoryCacheInfo(NamedTuple):
+  """Statistics of the in-memory cache, as returned by MemoryCache.info()."""
+  hits: int
+  misses: int
+  entries: int
+  size_bytes: int
+  max_bytes: int
+
+  @property
+  def hit_rate(self) -> float:
+    total = self.hits + self.misses
+    return self.hits / total if total else 0.0
+
+
+class MemoryCache:
+  """Thread-safe LRU cache bounded by the (pickled) size of the values.
+
+  This is used as first tier in front of diskcache, so that objects that are
+  looked up very often don't need to be read from SQLite and unpickled every
+  time.
+  """
+
+  # key -> (value, size in bytes, expiry timestamp or None)
+  _data: 'collections.OrderedDict[bytes, Tuple[Any, int, Optional[float]]]'
+
+  def __init__(self, max_bytes: int):
+    self.max_bytes = max_bytes
+    self._data = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self._size_bytes = 0
+    self._hits = 0
+    self._misses = 0
+
+  def get(self, key: bytes, default=None):
+    with self._lock:
+      try:
+        value, size, expire_time = self._data[key]
+      except KeyError:
+        self._misses += 1
+        return default
+      if expire_time is not None and expire_time <= time.time():
+        del self._data[key]
+        self._size_bytes -= size
+        self._misses += 1
+        return default
+      self._data.move_to_end(key)
+      self._hits += 1
+      return value
+
+  def set(self, key: bytes, value, size: int, expire: Optional[float] = None):
+    """Store value, evicting the least recently used entries if necessary.
+
+    Values bigger than the whole cache are not stored at all."""
+    if size > self.max_bytes:
+      return
+    expire_time = time.time() + expire if expire else None
+    with self._lock:
+      if key in self._data:
+        self._size_bytes -= self._data.pop(key)[1]
+      self._data[key] = (value, size, expire_time)
+      self._size_bytes += size
+      while self._size_bytes > self.max_bytes:
+        _, (_, evicted_size, _) = self._data.popitem(last=False)
+        self._size_bytes -= evicted_size
+
+  def clear(self):
+    with self._lock:
+      self._data.clear()
+      self._size_bytes = 0
+
+  def info(self) -> MemoryCacheInfo:
+    with self._lock:
+      return MemoryCacheInfo(hits=self._hits,
+                             misses=self._misses,
+                             entries=len(self._data),
+                             size_bytes=self._size_bytes,
+                             max_bytes=self.max_bytes)
+
+
+def _is_json_value(value) -> bool:
+  """Return True if value would be restored identically by json.loads()."""
+  if value is None or isinstance(value, (str, bool, int, float)):
+    return True
+  if isinstance(value, list):
+    return all(_is_json_value(v) for v in value)
+  if isinstance(value, dict):
+    return all(
+        isinstance(k, str) and _is_json_value(v) for k, v in value.items())
+  return False
+
+
+def _json_dumps(value) -> Optional[bytes]:
+  if not _is_json_value(value):
+    return None
+  return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+def _pickle_dumps(value) -> bytes:
+  return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+# encoding name -> (id, dumps, loads). dumps returns None if the value can't be
+# encoded, in which case pickle is used.
+_ENCODINGS: Dict[str, Tuple[bytes, Callable, Callable]] = {}
+_ENCODINGS['pickle'] = (b'p', _pickle_dumps, pickle.loads)
+_ENCODINGS['json'] = (b'j', _json_dumps, json.loads)
+
+# compression name -> (id, compress, decompress)
+_COMPRESSIONS: Dict[str, Tuple[bytes, Callable, Callable]] = {}
+_COMPRESSIONS['none'] = (b'-', lambda d: d, lambda d: d)
+_COMPRESSIONS['zlib'] = (b'z', lambda d: zlib.compress(d, 1), zlib.decompress)
+if zstandard:
+  _COMPRESSIONS['zstd'] = (b's', zstandard.compress, zstandard.decompress)
+
+
+class Serializer:
+  """Converts the values stored in diskcache by cached_api_call to bytes.
+
+  The serialized data starts with one byte identifying the encoding and one
+  byte identifying the compression, so that data written with different
+  settings can always be read back.
+
+  Parameters:
+  - encoding: 'pickle', or 'json' to encode plain API payloads (dicts, lists,
+    strings, numbers) as JSON, and everything else with pickle.
+  - compression: 'none', 'zlib' or 'zstd' (requires the zstandard module).
+  - compression_min_bytes: don't compress data smaller than this.
+  """
+
+  def __init__(self,
+               encoding: str = 'pickle',
+               compression: str = 'none',
+               compression_min_bytes: int = 0):
+    if encoding not in _ENCODINGS:
+      raise ValueError(f'unknown cache encoding: {encoding}')
+    if compression not in _COMPRESSIONS:
+      raise ValueError(f'unknown or unavailable cache compression: '
+                       f'{compression}')
+    self.encoding = encoding
+    self.compression = compression
+    self.compression_min_bytes = compression_min_bytes
+
+  def dumps(self, value) -> Tuple[bytes, int]:
+    """Serialize value, and return the data and the uncompressed size."""
+    encoding_id, dumps, _ = _ENCODINGS[self.encoding]
+    raw = dumps(value)
+    if raw is None:
+      encoding_id, dumps, _ = _ENCODINGS['pickle']
+      raw = dumps(value)
+    compression_id, compress, _ = _COMPRESSIONS[self.compression]
+    if len(raw) < self.compression_min_bytes:
+      compression_id, compress, _ = _COMPRESSIONS['none']
+    return encoding_id + compression_id + compress(raw), len(raw)
+
+  @staticmethod
+  def loads(data: bytes) -> Tuple[Any, int]:
+    """Deserialize data, and return the value and the uncompressed size.
+
+    Raises ValueError if the data format isn't known."""
+    encoding_id, compression_id = data[0:1], data[1:2]
+    for c_id, _, decompress in _COMPRESSIONS.values():
+      if c_id == compression_id:
+        break
+    else:
+      raise ValueError('unknown cache data compression')
+    for e_id, _, loads in _ENCODINGS.values():
+      if e_id == encoding_id:
+        break
+    else:
+      raise ValueError('unknown cache data encoding')
+    raw = decompress(data[2:])
+    return loads(raw), len(raw)
+
+
+def get_serializer() -> Serializer:
+  """Get the Serializer used for the values stored in diskcache."""
+  global _serializer
+  if not _serializer:
+    _serializer = Serializer(
+        encoding=config.CACHE_ENCODING,
+        compression=config.CACHE_COMPRESSION,
+        compression_min_bytes=config.CACHE_COMPRESSION_MIN_BYTES)
+  return _serializer
 
-  We use 'tmp' to store data that should be cached only during a single
-  execution of the script.
+
+def set_serializer(serializer: Serializer):
+  """Use a different Serializer for new values stored in diskcache."""
+  global _serializer
+  _serializer = serializer
+
+
+def _tmp_tag() -> str:
+  """Tag of the data that should be cached only during a single execution of
+  the script.
+
+  The tag is different for every process, so that processes sharing the cache
+  directory don't remove each other's data. Data of processes that didn't exit
+  cleanly expires after config.CACHE_TMP_EXPIRY_SECONDS.
   """
-  if _cache:
+  return f'tmp-{os.getpid()}'
+
+
+def _clean_cache():
+  """Remove all cached items with the tag of this process and expired items."""
+  if _cache is not None:
+    # 'tmp' was used for all processes by older versions.
     count = _cache.evict('tmp')
+    count += _cache.evict(_tmp_tag())
     count += _cache.expire()
     if count:
       logging.debug('removed %d items from cache', count)
 
 
 def _close_cache():
-  if _cache:
+  if _memory_cache:
+    info = _memory_cache.info()
+    logging.debug(
+        'memory cache: %d hits, %d misses (hit rate: %.1f%%), %d bytes used',
+        info.hits, info.misses, info.hit_rate * 100, info.size_bytes)
+    _memory_cache.clear()
+  if _negative_cache:
+    _negative_cache.clear()
+  use_shared_cache()
+  if _cache is not None:
     _clean_cache()
     _cache.close()
 
 
+def _open_cache(directory: str, shards: int):
+  if shards:
+    return diskcache.FanoutCache(directory,
+                                 shards=shards,
+                                 timeout=config.CACHE_SHARDS_TIMEOUT,
+                                 tag_index=True)
+  return diskcache.Cache(directory, tag_index=True)
+
+
 def get_cache() -> diskcache.Cache:
-  """Get a Diskcache.Cache object that can be used to cache data."""
+  """Get a Diskcache.Cache object that can be used to cache data.
+
+  With config.CACHE_SHARDS, this is a diskcache.FanoutCache instead, which
+  has the same interface but allows concurrent writers."""
   global _cache
-  if not _cache:
-    _cache = diskcache.Cache(config.CACHE_DIR, tag_index=True)
+  # note: diskcache.Cache objects are falsy when they are empty.
+  if _cache is None:
+    _cache = _open_cache(config.CACHE_DIR, config.CACHE_SHARDS)
     # Make sure that we remove any data that wasn't cleaned up correctly for
     # some reason.
     _clean_cache()
@@ -66,27 +310,202 @@ def get_cache() -> diskcache.Cache:
   return _cache
 
 
-deque_tmpdirs: List[str] = []
+def get_memory_cache() -> MemoryCache:
+  """Get the in-memory cache used in front of get_cache() by cached_api_call."""
+  global _memory_cache
+  if not _memory_cache:
+    _memory_cache = MemoryCache(config.CACHE_MEMORY_MAX_BYTES)
+  return _memory_cache
+
+
+def get_negative_cache() -> MemoryCache:
+  """Get the in-memory cache of API errors used by cached_api_call.
 
+  Every entry has a size of 1, i.e. the size is the number of entries."""
+  global _negative_cache
+  if not _negative_cache:
+    _negative_cache = MemoryCache(config.CACHE_NEGATIVE_MAX_ENTRIES)
+  return _negative_cache
 
-def _clean_tmp_deque():
-  for d in deque_tmpdirs:
-    logging.debug('deleting dequeue tempdir: %s', d)
-    shutil.rmtree(d, ignore_errors=True)
+
+def negative_cache_class(err: BaseException) -> Optional[str]:
+  """Return the error class of an API error (a key of
+  config.CACHE_NEGATIVE_TTL), or None if err shouldn't be cached."""
+  if isinstance(err, googleapiclient.errors.HttpError):
+    err = utils.GcpApiError(err)
+  if not isinstance(err, utils.GcpApiError):
+    return None
+  if err.reason == 'SERVICE_DISABLED':
+    return 'SERVICE_DISABLED'
+  try:
+    status = err.status
+  except AttributeError:
+    # GcpApiError without HTTP response
+    return None
+  if status == 403:
+    return 'PERMISSION_DENIED'
+  elif status == 404:
+    return 'NOT_FOUND'
+  return None
 
 
-def get_tmp_deque(prefix='tmp-deque-') -> diskcache.Deque:
-  """Get a Diskcache.Deque object useful to temporarily store data (like logs).
+# Length prefix of the records in a SegmentStore.
+_SEGMENT_RECORD_HEADER = struct.Struct('<I')
 
-  arguments:
-    prefix: prefix to be added to the temporary directory (default: tmp-deque)
+
+class SegmentStore:
+  """Append-only store of pickled records in a single temporary file.
+
+  Records are written in bulk (one write per extendleft() call) as
+  length-prefixed pickles, and read through a read-only mmap of the file.
+  The file is unlinked right after creation, so it disappears automatically
+  when the store and all the SegmentSequence objects using it are gone.
+
+  A store is meant to be shared by many writers (e.g. all the logs queries of
+  a run): use new_sequence() to get a deque-like view of the records written
+  by a single writer.
   """
-  tempdir = tempfile.mkdtemp(prefix=prefix, dir=config.CACHE_DIR)
-  if not deque_tmpdirs:
-    atexit.register(_clean_tmp_deque)
-  deque_tmpdirs.append(tempdir)
-  deque = diskcache.Deque(directory=tempdir)
-  return deque
+
+  def __init__(self, prefix='tmp-segments-'):
+    os.makedirs(config.CACHE_DIR, exist_ok=True)
+    # pylint: disable=consider-using-with
+    self._file = tempfile.TemporaryFile(prefix=prefix,
+                                        dir=config.CACHE_DIR,
+                                        buffering=0)
+    self._lock = threading.Lock()
+    self._size = 0
+    self._mmap: Optional[mmap.mmap] = None
+
+  @property
+  def size_bytes(self) -> int:
+    return self._size
+
+  def append_records(self, records: Iterable) -> array.array:
+    """Write records with a single write call, and return their offsets."""
+    offsets = array.array('Q')
+    buf = bytearray()
+    for record in records:
+      data = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+      offsets.append(len(buf))
+      buf += _SEGMENT_RECORD_HEADER.pack(len(data))
+      buf += data
+    if not buf:
+      return offsets
+    with self._lock:
+      base = self._size
+      self._file.seek(base)
+      view = memoryview(buf)
+      while view:
+        view = view[self._file.write(view):]
+      self._size += len(buf)
+    for i in range(len(offsets)):
+      offsets[i] += base
+    return offsets
+
+  def _get_mmap(self, end: int) -> mmap.mmap:
+    """Return a mmap of the file that covers at least up to end."""
+    with self._lock:
+      if self._mmap is None or len(self._mmap) < end:
+        # The previous mmap might still be used by readers: it will be unmapped
+        # when the last reference goes away.
+        self._mmap = mmap.mmap(self._file.fileno(),
+                               self._size,
+                               access=mmap.ACCESS_READ)
+      return self._mmap
+
+  def read_records(self, offsets: Iterable[int], end: int) -> Iterator:
+    """Unpickle the records at offsets (all of them must be before end)."""
+    view = memoryview(self._get_mmap(end))
+    for offset in offsets:
+      size, = _SEGMENT_RECORD_HEADER.unpack_from(view, offset)
+      start = offset + _SEGMENT_RECORD_HEADER.size
+      yield pickle.loads(view[start:start + size])
+
+  def read_raw(self, offsets: Iterable[int], end: int) -> bytes:
+    """Return the records at offsets, still pickled and length-prefixed (see
+    load_raw_records)."""
+    view = memoryview(self._get_mmap(end))
+    parts = []
+    for offset in offsets:
+      size, = _SEGMENT_RECORD_HEADER.unpack_from(view, offset)
+      parts.append(view[offset:offset + _SEGMENT_RECORD_HEADER.size + size])
+    return b''.join(parts)
+
+  def new_sequence(self) -> 'SegmentSequence':
+    return SegmentSequence(self)
+
+
+class SegmentSequence(collections.abc.Sequence):
+  """Records of a SegmentStore, most recently added first.
+
+  This replaces a diskcache.Deque that is only filled with appendleft():
+  extendleft() adds records the same way, but writes them all at once."""
+
+  def __init__(self, store: SegmentStore):
+    self._store = store
+    self._offsets = array.array('Q')
+    self._end = 0
+
+  def extendleft(self, records: Iterable):
+    offsets = self._store.append_records(records)
+    if offsets:
+      self._offsets.extend(offsets)
+      self._end = self._store.size_bytes
+
+  def __len__(self) -> int:
+    return len(self._offsets)
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return list(self)[index]
+    if index < 0:
+      index += len(self._offsets)
+    if not 0 <= index < len(self._offsets):
+      raise IndexError('SegmentSequence index out of range')
+    offset = self._offsets[len(self._offsets) - 1 - index]
+    return next(self._store.read_records([offset], self._end))
+
+  def __iter__(self) -> Iterator:
+    if not self._offsets:
+      return iter(())
+    return self._store.read_records(reversed(self._offsets), self._end)
+
+  def raw_chunks(self, max_records: int) -> Iterator[bytes]:
+    """Yield the records in order, by chunks of at most max_records, without
+    unpickling them (e.g. to pass them to another process)."""
+    offsets = self._offsets[::-1]
+    for i in range(0, len(offsets), max_records):
+      yield self._store.read_raw(offsets[i:i + max_records], self._end)
+
+
+def load_raw_records(data: bytes) -> Iterator:
+  """Unpickle the records returned by SegmentSequence.raw_chunks()."""
+  view = memoryview(data)
+  offset = 0
+  while offset < len(view):
+    size, = _SEGMENT_RECORD_HEADER.unpack_from(view, offset)
+    offset += _SEGMENT_RECORD_HEADER.size
+    yield pickle.loads(view[offset:offset + size])
+    offset += size
+
+
+# Argument types that are pickled as-is for the cache key.
+_PLAIN_KEY_TYPES = frozenset([str, int, float, bool, bytes, type(None)])
+
+
+def _key_arg(arg):
+  """Return what should be hashed for a single argument of a cached function.
+
+  Objects implementing a cache_key() method (e.g. models.Resource and
+  models.Context) are represented by their class and cache key, so that we
+  don't need to pickle the whole object for every call."""
+  arg_type = type(arg)
+  if arg_type in _PLAIN_KEY_TYPES:
+    return arg
+  cache_key = getattr(arg_type, 'cache_key', None)
+  if callable(cache_key):
+    return (arg_type.__module__, arg_type.__qualname__, cache_key(arg))
+  return arg
 
 
 # Write our own implementation instead of using private function
@@ -95,70 +514,477 @@ def get_tmp_deque(prefix='tmp-deque-') -> diskcache.Deque:
 def _make_key(func, args, kwargs):
   h = hashlib.sha256()
   func_name = bytes(func.__module__ + '.' + func.__name__ + ':', 'utf-8')
-  h.update(pickle.dumps(args))
-  h.update(pickle.dumps(kwargs))
+  h.update(pickle.dumps(tuple(map(_key_arg, args))))
+  if kwargs:
+    h.update(pickle.dumps({k: _key_arg(v) for k, v in kwargs.items()}))
   # we don't hash the function name so that it's easier to debug
   key = func_name + h.digest()
   return key
 
 
-@contextlib.contextmanager
-def _acquire_timeout(lock, timeout, name):
-  result = lock.acquire(timeout=timeout)
-  if not result:
-    raise RuntimeError(f"Couldn't acquire lock for {name}.")
-  try:
-    yield
-  finally:
-    if result:
-      lock.release()
+def call_key(func: Callable,
+             args: tuple,
+             kwargs: Optional[dict] = None) -> bytes:
+  """Return the key under which cached_api_call caches the result of
+  func(*args, **kwargs)."""
+  return _make_key(func, args, kwargs or {})
+
+
+class SingleFlightInfo(NamedTuple):
+  # number of calls currently executing
+  in_flight: int
+  # number of calls that waited for the result of an identical in-flight call
+  deduplicated: int
+
+
+# Result of a SingleFlight call telling the callers waiting for it to retry.
+_RETRY_CALL = object()
+
+
+class SingleFlight:
+  """Make sure that only one call per key is executing at any time.
+
+  Callers that arrive while a call with the same key is in flight wait for
+  its result instead of doing the call themselves. Entries are removed as soon
+  as the call completes, so that memory usage doesn't grow with the number of
+  distinct keys ever requested.
+
+  If the call exceeds the deadline of the calling thread (e.g. of its rule),
+  the waiting callers aren't given the DeadlineExceededError: they retry, and
+  one of them does the call.
+  """
+
+  _calls: Dict[bytes, concurrent.futures.Future]
+
+  def __init__(self, on_wait: Optional[Callable[[float], None]] = None):
+    """Args:
+
+      on_wait: called with the number of seconds that a caller waited for the
+        result of an identical in-flight call.
+    """
+    self._lock = threading.Lock()
+    self._calls = {}
+    self._deduplicated = 0
+    self._on_wait = on_wait
+
+  def do(self, key: bytes, func: Callable[[], Any], timeout: float, name: str):
+    while True:
+      with self._lock:
+        future = self._calls.get(key)
+        if future is None:
+          future = concurrent.futures.Future()
+          self._calls[key] = future
+          break
+        self._deduplicated += 1
+
+      start_time = time.monotonic()
+      try:
+        with tracing.span(name, 'cache lock wait'):
+          result = future.result(timeout=timeout)
+      except concurrent.futures.TimeoutError as err:
+        raise RuntimeError(f"Couldn't acquire lock for {name}.") from err
+      finally:
+        if self._on_wait:
+          self._on_wait(time.monotonic() - start_time)
+      if result is not _RETRY_CALL:
+        return result
+
+    # The entry is removed before the future is done, so that retrying callers
+    # don't find it anymore.
+    try:
+      result = func()
+    except deadlines.DeadlineExceededError:
+      self._remove(key)
+      future.set_result(_RETRY_CALL)
+      raise
+    except BaseException as err:
+      self._remove(key)
+      future.set_exception(err)
+      raise
+    self._remove(key)
+    future.set_result(result)
+    return result
+
+  def _remove(self, key: bytes):
+    with self._lock:
+      del self._calls[key]
+
+  def info(self) -> SingleFlightInfo:
+    with self._lock:
+      return SingleFlightInfo(in_flight=len(self._calls),
+                              deduplicated=self._deduplicated)
+
+
+# Upper bounds (in seconds) of the buckets of the CallStats latency histograms.
+STATS_HISTOGRAM_BUCKETS = (0.001, 0.01, 0.1, 1.0, 10.0, 60.0)
+
+
+class CallStats:
+  """Counters and latency histograms of a function decorated with
+  cached_api_call."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self._lock:
+      self.calls = 0
+      self.disk_hits = 0
+      self.misses = 0
+      self.negative_hits = 0
+      self.errors_cached = 0
+      self.stale_hits = 0
+      self.revalidations = 0
+      self.revalidations_unchanged = 0
+      self.deduplicated = 0
+      self.bytes_stored = 0
+      self.lock_wait_seconds = 0.0
+      self.compute_seconds = 0.0
+      self.lock_wait_histogram = [0] * (len(STATS_HISTOGRAM_BUCKETS) + 1)
+      self.compute_histogram = [0] * (len(STATS_HISTOGRAM_BUCKETS) + 1)
+
+  def add_call(self):
+    with self._lock:
+      self.calls += 1
+
+  def add_disk_hit(self):
+    with self._lock:
+      self.disk_hits += 1
+
+  def add_miss(self, compute_seconds: float, bytes_stored: int = 0):
+    with self._lock:
+      self.misses += 1
+      self.bytes_stored += bytes_stored
+      self.compute_seconds += compute_seconds
+      self.compute_histogram[bisect.bisect_left(STATS_HISTOGRAM_BUCKETS,
+                                                compute_seconds)] += 1
+
+  def add_stale_hit(self):
+    with self._lock:
+      self.stale_hits += 1
+
+  def add_revalidation(self, unchanged: bool):
+    with self._lock:
+      self.revalidations += 1
+      if unchanged:
+        self.revalidations_unchanged += 1
+
+  def add_negative_hit(self):
+    with self._lock:
+      self.negative_hits += 1
 
+  def add_error_cached(self):
+    with self._lock:
+      self.errors_cached += 1
 
-def cached_api_call(expire=None, in_memory=False):
+  def add_lock_wait(self, seconds: float):
+    with self._lock:
+      self.deduplicated += 1
+      self.lock_wait_seconds += seconds
+      self.lock_wait_histogram[bisect.bisect_left(STATS_HISTOGRAM_BUCKETS,
+                                                  seconds)] += 1
+
+  def to_dict(self) -> Dict[str, Any]:
+    with self._lock:
+      bucket_names = [f'<={b}s' for b in STATS_HISTOGRAM_BUCKETS] + ['inf']
+      return {
+          'calls':
+              self.calls,
+          # calls that were neither deduplicated nor computed and not
+          # read from disk were served from memory.
+          'memory_hits':
+              self.calls - self.disk_hits - self.misses - self.deduplicated -
+              self.negative_hits,
+          'disk_hits':
+              self.disk_hits,
+          'misses':
+              self.misses,
+          'negative_hits':
+              self.negative_hits,
+          'errors_cached':
+              self.errors_cached,
+          'stale_hits':
+              self.stale_hits,
+          'revalidations':
+              self.revalidations,
+          'revalidations_unchanged':
+              self.revalidations_unchanged,
+          'deduplicated':
+              self.deduplicated,
+          'bytes_stored':
+              self.bytes_stored,
+          'lock_wait_seconds':
+              round(self.lock_wait_seconds, 6),
+          'compute_seconds':
+              round(self.compute_seconds, 6),
+          'lock_wait_histogram':
+              dict(zip(bucket_names, self.lock_wait_histogram)),
+          'compute_histogram':
+              dict(zip(bucket_names, self.compute_histogram)),
+      }
+
+
+# function name -> CallStats of all functions decorated with cached_api_call.
+_stats: Dict[str, CallStats] = {}
+
+
+def get_stats() -> Dict[str, Dict[str, Any]]:
+  """Return the statistics of all cached_api_call functions that were called
+  since the last reset_stats()."""
+  return {
+      name: stats.to_dict()
+      for name, stats in sorted(_stats.items())
+      if stats.calls
+  }
+
+
+def reset_stats():
+  for stats in _stats.values():
+    stats.reset()
+
+
+# lru_cache objects of all functions decorated with cached_api_call(in_memory).
+_lru_cached_funcs: List[Callable] = []
+
+_revalidation_executor = None
+
+
+def _get_revalidation_executor() -> concurrent.futures.Executor:
+  global _revalidation_executor
+  if not _revalidation_executor:
+    _revalidation_executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=config.CACHE_REVALIDATE_WORKERS,
+        thread_name_prefix='cache-revalidate')
+  return _revalidation_executor
+
+
+def _clear_memory():
+  for lru_cached_func in _lru_cached_funcs:
+    lru_cached_func.cache_clear()  # type: ignore
+  get_memory_cache().clear()
+  get_negative_cache().clear()
+
+
+def clear():
+  """Remove all cached results (in memory and on disk)."""
+  _clear_memory()
+  get_cache().clear()
+
+
+def use_isolated_cache():
+  """Use an empty disk cache in a temporary directory instead of the shared
+  cache of config.CACHE_DIR, until use_shared_cache() is called.
+
+  The results cached in memory are removed, but the shared cache is left
+  untouched: other processes may be using it, and the results computed in
+  the meantime (e.g. from an API snapshot) must not be used by later runs."""
+  global _cache, _shared_cache, _isolated_cache_dir
+  use_shared_cache()
+  _clear_memory()
+  _shared_cache = _cache
+  _isolated_cache_dir = tempfile.TemporaryDirectory(prefix='gcpdiag-cache-')
+  _cache = _open_cache(_isolated_cache_dir.name, config.CACHE_SHARDS)
+
+
+def use_shared_cache():
+  """Go back to the shared cache after use_isolated_cache(), removing the
+  isolated cache and the results cached in memory."""
+  global _cache, _shared_cache, _isolated_cache_dir
+  if _isolated_cache_dir is None:
+    return
+  _clear_memory()
+  if _cache is not None:
+    _cache.close()
+  _isolated_cache_dir.cleanup()
+  _cache = _shared_cache
+  _shared_cache = None
+  _isolated_cache_dir = None
+
+
+def cached_api_call(expire=None, in_memory=False, revalidate_after=None):
   """Caching decorator optimized for API calls.
 
   This is very similar to functools.lru_cache, with the following differences:
   - uses diskcache so that the memory footprint doesn't grow uncontrollably (the
     API results might be big).
-  - uses a lock so that if the function is called from two threads
-    simultaneously, only one API call will be done and the other will wait until
-    the result is available in the cache.
+  - results are additionally kept in a size-bounded in-memory LRU cache
+    (see get_memory_cache()), so that hot objects don't need to be read from
+    diskcache and unpickled on every call.
+  - uses a SingleFlight object so that if the function is called from two
+    threads simultaneously, only one API call will be done and the other will
+    wait for its result. The number of deduplicated calls is available with
+    wrapper.singleflight.info().
+  - API errors (see negative_cache_class()) are cached in memory for the
+    number of seconds configured in config.CACHE_NEGATIVE_TTL, so that e.g. a
+    disabled API is queried only once and not by every rule.
+  - collects hit/miss counters and latency histograms (see get_stats() and
+    wrapper.stats).
 
   Parameters:
   - expire: number of seconds until the key expires (default: expire when the
     process ends)
   - in_memory: if true the result will be kept in memory, similarly to
     lru_cache (but with the locking).
+  - revalidate_after: number of seconds after which a cached result is stale
+    (requires expire). A stale result isn't used, unless the cache_serve_stale
+    option is set (e.g. by the webhook): it is then still returned
+    immediately, but the function is called again in the background to
+    refresh the cache. If the new result is the same (i.e. the serialized data
+    is identical), only the expiration of the existing entry is extended.
   """
+  if revalidate_after and (in_memory or not expire):
+    raise ValueError('revalidate_after requires expire and not in_memory')
 
   def _cached_api_call_decorator(func):
-    lockdict = collections.defaultdict(threading.Lock)
+    func_name = f'{func.__module__}.{func.__qualname__}'
+    stats = _stats.setdefault(func_name, CallStats())
+    singleflight = SingleFlight(on_wait=stats.add_lock_wait)
     if in_memory:
-      lru_cached_func = functools.lru_cache()(func)
+
+      def _timed_func(*args, **kwargs):
+        start_time = time.monotonic()
+        try:
+          with call_audit.cache_miss(func_name):
+            return func(*args, **kwargs)
+        finally:
+          stats.add_miss(time.monotonic() - start_time)
+
+      lru_cached_func = functools.lru_cache()(_timed_func)
+      _lru_cached_funcs.append(lru_cached_func)
+
+    revalidating = set()
+    revalidating_lock = threading.Lock()
+
+    def _revalidate(key, args, kwargs, cached_data, cached_result):
+      try:
+        result = func(*args, **kwargs)
+        data, size = get_serializer().dumps(result)
+        api_cache = get_cache()
+        unchanged = data == cached_data and api_cache.touch(key, expire)
+        if unchanged:
+          # keep the existing objects (and avoid writing the same data).
+          result = cached_result
+        else:
+          logging.debug('revalidated result of %s changed', func.__name__)
+          api_cache.set(key, data, expire=expire)
+        get_memory_cache().set(key, result, size, expire=revalidate_after)
+        stats.add_revalidation(unchanged)
+      except Exception as err:  # pylint: disable=broad-except
+        # we will try again the next time that the stale result is used.
+        logging.debug('revalidation of %s failed: %s', func.__name__, err)
+      finally:
+        with revalidating_lock:
+          revalidating.discard(key)
+
+    def _schedule_revalidation(key, args, kwargs, cached_data, cached_result):
+      with revalidating_lock:
+        if key in revalidating:
+          return
+        revalidating.add(key)
+      logging.debug('revalidating stale result of %s', func.__name__)
+      _get_revalidation_executor().submit(_revalidate, key, args, kwargs,
+                                          cached_data, cached_result)
+
+    def _disk_cached_call(key, args, kwargs):
+      memory_cache = get_memory_cache()
+      # The disk tier stores serialized bytes, so that we know the size
+      # of the value when promoting it to the memory tier.
+      api_cache = get_cache()
+      cached = api_cache.get(key, expire_time=True)
+      # FanoutCache returns just the default (not a tuple) on timeouts.
+      cached_data, cached_expire_time = cached if cached else (None, None)
+      cached_result = None
+      cached_size = None
+      if isinstance(cached_data, bytes):
+        try:
+          cached_result, cached_size = Serializer.loads(cached_data)
+        except ValueError:
+          # data written by an older gcpdiag version: ignore it.
+          pass
+      if cached_size is not None:
+        logging.debug('returning cached result for %s', func.__name__)
+        stats.add_disk_hit()
+        memory_expire = None
+        if cached_expire_time:
+          memory_expire = cached_expire_time - time.time()
+        if revalidate_after and memory_expire is not None:
+          # the entry was stored (or revalidated) expire seconds before
+          # cached_expire_time.
+          memory_expire -= expire - revalidate_after
+        if memory_expire is None or memory_expire > 0:
+          memory_cache.set(key,
+                           cached_result,
+                           cached_size,
+                           expire=memory_expire)
+          return cached_result
+        if config.get('cache_serve_stale'):
+          stats.add_stale_hit()
+          _schedule_revalidation(key, args, kwargs, cached_data, cached_result)
+          return cached_result
+        # stale results are only used with the cache_serve_stale option:
+        # fetch a fresh one.
+      logging.debug('calling function %s (expire=%s, key=%s)', func.__name__,
+                    expire, key)
+      start_time = time.monotonic()
+      try:
+        with call_audit.cache_miss(func_name):
+          result = func(*args, **kwargs)
+      except BaseException:
+        stats.add_miss(time.monotonic() - start_time)
+        raise
+      compute_seconds = time.monotonic() - start_time
+      data, size = get_serializer().dumps(result)
+      if expire:
+        api_cache.set(key, data, expire=expire)
+      else:
+        api_cache.set(key,
+                      data,
+                      expire=config.CACHE_TMP_EXPIRY_SECONDS,
+                      tag=_tmp_tag())
+      memory_cache.set(key, result, size, expire=revalidate_after or expire)
+      stats.add_miss(compute_seconds, len(data))
+      return result
+
+    def _negative_cached_call(key, call):
+      try:
+        return call()
+      except Exception as err:
+        ttl = config.CACHE_NEGATIVE_TTL.get(negative_cache_class(err))
+        if ttl:
+          logging.debug('caching %s of %s for %ds',
+                        type(err).__name__, func.__name__, ttl)
+          get_negative_cache().set(key, err, 1, expire=ttl)
+          stats.add_error_cached()
+        raise
 
     @functools.wraps(func)
     def _cached_api_call_wrapper(*args, **kwargs):
+      stats.add_call()
       key = _make_key(func, args, kwargs)
-      lock = lockdict[key]
-      with _acquire_timeout(lock, config.CACHE_LOCK_TIMEOUT, func.__name__):
-        if in_memory:
-          return lru_cached_func(*args, **kwargs)
-        else:
-          api_cache = get_cache()
-          # We use 'no data' to be able to cache calls that returned None.
-          cached_result = api_cache.get(key, default='no data')
-          if cached_result != 'no data':
-            logging.debug('returning cached result for %s', func.__name__)
-            return cached_result
-          logging.debug('calling function %s (expire=%s, key=%s)',
-                        func.__name__, expire, key)
-          result = func(*args, **kwargs)
-          if expire:
-            api_cache.set(key, result, expire=expire)
-          else:
-            api_cache.set(key, result, tag='tmp')
-          return result
+      cached_err = get_negative_cache().get(key)
+      if cached_err is not None:
+        logging.debug('returning cached error for %s', func.__name__)
+        stats.add_negative_hit()
+        # don't accumulate the tracebacks of all previous raises.
+        raise cached_err.with_traceback(None)
+      if in_memory:
+        return singleflight.do(
+            key, lambda: _negative_cached_call(
+                key, lambda: lru_cached_func(*args, **kwargs)),
+            config.CACHE_LOCK_TIMEOUT, func.__name__)
+      # We use 'no data' to be able to cache calls that returned None.
+      cached_result = get_memory_cache().get(key, default='no data')
+      if cached_result != 'no data':
+        logging.debug('returning cached result for %s', func.__name__)
+        return cached_result
+      return singleflight.do(
+          key, lambda: _negative_cached_call(
+              key, lambda: _disk_cached_call(key, args, kwargs)),
+          config.CACHE_LOCK_TIMEOUT, func.__name__)
 
+    _cached_api_call_wrapper.singleflight = singleflight  # type: ignore
+    _cached_api_call_wrapper.stats = stats  # type: ignore
     return _cached_api_call_wrapper
 
   # Decorator without parens -> called with function as first parameter
@@ -0,0 +1,780 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+"""Test code in caching.py."""
+
+import concurrent.futures
+import json
+import pickle
+import threading
+import time
+from unittest import mock
+
+import diskcache
+import googleapiclient.errors
+import httplib2
+import pytest
+
+from gcpdiag import caching, config, deadlines, models, utils
+
+_disk_cache = diskcache.Cache()
+
+
+def get_cache_stub():
+  """Use a temporary directory instead of the user cache for testing."""
+  return _disk_cache
+
+
+class FakeResource(models.Resource):
+  """Resource with some data that shouldn't be part of the cache key."""
+
+  def __init__(self, project_id, name, resource_data):
+    super().__init__(project_id=project_id)
+    self.name = name
+    self.resource_data = resource_data
+
+  @property
+  def full_path(self) -> str:
+    return f'projects/{self.project_id}/fakes/{self.name}'
+
+
+def fake_api_call(*args, **kwargs):
+  del args, kwargs
+
+
+def make_api_error(status, reason=None):
+  content = {'error': {'message': f'error {status}', 'details': []}}
+  if reason:
+    content['error']['details'].append({
+        '@type': 'type.googleapis.com/google.rpc.ErrorInfo',
+        'reason': reason,
+        'metadata': {
+            'service': 'compute.googleapis.com'
+        }
+    })
+  return utils.GcpApiError(
+      googleapiclient.errors.HttpError(httplib2.Response({'status': status}),
+                                       json.dumps(content).encode('utf-8')))
+
+
+class TestMakeKey:
+  """Test caching._make_key."""
+
+  # pylint: disable=protected-access
+  def test_resource_key_ignores_resource_data(self):
+    r1 = FakeResource('p1', 'r1', {'a': 1})
+    r2 = FakeResource('p1', 'r1', {'a': 2})
+    r3 = FakeResource('p1', 'r3', {'a': 1})
+    assert caching._make_key(fake_api_call, (r1,), {}) == \
+        caching._make_key(fake_api_call, (r2,), {})
+    assert caching._make_key(fake_api_call, (r1,), {}) != \
+        caching._make_key(fake_api_call, (r3,), {})
+    assert caching._make_key(fake_api_call, (), {'r': r1}) == \
+        caching._make_key(fake_api_call, (), {'r': r2})
+
+  # pylint: disable=protected-access
+  def test_resource_key_not_pickled(self):
+    # objects implementing cache_key() don't need to be picklable
+    r1 = FakeResource('p1', 'r1', {'lock': threading.Lock()})
+    assert caching._make_key(fake_api_call, (r1,), {})
+
+  # pylint: disable=protected-access
+  def test_context_key(self):
+    c1 = models.Context(project_id='p1')
+    c2 = models.Context(project_id='p1', regions=['us-central1'])
+    assert caching._make_key(fake_api_call, (c1,), {}) == \
+        caching._make_key(fake_api_call, (models.Context(project_id='p1'),), {})
+    assert caching._make_key(fake_api_call, (c1,), {}) != \
+        caching._make_key(fake_api_call, (c2,), {})
+
+  # pylint: disable=protected-access
+  def test_plain_args(self):
+    assert caching._make_key(fake_api_call, ('p1', 1), {}) != \
+        caching._make_key(fake_api_call, ('p1', 2), {})
+    assert caching._make_key(fake_api_call, ('p1',), {}) != \
+        caching._make_key(fake_api_call, ('p1',), {'x': None})
+
+  # pylint: disable=protected-access
+  def test_call_key(self):
+    assert caching.call_key(fake_api_call, ('p1',)) == \
+        caching._make_key(fake_api_call, ('p1',), {})
+    assert caching.call_key(fake_api_call, (), {'x': 1}) == \
+        caching._make_key(fake_api_call, (), {'x': 1})
+
+
+class TestMemoryCache:
+  """Test caching.MemoryCache."""
+
+  def test_get_set(self):
+    cache = caching.MemoryCache(max_bytes=100)
+    assert cache.get(b'a') is None
+    cache.set(b'a', 'value-a', 10)
+    assert cache.get(b'a') == 'value-a'
+    info = cache.info()
+    assert info.hits == 1
+    assert info.misses == 1
+    assert info.entries == 1
+    assert info.size_bytes == 10
+    assert info.hit_rate == 0.5
+
+  def test_lru_eviction_by_size(self):
+    cache = caching.MemoryCache(max_bytes=100)
+    cache.set(b'a', 'value-a', 40)
+    cache.set(b'b', 'value-b', 40)
+    # make 'a' the most recently used entry
+    assert cache.get(b'a') == 'value-a'
+    cache.set(b'c', 'value-c', 40)
+    assert cache.get(b'b') is None
+    assert cache.get(b'a') == 'value-a'
+    assert cache.get(b'c') == 'value-c'
+    assert cache.info().size_bytes == 80
+
+  def test_too_big_value(self):
+    cache = caching.MemoryCache(max_bytes=100)
+    cache.set(b'a', 'value-a', 101)
+    assert cache.get(b'a') is None
+    assert cache.info().size_bytes == 0
+
+  def test_replace_value(self):
+    cache = caching.MemoryCache(max_bytes=100)
+    cache.set(b'a', 'value-a', 40)
+    cache.set(b'a', 'value-a2', 50)
+    assert cache.get(b'a') == 'value-a2'
+    assert cache.info().size_bytes == 50
+
+  def test_expire(self):
+    cache = caching.MemoryCache(max_bytes=100)
+    with mock.patch('time.time', return_value=1000):
+      cache.set(b'a', 'value-a', 10, expire=10)
+      assert cache.get(b'a') == 'value-a'
+    with mock.patch('time.time', return_value=1010):
+      assert cache.get(b'a') is None
+    assert cache.info().entries == 0
+
+
+@mock.patch('gcpdiag.caching.get_cache', new=get_cache_stub)
+class TestCachedApiCall:
+  """Test caching.cached_api_call."""
+
+  def test_memory_tier(self):
+    calls = []
+
+    @caching.cached_api_call
+    def api_call_memory_tier(x):
+      calls.append(x)
+      return {'x': x}
+
+    assert api_call_memory_tier(1) == {'x': 1}
+    # The second call is served from memory without touching the disk tier.
+    with mock.patch.object(_disk_cache, 'get') as disk_get:
+      assert api_call_memory_tier(1) == {'x': 1}
+      disk_get.assert_not_called()
+    assert calls == [1]
+
+  def test_promote_on_disk_hit(self):
+    calls = []
+
+    @caching.cached_api_call
+    def api_call_promote(x):
+      calls.append(x)
+      return {'x': x}
+
+    assert api_call_promote(2) == {'x': 2}
+    # Simulate a new process: the memory tier is empty, but diskcache still
+    # has the result.
+    caching.get_memory_cache().clear()
+    assert api_call_promote(2) == {'x': 2}
+    with mock.patch.object(_disk_cache, 'get') as disk_get:
+      assert api_call_promote(2) == {'x': 2}
+      disk_get.assert_not_called()
+    assert calls == [2]
+
+  def test_cached_none(self):
+    calls = []
+
+    @caching.cached_api_call
+    def api_call_none():
+      calls.append(None)
+
+    assert api_call_none() is None
+    caching.get_memory_cache().clear()
+    assert api_call_none() is None
+    assert len(calls) == 1
+
+
+_fanout_cache = diskcache.FanoutCache(shards=4, tag_index=True)
+
+
+@mock.patch('gcpdiag.caching.get_cache', new=lambda: _fanout_cache)
+class TestShardedCache:
+  """Test caching.cached_api_call with a diskcache.FanoutCache."""
+
+  def test_sharded_cache(self):
+    calls = []
+
+    @caching.cached_api_call
+    def api_call_sharded(x):
+      calls.append(x)
+      return {'x': x}
+
+    for x in range(10):
+      assert api_call_sharded(x) == {'x': x}
+    caching.get_memory_cache().clear()
+    for x in range(10):
+      assert api_call_sharded(x) == {'x': x}
+    assert calls == list(range(10))
+
+  def test_timeout_is_miss(self):
+    calls = []
+
+    @caching.cached_api_call
+    def api_call_timeout(x):
+      calls.append(x)
+      return {'x': x}
+
+    api_call_timeout(1)
+    caching.get_memory_cache().clear()
+    # FanoutCache returns the default value when SQLite times out
+    with mock.patch.object(_fanout_cache, 'get', return_value=None):
+      assert api_call_timeout(1) == {'x': 1}
+    assert calls == [1, 1]
+
+  def test_tmp_tag_per_process(self):
+
+    @caching.cached_api_call
+    def api_call_tmp_tag(x):
+      return {'x': x}
+
+    with mock.patch('os.getpid', return_value=1):
+      api_call_tmp_tag(1)
+    with mock.patch('os.getpid', return_value=2):
+      api_call_tmp_tag(2)
+    # another process exiting doesn't remove the data of process 1
+    assert _fanout_cache.evict('tmp-2') == 1
+    assert _fanout_cache.evict('tmp-1') == 1
+
+
+_revalidation_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+
+@mock.patch('gcpdiag.caching.get_cache', new=get_cache_stub)
+@mock.patch('gcpdiag.caching._get_revalidation_executor',
+            new=lambda: _revalidation_executor)
+@mock.patch.dict(config._defaults, {'cache_serve_stale': True})
+class TestRevalidation:
+  """Test stale-while-revalidate of caching.cached_api_call."""
+
+  def _wait_revalidation(self):
+    # submit a no-op and wait for it: a single worker runs jobs in order.
+    _revalidation_executor.submit(lambda: None).result()
+
+  def test_fresh_result(self):
+    calls = []
+
+    @caching.cached_api_call(expire=100, revalidate_after=10)
+    def api_call_fresh(x):
+      calls.append(x)
+      return {'x': x}
+
+    with mock.patch('time.time', return_value=1000):
+      assert api_call_fresh(1) == {'x': 1}
+      caching.get_memory_cache().clear()
+      assert api_call_fresh(1) == {'x': 1}
+    assert calls == [1]
+    assert api_call_fresh.stats.to_dict()['stale_hits'] == 0
+
+  def test_stale_result_revalidated(self):
+    results = [{'v': 1}, {'v': 2}]
+
+    @caching.cached_api_call(expire=100, revalidate_after=10)
+    def api_call_stale():
+      return results.pop(0)
+
+    with mock.patch('time.time', return_value=1000):
+      assert api_call_stale() == {'v': 1}
+    caching.get_memory_cache().clear()
+    with mock.patch('time.time', return_value=1020):
+      # the stale result is returned without waiting for the new one
+      assert api_call_stale() == {'v': 1}
+      self._wait_revalidation()
+      assert api_call_stale() == {'v': 2}
+      caching.get_memory_cache().clear()
+      assert api_call_stale() == {'v': 2}
+    stats = api_call_stale.stats.to_dict()
+    assert stats['stale_hits'] == 1
+    assert stats['revalidations'] == 1
+    assert stats['revalidations_unchanged'] == 0
+
+  def test_stale_result_not_served_by_default(self):
+    results = [{'v': 1}, {'v': 2}]
+
+    @caching.cached_api_call(expire=100, revalidate_after=10)
+    def api_call_fresh_only():
+      return results.pop(0)
+
+    with mock.patch('time.time', return_value=1000):
+      assert api_call_fresh_only() == {'v': 1}
+    caching.get_memory_cache().clear()
+    with mock.patch.dict(config._defaults, {'cache_serve_stale': False}), \
+        mock.patch('time.time', return_value=1020):
+      # the new result is fetched before returning
+      assert api_call_fresh_only() == {'v': 2}
+      caching.get_memory_cache().clear()
+      assert api_call_fresh_only() == {'v': 2}
+    stats = api_call_fresh_only.stats.to_dict()
+    assert stats['stale_hits'] == 0
+    assert stats['revalidations'] == 0
+
+  def test_unchanged_result_kept(self):
+    calls = []
+
+    @caching.cached_api_call(expire=100, revalidate_after=10)
+    def api_call_unchanged():
+      calls.append(1)
+      return {'v': 1}
+
+    with mock.patch('time.time', return_value=1000):
+      api_call_unchanged()
+    caching.get_memory_cache().clear()
+    with mock.patch('time.time', return_value=1020):
+      stale = api_call_unchanged()
+      self._wait_revalidation()
+      # the object returned before is kept
+      assert api_call_unchanged() is stale
+    with mock.patch('time.time', return_value=1025):
+      caching.get_memory_cache().clear()
+      # the entry was revalidated at 1020: it's fresh again
+      api_call_unchanged()
+    assert len(calls) == 2
+    assert api_call_unchanged.stats.to_dict()['revalidations_unchanged'] == 1
+
+  def test_failed_revalidation(self):
+    calls = []
+
+    @caching.cached_api_call(expire=100, revalidate_after=10)
+    def api_call_failing():
+      calls.append(1)
+      if len(calls) > 1:
+        raise RuntimeError('failed')
+      return {'v': 1}
+
+    with mock.patch('time.time', return_value=1000):
+      api_call_failing()
+    caching.get_memory_cache().clear()
+    with mock.patch('time.time', return_value=1020):
+      assert api_call_failing() == {'v': 1}
+      self._wait_revalidation()
+      # revalidated again on the next use of the stale result
+      assert api_call_failing() == {'v': 1}
+      self._wait_revalidation()
+    assert len(calls) == 3
+
+  def test_requires_expire(self):
+    with pytest.raises(ValueError):
+      caching.cached_api_call(revalidate_after=10)
+    with pytest.raises(ValueError):
+      caching.cached_api_call(expire=100, in_memory=True, revalidate_after=10)
+
+
+class TestSingleFlight:
+  """Test caching.SingleFlight."""
+
+  def test_concurrent_calls_deduplicated(self):
+    singleflight = caching.SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_call():
+      calls.append(1)
+      started.set()
+      release.wait()
+      return 'result'
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(
+            singleflight.do(b'k', slow_call, 10, 'slow_call')))
+        for _ in range(5)
+    ]
+    threads[0].start()
+    started.wait()
+    for t in threads[1:]:
+      t.start()
+    while singleflight.info().deduplicated < 4:
+      time.sleep(0.01)
+    release.set()
+    for t in threads:
+      t.join()
+    assert calls == [1]
+    assert results == ['result'] * 5
+    assert singleflight.info() == caching.SingleFlightInfo(in_flight=0,
+                                                           deduplicated=4)
+
+  def test_entries_reclaimed(self):
+    singleflight = caching.SingleFlight()
+    for i in range(100):
+      assert singleflight.do(str(i).encode(), lambda: 'ok', 10, 'call') == 'ok'
+    assert singleflight.info().in_flight == 0
+
+  def test_exception_shared_with_waiters(self):
+    singleflight = caching.SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def failing_call():
+      started.set()
+      release.wait()
+      raise ValueError('failed')
+
+    errors = []
+
+    def run():
+      try:
+        singleflight.do(b'k', failing_call, 10, 'failing_call')
+      except ValueError as err:
+        errors.append(err)
+
+    threads = [threading.Thread(target=run) for _ in range(2)]
+    threads[0].start()
+    started.wait()
+    threads[1].start()
+    while singleflight.info().deduplicated < 1:
+      time.sleep(0.01)
+    release.set()
+    for t in threads:
+      t.join()
+    assert len(errors) == 2
+    assert singleflight.info().in_flight == 0
+    # the next call is executed again
+    assert singleflight.do(b'k', lambda: 'ok', 10, 'call') == 'ok'
+
+  def test_deadline_not_shared_with_waiters(self):
+    singleflight = caching.SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def call():
+      calls.append(1)
+      if len(calls) == 1:
+        started.set()
+        release.wait()
+        raise deadlines.DeadlineExceededError('rule deadline exceeded')
+      return 'result'
+
+    def run(i):
+      try:
+        results[i] = singleflight.do(b'k', call, 10, 'call')
+      except deadlines.DeadlineExceededError as err:
+        results[i] = err
+
+    results: dict = {}
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(2)]
+    threads[0].start()
+    started.wait()
+    threads[1].start()
+    while singleflight.info().deduplicated < 1:
+      time.sleep(0.01)
+    release.set()
+    for t in threads:
+      t.join()
+    # the waiting caller did the call again.
+    assert len(calls) == 2
+    assert isinstance(results[0], deadlines.DeadlineExceededError)
+    assert results[1] == 'result'
+    assert singleflight.info().in_flight == 0
+
+  def test_timeout(self):
+    singleflight = caching.SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_call():
+      started.set()
+      release.wait()
+
+    t = threading.Thread(
+        target=lambda: singleflight.do(b'k', slow_call, 10, 'slow_call'))
+    t.start()
+    started.wait()
+    with pytest.raises(RuntimeError):
+      singleflight.do(b'k', slow_call, 0.01, 'slow_call')
+    release.set()
+    t.join()
+
+
+class TestSerializer:
+  """Test caching.Serializer."""
+
+  def test_roundtrip(self):
+    values = [
+        None, 'string', {
+            'items': [{
+                'name': 'x' * 10000,
+                'id': 1,
+                'enabled': True
+            }]
+        }, {
+            1: 'int key'
+        }, ('tuple',),
+        FakeResource('p1', 'r1', {'a': 1})
+    ]
+    for encoding in ['pickle', 'json']:
+      for compression in ['none', 'zlib']:
+        serializer = caching.Serializer(encoding=encoding,
+                                        compression=compression)
+        for value in values:
+          data, _ = serializer.dumps(value)
+          assert caching.Serializer.loads(data)[0] == value
+
+  def test_json_only_for_plain_values(self):
+    serializer = caching.Serializer(encoding='json')
+    assert serializer.dumps({'a': [1, 2]})[0] == b'j-{"a":[1,2]}'
+    # int keys and tuples would be changed by json: use pickle instead
+    assert serializer.dumps({1: 'a'})[0].startswith(b'p-')
+    assert serializer.dumps(('a',))[0].startswith(b'p-')
+
+  def test_compression(self):
+    serializer = caching.Serializer(compression='zlib',
+                                    compression_min_bytes=100)
+    data, size = serializer.dumps('x' * 10000)
+    assert data.startswith(b'pz')
+    assert len(data) < size
+    assert caching.Serializer.loads(data) == ('x' * 10000, size)
+    # small values are not compressed
+    assert serializer.dumps('x')[0].startswith(b'p-')
+
+  def test_unknown_format(self):
+    with pytest.raises(ValueError):
+      caching.Serializer.loads(pickle.dumps('legacy'))
+    with pytest.raises(ValueError):
+      caching.Serializer(compression='unknown')
+
+
+@mock.patch('gcpdiag.caching.get_cache', new=get_cache_stub)
+class TestCallStats:
+  """Test statistics collected by caching.cached_api_call."""
+
+  def test_disk_cache_stats(self):
+
+    @caching.cached_api_call
+    def api_call_stats(x):
+      return {'x': x}
+
+    api_call_stats.stats.reset()
+    api_call_stats(1)
+    api_call_stats(1)
+    caching.get_memory_cache().clear()
+    api_call_stats(1)
+    stats = caching.get_stats()['gcpdiag.caching_test.' +
+                                api_call_stats.__qualname__]
+    assert stats['calls'] == 3
+    assert stats['misses'] == 1
+    assert stats['memory_hits'] == 1
+    assert stats['disk_hits'] == 1
+    assert stats['bytes_stored'] > 0
+    assert sum(stats['compute_histogram'].values()) == 1
+
+  def test_in_memory_stats(self):
+
+    @caching.cached_api_call(in_memory=True)
+    def api_call_in_memory_stats(x):
+      return {'x': x}
+
+    api_call_in_memory_stats.stats.reset()
+    api_call_in_memory_stats(1)
+    api_call_in_memory_stats(1)
+    api_call_in_memory_stats(2)
+    stats = api_call_in_memory_stats.stats.to_dict()
+    assert stats['calls'] == 3
+    assert stats['misses'] == 2
+    assert stats['memory_hits'] == 1
+
+  def test_reset_stats(self):
+
+    @caching.cached_api_call(in_memory=True)
+    def api_call_reset_stats():
+      pass
+
+    api_call_reset_stats()
+    caching.reset_stats()
+    assert 'gcpdiag.caching_test.' + api_call_reset_stats.__qualname__ \
+        not in caching.get_stats()
+
+
+@mock.patch('gcpdiag.caching.get_cache', new=get_cache_stub)
+class TestNegativeCache:
+  """Test caching of API errors by caching.cached_api_call."""
+
+  def test_error_classes(self):
+    assert caching.negative_cache_class(make_api_error(
+        403, 'SERVICE_DISABLED')) == 'SERVICE_DISABLED'
+    assert caching.negative_cache_class(
+        make_api_error(403)) == 'PERMISSION_DENIED'
+    assert caching.negative_cache_class(make_api_error(404)) == 'NOT_FOUND'
+    assert caching.negative_cache_class(make_api_error(429)) is None
+    assert caching.negative_cache_class(make_api_error(404).response) == \
+        'NOT_FOUND'
+    assert caching.negative_cache_class(ValueError()) is None
+
+  def test_error_cached(self):
+    calls = []
+
+    @caching.cached_api_call
+    def api_call_disabled(x):
+      calls.append(x)
+      raise make_api_error(403, 'SERVICE_DISABLED')
+
+    for _ in range(3):
+      with pytest.raises(utils.GcpApiError):
+        api_call_disabled(1)
+    assert calls == [1]
+    stats = api_call_disabled.stats.to_dict()
+    assert stats['errors_cached'] == 1
+    assert stats['negative_hits'] == 2
+
+  def test_error_cached_in_memory(self):
+    calls = []
+
+    @caching.cached_api_call(in_memory=True)
+    def api_call_not_found(x):
+      calls.append(x)
+      raise make_api_error(404)
+
+    for _ in range(3):
+      with pytest.raises(utils.GcpApiError):
+        api_call_not_found(1)
+    assert calls == [1]
+
+  def test_error_expires(self):
+    calls = []
+
+    @caching.cached_api_call
+    def api_call_forbidden(x):
+      calls.append(x)
+      raise make_api_error(403)
+
+    with mock.patch('time.time', return_value=1000):
+      with pytest.raises(utils.GcpApiError):
+        api_call_forbidden(1)
+    with mock.patch('time.time',
+                    return_value=1000 +
+                    caching.config.CACHE_NEGATIVE_TTL['PERMISSION_DENIED']):
+      with pytest.raises(utils.GcpApiError):
+        api_call_forbidden(1)
+    assert calls == [1, 1]
+
+  def test_transient_error_not_cached(self):
+    calls = []
+
+    @caching.cached_api_call
+    def api_call_unavailable(x):
+      calls.append(x)
+      raise make_api_error(503)
+
+    for _ in range(2):
+      with pytest.raises(utils.GcpApiError):
+        api_call_unavailable(1)
+    assert calls == [1, 1]
+
+
+class TestIsolatedCache:
+  """Test caching.use_isolated_cache()."""
+
+  def test_isolated_cache(self, tmp_path):
+    shared_cache = diskcache.Cache(str(tmp_path))
+    shared_cache.set('other-process-key', 'value')
+    calls = []
+
+    @caching.cached_api_call(expire=3600)
+    def get_value():
+      calls.append(1)
+      return len(calls)
+
+    with mock.patch('gcpdiag.caching._cache', new=shared_cache):
+      assert get_value() == 1
+      caching.use_isolated_cache()
+      try:
+        assert caching.get_cache() is not shared_cache
+        # results of the shared cache are not used...
+        assert get_value() == 2
+        assert get_value() == 2
+      finally:
+        caching.use_shared_cache()
+      assert caching.get_cache() is shared_cache
+      # ...and the shared cache isn't modified.
+      assert shared_cache.get('other-process-key') == 'value'
+      assert get_value() == 1
+
+
+class TestSegmentStore:
+  """Test caching.SegmentStore and caching.SegmentSequence."""
+
+  def test_deque_order(self):
+    store = caching.SegmentStore()
+    seq = store.new_sequence()
+    assert not seq
+    assert list(seq) == []
+    seq.extendleft([{'n': 1}, {'n': 2}])
+    seq.extendleft([{'n': 3}])
+    # same order as diskcache.Deque.appendleft() of every record
+    assert list(seq) == [{'n': 3}, {'n': 2}, {'n': 1}]
+    assert len(seq) == 3
+    assert seq[0] == {'n': 3}
+    assert seq[-1] == {'n': 1}
+    assert seq[1:] == [{'n': 2}, {'n': 1}]
+    with pytest.raises(IndexError):
+      _ = seq[3]
+
+  def test_raw_chunks(self):
+    store = caching.SegmentStore()
+    seq = store.new_sequence()
+    seq.extendleft(range(5))
+    seq.extendleft(['a', 'b'])
+    chunks = list(seq.raw_chunks(3))
+    assert len(chunks) == 3
+    assert [list(caching.load_raw_records(c)) for c in chunks
+           ] == [['b', 'a', 4], [3, 2, 1], [0]]
+
+  def test_shared_store(self):
+    store = caching.SegmentStore()
+    seq1 = store.new_sequence()
+    seq2 = store.new_sequence()
+    seq1.extendleft(['a1'])
+    seq2.extendleft(['b1', 'b2'])
+    # reading remaps the file when it grew since the last read
+    assert list(seq1) == ['a1']
+    seq1.extendleft(['a2' * 10000])
+    assert list(seq1) == ['a2' * 10000, 'a1']
+    assert list(seq2) == ['b2', 'b1']
+
+  def test_concurrent_writers(self):
+    store = caching.SegmentStore()
+    seqs = [store.new_sequence() for _ in range(8)]
+
+    def write(i):
+      for page in range(20):
+        seqs[i].extendleft([(i, page, n) for n in range(50)])
+
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(8)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    for i, seq in enumerate(seqs):
+      assert list(seq) == [(i, page, n)
+                           for page in reversed(range(20))
+                           for n in reversed(range(50))]
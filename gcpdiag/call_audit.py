@@ -0,0 +1,205 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+"""Audit of the API calls done by run_rule functions.
+
+Rules are supposed to fetch their data with QUERIES or in prefetch_rule, so
+that run_rule only gets cached results. When the audit is started, every
+cached_api_call miss and every API request that isn't part of a
+cached_api_call miss is recorded for the rule in whose run_rule it happened,
+with the stack location from where it was called.
+
+The current rule is tracked with a context variable, so that calls done by
+tasks that a rule submitted to the shared executor are attributed to the rule
+as well.
+"""
+
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+import traceback
+import urllib.parse
+from typing import Any, Dict, List, Optional, Tuple
+
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Frames of these modules are not interesting as call locations.
+_SKIPPED_FILES = frozenset(
+    os.path.join(_PACKAGE_DIR, f) for f in [
+        'call_audit.py', 'caching.py', 'executor.py', 'tracing.py',
+        'lint/__init__.py', 'queries/apis.py', 'queries/apis_utils.py'
+    ])
+
+_lock = threading.Lock()
+# Recorded calls per rule, or None when the audit is not started.
+_calls: Optional[Dict[str, Dict[Tuple[str, str, Tuple[str, ...]],
+                                '_CallRecord']]] = None
+_rule: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    'call_audit_rule', default=None)
+_current_call: contextvars.ContextVar[Optional['_CallRecord']] = \
+    contextvars.ContextVar('call_audit_call', default=None)
+
+
+class _CallRecord:
+  """Calls of a rule with the same kind, name and stack."""
+
+  def __init__(self, kind: str, name: str, stack: Tuple[str, ...]):
+    self.kind = kind
+    self.name = name
+    self.stack = stack
+    self.count = 0
+    self.api_requests = 0
+    self.seconds = 0.0
+
+  def to_dict(self) -> Dict[str, Any]:
+    # the location is the innermost frame in the rule code, if any.
+    location = next(
+        (f for f in reversed(self.stack) if f.startswith('gcpdiag/lint/')),
+        self.stack[-1] if self.stack else None)
+    return {
+        'kind': self.kind,
+        'name': self.name,
+        'location': location,
+        'count': self.count,
+        'api_requests': self.api_requests,
+        'seconds': round(self.seconds, 6),
+        'stack': list(self.stack)
+    }
+
+
+def _stack() -> Tuple[str, ...]:
+  """Return the gcpdiag frames of the current stack, outermost first."""
+  frames = []
+  for frame in traceback.extract_stack():
+    if not frame.filename.startswith(_PACKAGE_DIR + os.sep):
+      continue
+    if frame.filename in _SKIPPED_FILES:
+      continue
+    path = os.path.relpath(frame.filename, os.path.dirname(_PACKAGE_DIR))
+    frames.append(f'{path}:{frame.lineno} in {frame.name}')
+  # only keep the frames from the rule down, if the rule is on the stack.
+  for i, location in enumerate(frames):
+    if location.startswith('gcpdiag/lint/'):
+      return tuple(frames[i:])
+  return tuple(frames)
+
+
+def _get_record(kind: str, name: str) -> Optional[_CallRecord]:
+  rule = _rule.get()
+  if rule is None or _calls is None:
+    return None
+  stack = _stack()
+  with _lock:
+    if _calls is None:
+      return None
+    rule_calls = _calls.setdefault(rule, {})
+    record = rule_calls.get((kind, name, stack))
+    if record is None:
+      record = _CallRecord(kind, name, stack)
+      rule_calls[(kind, name, stack)] = record
+    record.count += 1
+  return record
+
+
+def start():
+  """Start recording (and forget any previously recorded call)."""
+  global _calls
+  with _lock:
+    _calls = {}
+
+
+def stop():
+  global _calls
+  with _lock:
+    _calls = None
+
+
+@contextlib.contextmanager
+def run_phase(rule_name: str):
+  """Attribute the calls done in this block to the rule."""
+  token = _rule.set(rule_name)
+  try:
+    yield
+  finally:
+    _rule.reset(token)
+
+
+@contextlib.contextmanager
+def cache_miss(func_name: str):
+  """Record a cached_api_call miss (and the API requests that it does)."""
+  if _calls is None or _current_call.get() is not None:
+    # nested misses are part of the outer miss.
+    yield
+    return
+  record = _get_record('cache miss', func_name)
+  if record is None:
+    yield
+    return
+  token = _current_call.set(record)
+  start_time = time.monotonic()
+  try:
+    yield
+  finally:
+    _current_call.reset(token)
+    with _lock:
+      record.seconds += time.monotonic() - start_time
+
+
+@contextlib.contextmanager
+def api_request(method: str, uri: str):
+  """Record an API request done in this block."""
+  if _calls is None:
+    yield
+    return
+  call = _current_call.get()
+  if call is not None:
+    with _lock:
+      call.api_requests += 1
+    yield
+    return
+  parsed = urllib.parse.urlsplit(uri)
+  record = _get_record('uncached request',
+                       f'{method} {parsed.netloc}{parsed.path}')
+  if record is None:
+    yield
+    return
+  start_time = time.monotonic()
+  try:
+    yield
+  finally:
+    with _lock:
+      record.api_requests += 1
+      record.seconds += time.monotonic() - start_time
+
+
+def get_report() -> Dict[str, List[Dict[str, Any]]]:
+  """Return the recorded calls per rule, the slowest first."""
+  with _lock:
+    calls = {
+        rule: list(records.values())
+        for rule, records in (_calls or {}).items()
+    }
+  report = {}
+  for rule, records in sorted(calls.items()):
+    records.sort(key=lambda r: (-r.seconds, -r.count, r.kind, r.name))
+    report[rule] = [r.to_dict() for r in records]
+  return report
+
+
+def save(path: str):
+  with open(path, 'w', encoding='utf-8') as f:
+    json.dump(get_report(), f, indent=2)
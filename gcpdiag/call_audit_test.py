@@ -0,0 +1,99 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+"""Test code in call_audit.py."""
+
+import json
+
+from gcpdiag import call_audit, executor
+
+
+def _request(uri='https://compute.googleapis.com/compute/v1/x?pageToken=a'):
+  with call_audit.api_request('GET', uri):
+    pass
+
+
+def _query():
+  with call_audit.cache_miss('queries.get_things'):
+    _request()
+    _request()
+    with call_audit.cache_miss('queries.get_other_things'):
+      _request()
+
+
+class TestCallAudit:
+  """Test recording of the API calls done in the run phase."""
+
+  def setup_method(self):
+    call_audit.start()
+
+  def teardown_method(self):
+    call_audit.stop()
+
+  def test_not_started(self):
+    call_audit.stop()
+    with call_audit.run_phase('rule'):
+      _query()
+    assert call_audit.get_report() == {}
+
+  def test_outside_run_phase(self):
+    _query()
+    _request()
+    assert call_audit.get_report() == {}
+
+  def test_cache_miss(self):
+    with call_audit.run_phase('rule'):
+      for _ in range(2):
+        _query()
+    (miss,) = call_audit.get_report()['rule']
+    assert miss['kind'] == 'cache miss'
+    assert miss['name'] == 'queries.get_things'
+    assert miss['count'] == 2
+    # the nested miss is part of the outer one
+    assert miss['api_requests'] == 6
+    caller, callee = miss['stack'][-2:]
+    assert caller.startswith('gcpdiag/call_audit_test.py:')
+    assert caller.endswith(' in test_cache_miss')
+    assert callee.endswith(' in _query')
+
+  def test_uncached_request(self):
+    with call_audit.run_phase('rule1'):
+      _request()
+      _request('https://compute.googleapis.com/compute/v1/x?pageToken=b')
+    with call_audit.run_phase('rule2'):
+      _request()
+    report = call_audit.get_report()
+    assert sorted(report) == ['rule1', 'rule2']
+    # called from two different lines
+    request1, request2 = report['rule1']
+    assert request1['stack'] != request2['stack']
+    for request in report['rule1']:
+      assert request['kind'] == 'uncached request'
+      assert request['name'] == 'GET compute.googleapis.com/compute/v1/x'
+      assert request['count'] == 1
+    assert report['rule2'][0]['api_requests'] == 1
+
+  def test_executor(self):
+    with call_audit.run_phase('rule'):
+      list(executor.get_executor().map(lambda _: _request(), range(3)))
+    requests = call_audit.get_report()['rule']
+    assert sum(r['api_requests'] for r in requests) == 3
+
+  def test_save(self, tmp_path):
+    with call_audit.run_phase('rule'):
+      _query()
+    path = tmp_path / 'calls.json'
+    call_audit.save(str(path))
+    assert json.loads(path.read_text()) == call_audit.get_report()
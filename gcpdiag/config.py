@@ -69,12 +69,90 @@ CACHE_DIR = appdirs.user_cache_dir('gcpdiag')
 # Number of seconds to wait for the gcpdiag.cache API cache lock to be freed.
 CACHE_LOCK_TIMEOUT = 120
 
+# Number of diskcache shards (diskcache.FanoutCache) used for the API cache.
+# With 0, a single diskcache.Cache is used, which serializes all writers on
+# one SQLite database. Use shards when multiple processes (e.g. gunicorn
+# workers) share CACHE_DIR.
+CACHE_SHARDS = 0
+
+# SQLite timeout in seconds of a cache shard. Reads and writes that time out
+# are treated as cache misses.
+CACHE_SHARDS_TIMEOUT = 1.0
+
+# Number of seconds after which values cached only for the duration of a
+# process are removed, in case that process didn't exit cleanly.
+CACHE_TMP_EXPIRY_SECONDS = 3600 * 24
+
+# Maximum size in bytes of the in-memory tier that sits in front of diskcache
+# (set to 0 to disable it).
+CACHE_MEMORY_MAX_BYTES = 64 * 1024 * 1024
+
+# Serialization of the values stored in diskcache (see caching.Serializer).
+CACHE_ENCODING = 'pickle'
+CACHE_COMPRESSION = 'zlib'
+CACHE_COMPRESSION_MIN_BYTES = 4096
+
+# Number of seconds to cache API errors, per error class (see
+# caching.negative_cache_class). Set to 0 to disable caching of an error class.
+CACHE_NEGATIVE_TTL = {
+    'SERVICE_DISABLED': 600,
+    'PERMISSION_DENIED': 300,
+    'NOT_FOUND': 60,
+}
+
+# Maximum number of cached API errors.
+CACHE_NEGATIVE_MAX_ENTRIES = 10000
+
+# Resources cached with stale-while-revalidate (see caching.cached_api_call):
+# after CACHE_REVALIDATE_AFTER_SECONDS the cached value is fetched again. With
+# the cache_serve_stale option, it is still returned and refetched in the
+# background instead, until CACHE_STALE_EXPIRY_SECONDS.
+CACHE_REVALIDATE_AFTER_SECONDS = 60
+CACHE_STALE_EXPIRY_SECONDS = 3600
+
+# Number of threads used to revalidate stale cached values.
+CACHE_REVALIDATE_WORKERS = 2
+
 # How long to cache documents that rarely change (e.g. predefined IAM roles).
 STATIC_DOCUMENTS_EXPIRY_SECONDS = 3600 * 24
 
+# How long to cache the discovery documents of APIs that aren't bundled with
+# googleapiclient.
+DISCOVERY_DOCUMENTS_EXPIRY_SECONDS = 3600 * 24 * 7
+
 # Prefetch worker threads
 MAX_WORKERS = 10
 
+# With the cpu_workers option, executor.filter_records() scans at least
+# CPU_OFFLOAD_MIN_RECORDS records in worker processes, by chunks of
+# CPU_OFFLOAD_CHUNK_RECORDS.
+CPU_OFFLOAD_MIN_RECORDS = 2000
+CPU_OFFLOAD_CHUNK_RECORDS = 1000
+
+# Concurrency of requests per API service (see apis_utils.ConcurrencyLimiter):
+# starts at API_CONCURRENCY_INITIAL, grows while requests are fast and
+# successful, and is multiplied by API_CONCURRENCY_BACKOFF on 429/5xx errors.
+# Requests are made by both the prefetch and the rule worker threads, so the
+# maximum is above MAX_WORKERS.
+API_CONCURRENCY_INITIAL = MAX_WORKERS
+API_CONCURRENCY_MIN = 1
+API_CONCURRENCY_MAX = 2 * MAX_WORKERS
+API_CONCURRENCY_BACKOFF = 0.5
+
+# Requests slower than this factor times the average latency of an API don't
+# raise its concurrency limit.
+API_CONCURRENCY_LATENCY_FACTOR = 2.0
+
+# Maximum number of idle httplib2.Http objects (each with its keep-alive
+# connections) kept by apis_utils.PooledHttp.
+API_HTTP_POOL_MAX_IDLE = API_CONCURRENCY_MAX
+
+# Maximum number of requests per batch HTTP request of
+# apis_utils.batch_execute_all(), by default and for the APIs that have a lower
+# limit (googleapiclient refuses batches of more than 1000 requests).
+API_BATCH_MAX_REQUESTS = 100
+API_BATCH_MAX_REQUESTS_PER_SERVICE: Dict[str, int] = {}
+
 _args: Dict[str, Any] = {}
 _config: Dict[str, Any] = {}
 _project_id: str = ''
@@ -97,6 +175,15 @@ _defaults: Dict[str, Any] = {
     'logging_page_size': 500,
     'logging_fetch_max_entries': 10000,
     'logging_fetch_max_time_seconds': 120,
+    'run_timeout_seconds': None,
+    'rule_timeout_seconds': None,
+    'cpu_workers': 0,
+    'cache_serve_stale': False,
+    'cache_stats_file': None,
+    'trace_file': None,
+    'run_phase_calls_file': None,
+    'snapshot_record': None,
+    'snapshot_replay': None,
 }
 
 #
@@ -0,0 +1,95 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Deadlines of the lint run and of the rules, with cooperative cancellation.
+
+There is one deadline for the whole run, which applies to all threads, and
+a deadline for the rule running in the current thread. Long-running query
+functions call check() regularly (e.g. for every page of results), so that
+they stop with DeadlineExceededError once the deadline is exceeded.
+
+Deadlines are time.monotonic() values.
+"""
+
+import contextlib
+import threading
+import time
+from typing import Optional
+
+_run_deadline: Optional[float] = None
+_local = threading.local()
+
+
+class DeadlineExceededError(Exception):
+  """The deadline of the run or of the current rule was exceeded."""
+
+
+def after(seconds: Optional[float]) -> Optional[float]:
+  """Return the deadline `seconds` from now (None if seconds isn't set)."""
+  if not seconds:
+    return None
+  return time.monotonic() + seconds
+
+
+def earliest(*deadlines: Optional[float]) -> Optional[float]:
+  """Return the earliest of deadlines that are set, or None."""
+  deadlines_set = [d for d in deadlines if d is not None]
+  return min(deadlines_set) if deadlines_set else None
+
+
+def set_run_timeout(seconds: Optional[float]):
+  """Set the deadline of the run to `seconds` from now (None: no deadline)."""
+  global _run_deadline
+  _run_deadline = after(seconds)
+
+
+def get_run_deadline() -> Optional[float]:
+  return _run_deadline
+
+
+def run_expired() -> bool:
+  return _run_deadline is not None and time.monotonic() >= _run_deadline
+
+
+@contextlib.contextmanager
+def rule_deadline(deadline: Optional[float]):
+  """Set the deadline of the rule running in the current thread."""
+  previous = getattr(_local, 'deadline', None)
+  _local.deadline = deadline
+  try:
+    yield
+  finally:
+    _local.deadline = previous
+
+
+def current() -> Optional[float]:
+  """Return the deadline that applies to the current thread, or None."""
+  return earliest(_run_deadline, getattr(_local, 'deadline', None))
+
+
+def remaining() -> Optional[float]:
+  """Return the number of seconds until current(), or None."""
+  deadline = current()
+  if deadline is None:
+    return None
+  return max(0.0, deadline - time.monotonic())
+
+
+def check():
+  """Raise DeadlineExceededError if the current deadline was exceeded."""
+  now = time.monotonic()
+  if _run_deadline is not None and now >= _run_deadline:
+    raise DeadlineExceededError('run deadline exceeded')
+  deadline = getattr(_local, 'deadline', None)
+  if deadline is not None and now >= deadline:
+    raise DeadlineExceededError('rule deadline exceeded')
@@ -0,0 +1,71 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+"""Test code in deadlines.py."""
+
+import threading
+import time
+
+import pytest
+
+from gcpdiag import deadlines
+
+
+class TestDeadlines:
+  """Test run and rule deadlines."""
+
+  def teardown_method(self):
+    deadlines.set_run_timeout(None)
+
+  def test_no_deadline(self):
+    assert deadlines.current() is None
+    assert deadlines.remaining() is None
+    assert not deadlines.run_expired()
+    deadlines.check()
+
+  def test_run_deadline(self):
+    deadlines.set_run_timeout(0.05)
+    deadlines.check()
+    assert 0 < deadlines.remaining() <= 0.05
+    time.sleep(0.05)
+    assert deadlines.run_expired()
+    assert deadlines.remaining() == 0
+    with pytest.raises(deadlines.DeadlineExceededError,
+                       match='run deadline exceeded'):
+      deadlines.check()
+
+  def test_rule_deadline_is_per_thread(self):
+    other_thread_errors = []
+
+    def check_other_thread():
+      try:
+        deadlines.check()
+      except deadlines.DeadlineExceededError as err:
+        other_thread_errors.append(err)
+
+    with deadlines.rule_deadline(time.monotonic() - 1):
+      with pytest.raises(deadlines.DeadlineExceededError,
+                         match='rule deadline exceeded'):
+        deadlines.check()
+      thread = threading.Thread(target=check_other_thread)
+      thread.start()
+      thread.join()
+    assert not other_thread_errors
+    deadlines.check()
+
+  def test_earliest(self):
+    assert deadlines.earliest(None, None) is None
+    assert deadlines.earliest(None, 2.0, 1.0) == 1.0
+    assert deadlines.after(None) is None
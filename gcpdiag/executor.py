@@ -14,16 +14,167 @@
 """ThreadPoolExecutor instance that can be used to run tasks in parallel"""
 
 import concurrent.futures
-from typing import Optional
+import contextvars
+import multiprocessing
+import os
+import pickle
+import threading
+import time
+from typing import Callable, Iterable, List, Optional, Sequence, Union
 
-from gcpdiag import config
+from gcpdiag import caching, config, deadlines
 
 _executor: Optional[concurrent.futures.Executor] = None
+_process_executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+
+
+class _StealableTask:
+  """Task that is executed either by a pool worker or by the thread waiting for
+  its result, whichever claims it first."""
+
+  def __init__(self, fn, args):
+    self.fn = fn
+    self.args = args
+    self.future: concurrent.futures.Future = concurrent.futures.Future()
+    self._claimed = False
+    self._lock = threading.Lock()
+
+  def claim(self) -> bool:
+    with self._lock:
+      if self._claimed:
+        return False
+      self._claimed = True
+      return True
+
+  def run(self):
+    if not self.claim() or not self.future.set_running_or_notify_cancel():
+      return
+    try:
+      result = self.fn(*self.args)
+    except BaseException as exc:  # pylint: disable=broad-except
+      self.future.set_exception(exc)
+    else:
+      self.future.set_result(result)
+
+
+class NestedThreadPoolExecutor(concurrent.futures.ThreadPoolExecutor):
+  """ThreadPoolExecutor supporting map() calls from its own worker threads.
+
+  With a plain ThreadPoolExecutor, a task that calls map() on the executor
+  running it blocks a worker until the nested tasks are done: once all workers
+  are waiting for nested tasks that are still queued, the pool deadlocks.
+
+  The tasks of map() are still submitted to the pool, but the calling thread
+  runs any task that no worker picked up yet instead of waiting for it
+  (caller-runs work stealing). The calling thread thus only ever waits for
+  tasks that are already running, so nested fan-out can't starve the pool.
+  This also applies to threads outside of the pool (e.g. the rule threads):
+  all the workers may be waiting for the result of the caller (e.g. a
+  singleflight call that it executes) while its tasks are queued.
+  """
+
+  def submit(self, fn, /, *args, **kwargs):
+    # Run the task with the context variables of the submitting thread, e.g.
+    # so that call_audit attributes API calls to the rule that submitted it.
+    return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+  def map(self, fn, *iterables, timeout=None, chunksize=1):
+    del chunksize
+    end_time = None if timeout is None else timeout + time.monotonic()
+    tasks = [_StealableTask(fn, args) for args in zip(*iterables)]
+    for task in tasks:
+      self.submit(task.run)
+
+    def result_iterator():
+      try:
+        for task in tasks:
+          task.run()
+          if end_time is None:
+            yield task.future.result()
+          else:
+            yield task.future.result(end_time - time.monotonic())
+      finally:
+        # make the pool skip the tasks whose results aren't wanted anymore
+        for task in tasks:
+          if task.claim():
+            task.future.cancel()
+
+    return result_iterator()
 
 
 def get_executor() -> concurrent.futures.Executor:
   global _executor
   if _executor is None:
-    _executor = concurrent.futures.ThreadPoolExecutor(
-        max_workers=config.MAX_WORKERS)
+    _executor = NestedThreadPoolExecutor(max_workers=config.MAX_WORKERS)
   return _executor
+
+
+def start_process_executor(max_workers: int):
+  """Start the pool of worker processes used by filter_records().
+
+  The worker processes are spawned (not forked, since many threads are
+  running) right away, so that they are ready by the time rules need them.
+  The pool is kept for subsequent runs."""
+  global _process_executor
+  if _process_executor is None:
+    _process_executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context('spawn'))
+    for _ in range(max_workers):
+      _process_executor.submit(os.getpid)
+
+
+def get_process_executor() -> Optional[concurrent.futures.ProcessPoolExecutor]:
+  return _process_executor
+
+
+def _is_picklable(obj) -> bool:
+  try:
+    pickle.dumps(obj)
+    return True
+  except (pickle.PicklingError, AttributeError, TypeError):
+    return False
+
+
+def _filter_chunk(predicate: Callable, chunk) -> list:
+  if isinstance(chunk, bytes):
+    chunk = caching.load_raw_records(chunk)
+  return [r for r in chunk if predicate(r)]
+
+
+def filter_records(predicate: Callable, records: Sequence) -> List:
+  """Return the records for which predicate(record) is true, in order.
+
+  This is meant for CPU-heavy scanning of many records (e.g. log entries). If
+  the process pool was started (see start_process_executor), the records are
+  checked by chunks in the worker processes. Records stored in a
+  caching.SegmentSequence are passed to the workers as they are stored,
+  without being unpickled first. The predicate must be picklable (e.g. a
+  module-level function, or a functools.partial of one), otherwise the
+  records are checked in the current thread."""
+  pool = _process_executor
+  if (pool is None or len(records) < config.CPU_OFFLOAD_MIN_RECORDS or
+      not _is_picklable(predicate)):
+    return [r for r in records if predicate(r)]
+
+  chunk_size = config.CPU_OFFLOAD_CHUNK_RECORDS
+  # pickled segments of a SegmentSequence, or lists of records.
+  chunks: Iterable[Union[bytes, List]]
+  if isinstance(records, caching.SegmentSequence):
+    chunks = records.raw_chunks(chunk_size)
+  else:
+    chunks = (list(records[i:i + chunk_size])
+              for i in range(0, len(records), chunk_size))
+  futures = [pool.submit(_filter_chunk, predicate, chunk) for chunk in chunks]
+  result = []
+  try:
+    for future in futures:
+      try:
+        result.extend(future.result(deadlines.remaining()))
+      except concurrent.futures.TimeoutError:
+        deadlines.check()
+        raise
+  finally:
+    for future in futures:
+      future.cancel()
+  return result
@@ -0,0 +1,160 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+"""Test code in executor.py."""
+
+import concurrent.futures
+import contextvars
+import functools
+import multiprocessing
+import os
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from gcpdiag import caching, executor
+
+
+def _is_even(record):
+  return record['n'] % 2 == 0
+
+
+def _in_other_process(pid, record):
+  del record
+  return os.getpid() != pid
+
+
+class TestNestedThreadPoolExecutor:
+  """Test NestedThreadPoolExecutor."""
+
+  def test_map_outside_pool(self):
+    with executor.NestedThreadPoolExecutor(max_workers=2) as pool:
+      assert list(pool.map(lambda x: x * 2, range(5))) == [0, 2, 4, 6, 8]
+
+  def test_nested_map_saturated_pool(self):
+    # every worker runs an outer task, which fans out twice more: with a plain
+    # ThreadPoolExecutor all workers would wait for queued nested tasks.
+    with executor.NestedThreadPoolExecutor(max_workers=3) as pool:
+
+      def leaf(x):
+        time.sleep(0.001)
+        return x
+
+      def inner(x):
+        return sum(pool.map(leaf, range(x, x + 5)))
+
+      def outer(x):
+        return sum(pool.map(inner, range(x, x + 5)))
+
+      futures = [pool.submit(outer, i) for i in range(30)]
+      results = [f.result(timeout=30) for f in futures]
+    assert results == [
+        sum(sum(range(y, y + 5)) for y in range(x, x + 5)) for x in range(30)
+    ]
+
+  def test_nested_map_with_blocked_workers(self):
+    # the only other worker is blocked, so the nested tasks can only be
+    # executed by the thread calling map().
+    release = threading.Event()
+    with executor.NestedThreadPoolExecutor(max_workers=2) as pool:
+      blocker = pool.submit(release.wait, 30)
+      outer = pool.submit(lambda: list(pool.map(lambda x: x + 1, range(10))))
+      assert outer.result(timeout=30) == list(range(1, 11))
+      release.set()
+      assert blocker.result(timeout=30)
+
+  def test_map_outside_pool_with_blocked_workers(self):
+    # e.g. all the workers wait for a singleflight call executed by the thread
+    # calling map().
+    release = threading.Event()
+    with executor.NestedThreadPoolExecutor(max_workers=2) as pool:
+      blockers = [pool.submit(release.wait, 30) for _ in range(2)]
+      assert list(pool.map(lambda x: x + 1, range(10))) == list(range(1, 11))
+      release.set()
+      assert all(b.result(timeout=30) for b in blockers)
+
+  def test_nested_map_exception(self):
+
+    def fail_on_three(x):
+      if x == 3:
+        raise ValueError('three')
+      return x
+
+    with executor.NestedThreadPoolExecutor(max_workers=2) as pool:
+      results = []
+
+      def outer():
+        for r in pool.map(fail_on_three, range(5)):
+          results.append(r)
+
+      with pytest.raises(ValueError):
+        pool.submit(outer).result(timeout=30)
+    assert results == [0, 1, 2]
+
+  def test_context_variables(self):
+    var = contextvars.ContextVar('test_var', default=None)
+    var.set('submitter')
+    with executor.NestedThreadPoolExecutor(max_workers=2) as pool:
+      assert pool.submit(var.get).result(timeout=30) == 'submitter'
+      assert list(pool.map(lambda _: var.get(), range(2))) == ['submitter'] * 2
+
+  def test_get_executor(self):
+    assert isinstance(executor.get_executor(),
+                      executor.NestedThreadPoolExecutor)
+
+
+@mock.patch('gcpdiag.config.CPU_OFFLOAD_MIN_RECORDS', 10)
+@mock.patch('gcpdiag.config.CPU_OFFLOAD_CHUNK_RECORDS', 7)
+class TestFilterRecords:
+  """Test executor.filter_records."""
+
+  @pytest.fixture(name='pool')
+  def fixture_pool(self):
+    pool = concurrent.futures.ProcessPoolExecutor(
+        max_workers=2, mp_context=multiprocessing.get_context('spawn'))
+    with mock.patch('gcpdiag.executor._process_executor', pool):
+      yield pool
+    pool.shutdown()
+
+  def test_inline(self):
+    records = [{'n': n} for n in range(100)]
+    assert executor.filter_records(_is_even, records) == records[::2]
+
+  def test_list_in_processes(self, pool):
+    del pool
+    records = [{'n': n} for n in range(100)]
+    assert executor.filter_records(_is_even, records) == records[::2]
+    assert len(
+        executor.filter_records(
+            functools.partial(_in_other_process, os.getpid()), records)) == 100
+
+  def test_segment_sequence_in_processes(self, pool):
+    del pool
+    seq = caching.SegmentStore().new_sequence()
+    seq.extendleft([{'n': n} for n in range(50)])
+    expected = [{'n': n} for n in reversed(range(50)) if n % 2 == 0]
+    assert executor.filter_records(_is_even, seq) == expected
+
+  def test_not_picklable(self, pool):
+    pool.shutdown()
+    records = [{'n': n} for n in range(100)]
+    assert executor.filter_records(lambda r: r['n'] < 3, records) == records[:3]
+
+  def test_few_records(self, pool):
+    pool.shutdown()
+    records = [{'n': n} for n in range(5)]
+    assert executor.filter_records(_is_even, records) == records[::2]
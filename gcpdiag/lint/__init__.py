@@ -21,18 +21,22 @@ import dataclasses
 import enum
 import importlib
 import inspect
+import json
 import logging
 import os
 import pkgutil
 import re
 import sys
+import threading
+import time
 from collections.abc import Callable
 from typing import Any, Dict, Iterable, Iterator, List, Optional
 
 import googleapiclient.errors
 
-from gcpdiag import config, models, utils
-from gcpdiag.executor import get_executor
+from gcpdiag import (caching, call_audit, config, deadlines, models, tracing,
+                     utils)
+from gcpdiag.executor import get_executor, start_process_executor
 from gcpdiag.queries import logs
 
 
@@ -52,6 +56,123 @@ class LintRuleClass(enum.Enum):
     return str(self.value)
 
 
+@dataclasses.dataclass(frozen=True)
+class QueryNode:
+  """A query that lint rules depend on.
+
+  Rules declare the queries that they use in a module-level QUERIES list. The
+  queries of all the rules are executed in parallel before the rules (see
+  QueryScheduler), and every rule is started as soon as its queries are done.
+  The query functions should be cached (with caching.cached_api_call), so that
+  the rules get the results without calling the API again.
+
+  func is called with the context, or with the arguments returned by
+  args_f(context).
+  """
+  func: Callable
+  args_f: Optional[Callable[[models.Context], tuple]] = None
+
+  def args(self, context: models.Context) -> tuple:
+    if self.args_f:
+      return self.args_f(context)
+    return (context,)
+
+  def __str__(self):
+    return f'{self.func.__module__}.{self.func.__qualname__}'
+
+
+def project_id_args(context: models.Context) -> tuple:
+  """QueryNode args_f for query functions that take the project id."""
+  return (context.project_id,)
+
+
+def _submit_after(executor: concurrent.futures.Executor,
+                  futures: Iterable[Optional[concurrent.futures.Future]],
+                  fn: Callable, *args) -> concurrent.futures.Future:
+  """Submit fn(*args) to executor once all futures are done (successfully or
+  not), without blocking any thread, and return the future of fn.
+
+  fn isn't submitted anymore if the returned future is cancelled before."""
+  result: concurrent.futures.Future = concurrent.futures.Future()
+
+  def _copy_result(inner: concurrent.futures.Future):
+    if inner.cancelled():
+      result.set_exception(concurrent.futures.CancelledError())
+    elif inner.exception():
+      result.set_exception(inner.exception())
+    else:
+      result.set_result(inner.result())
+
+  def _start():
+    if not result.set_running_or_notify_cancel():
+      return
+    try:
+      executor.submit(fn, *args).add_done_callback(_copy_result)
+    except RuntimeError as err:
+      # executor shut down
+      result.set_exception(err)
+
+  pending = [f for f in futures if f]
+  if not pending:
+    _start()
+    return result
+  lock = threading.Lock()
+  remaining = [len(pending)]
+
+  def _on_done(_):
+    with lock:
+      remaining[0] -= 1
+      ready = not remaining[0]
+    if ready:
+      _start()
+
+  for f in pending:
+    f.add_done_callback(_on_done)
+  return result
+
+
+class QueryScheduler:
+  """Executes the QueryNode objects of a run.
+
+  Nodes with the same function and arguments are executed only once, and all
+  nodes are submitted to the executor right away, so that they run in
+  parallel.
+  """
+
+  def __init__(self, executor: concurrent.futures.Executor,
+               context: models.Context):
+    self.executor = executor
+    self.context = context
+    self._futures: Dict[bytes, concurrent.futures.Future] = {}
+
+  def _run_node(self, node: QueryNode, args: tuple):
+    try:
+      with tracing.span(str(node), 'query'):
+        node.func(*args)
+    except Exception as err:  # pylint: disable=broad-except
+      # The rules using this query will get the error when they call it.
+      logging.debug('query %s failed: %s', node, err)
+
+  def add(self, node: QueryNode) -> concurrent.futures.Future:
+    """Schedule node and return its future."""
+    args = node.args(self.context)
+    key = caching.call_key(node.func, args)
+    future = self._futures.get(key)
+    if not future:
+      future = self.executor.submit(self._run_node, node, args)
+      self._futures[key] = future
+    return future
+
+  @property
+  def node_count(self) -> int:
+    return len(self._futures)
+
+  def cancel(self):
+    """Cancel the queries that weren't started yet."""
+    for future in self._futures.values():
+      future.cancel()
+
+
 @dataclasses.dataclass
 class LintRule:
   """Identifies a lint rule."""
@@ -64,6 +185,8 @@ class LintRule:
   prepare_rule_f: Optional[Callable] = None
   prefetch_rule_f: Optional[Callable] = None
   prefetch_rule_future: Optional[concurrent.futures.Future] = None
+  queries: List[QueryNode] = dataclasses.field(default_factory=list)
+  cpu_heavy: bool = False
 
   def __hash__(self):
     return str(self.product + self.rule_class.value + self.rule_id).__hash__()
@@ -216,6 +339,67 @@ class LintReportRuleInterface:
                            short_info)
 
 
+class _RuleResultsBuffer:
+  """LintReportRuleInterface replacement that stores the results and log
+  records of a rule, so that rules can run concurrently but still be reported
+  one after the other with flush()."""
+
+  def __init__(self):
+    self._items: List[tuple] = []
+    # deadline of the rule, set when it starts running.
+    self.deadline: Optional[float] = None
+
+  def add_skipped(self,
+                  resource: Optional[models.Resource],
+                  reason: str,
+                  short_info: Optional[str] = None):
+    self._items.append(('add_skipped', (resource, reason, short_info)))
+
+  def add_ok(self, resource: models.Resource, short_info: str = ''):
+    self._items.append(('add_ok', (resource, short_info)))
+
+  def add_failed(self,
+                 resource: models.Resource,
+                 reason: Optional[str] = None,
+                 short_info: Optional[str] = None):
+    self._items.append(('add_failed', (resource, reason, short_info)))
+
+  def has_results(self) -> bool:
+    return bool(self._items)
+
+  def add_log_record(self, record: logging.LogRecord):
+    # the same record is seen by the filter of every handler.
+    if not self._items or self._items[-1][1] is not record:
+      self._items.append(('log', record))
+
+  def flush(self, rule_report: LintReportRuleInterface):
+    for method, args in self._items:
+      if method == 'log':
+        logging.getLogger().handle(args)
+      else:
+        getattr(rule_report, method)(*args)
+    self._items = []
+
+
+# _RuleResultsBuffer of the rule running in the current thread.
+_rule_buffers = threading.local()
+
+# How often to check whether a rule with a deadline started running.
+_RULE_START_POLL_SECONDS = 0.1
+
+
+class _RuleLogFilter(logging.Filter):
+  """Logging filter that holds back the records logged by rules running
+  concurrently, so that they are reported together with the rule results."""
+
+  def filter(self, record):
+    buffer = getattr(_rule_buffers, 'current', None)
+    if buffer is None:
+      return True
+    buffer.add_log_record(record)
+    return False
+
+
 class LintRulesPattern:
   """Filter to include/exclude rules to run.
 
@@ -352,6 +536,12 @@ class LintRuleRepository:
         prefetch_rule_f = f
         break
 
+    # Queries declared by the rule (see QueryNode).
+    queries = list(getattr(module, 'QUERIES', []))
+
+    # Rules that scan many records (see executor.filter_records).
+    cpu_heavy = bool(getattr(module, 'CPU_HEAVY', False))
+
     # Get module docstring.
     doc = inspect.getdoc(module)
     if not doc:
@@ -374,6 +564,8 @@ class LintRuleRepository:
                     run_rule_f=run_rule_f, # function for running rule
                     prepare_rule_f=prepare_rule_f, # function for preparing rule
                     prefetch_rule_f=prefetch_rule_f, # function for prefetching rule
+                    queries=queries, # queries executed before the rule
+                    cpu_heavy=cpu_heavy, # offload record scanning to processes
                     short_desc=short_desc, # starting description
                     long_desc=long_desc) # long description
     return rule
@@ -398,13 +590,70 @@ class LintRuleRepository:
     # Make sure the rules are sorted alphabetically
     self.rules.sort(key=str)
 
-    # Run the "prepare_rule" functions first, in a single thread.
+    # Collect cache statistics only for this run.
+    caching.reset_stats()
+    # API errors are cached only for the duration of a run: e.g. in the
+    # webhook server, a permission granted since the previous run must be
+    # used by the next one.
+    caching.get_negative_cache().clear()
+
+    # Record a timeline of the run with --trace-file.
+    trace_file = config.get('trace_file')
+    if trace_file:
+      tracing.start()
+    # Record the API calls done by run_rule functions with
+    # --run-phase-calls-file (they should be done with QUERIES or in
+    # prefetch_rule instead).
+    run_phase_calls_file = config.get('run_phase_calls_file')
+    if run_phase_calls_file:
+      call_audit.start()
+
+    # Deadline of the whole run: rules that didn't finish by then are reported
+    # as skipped, and pending queries are cancelled.
+    deadlines.set_run_timeout(config.get('run_timeout_seconds'))
+
+    # Rules marked with CPU_HEAVY scan many log entries: with --cpu-workers,
+    # start the worker processes now, so that they are ready when the logs
+    # are fetched.
+    cpu_workers = config.get('cpu_workers')
+    if cpu_workers and any(
+        rule.cpu_heavy for rule in self.list_rules(include, exclude)):
+      start_process_executor(cpu_workers)
+
+    # Start multiple threads for queries, logs fetching and prefetch functions.
+    executor = get_executor()
+
+    # Start the queries declared by the rules right away: they are
+    # deduplicated and executed in parallel.
+    scheduler = QueryScheduler(executor, context)
+    rule_queries = {
+        rule: [scheduler.add(node) for node in rule.queries
+              ] for rule in self.list_rules(include, exclude)
+    }
+    if scheduler.node_count:
+      logging.debug('started %d queries', scheduler.node_count)
+
+    # Run the "prepare_rule" functions in parallel: they mostly wait for the
+    # queries that determine which logs to fetch (e.g. the list of clusters).
+    # The logs queries are started only when all of them are done, because
+    # the logs.query() calls of all rules are grouped in the same jobs.
+    # Like the rules, every prepare_rule function has its own deadline: the
+    # rules whose prepare_rule function didn't finish in time are reported as
+    # skipped, without delaying the other rules more than that.
+    prepare_futures = {}
     for rule in self.list_rules(include, exclude):
       if rule.prepare_rule_f:
-        rule.prepare_rule_f(context)
+        buffer = _RuleResultsBuffer()
+        prepare_futures[rule] = (executor.submit(
+            tracing.traced(self._prepare_rule, str(rule), 'prepare_rule'),
+            rule, rule.prepare_rule_f, context, buffer,
+            deadlines.get_run_deadline()), buffer)
+    prepare_skipped: Dict[LintRule, _RuleResultsBuffer] = {}
+    for rule, (future, buffer) in prepare_futures.items():
+      prepared = self._wait_for_rule(rule, future, buffer)
+      if prepared.has_results():
+        prepare_skipped[rule] = prepared
 
-    # Start multiple threads for logs fetching and prefetch functions.
-    executor = get_executor()
     # Start fetching any logs queries that were defined in prepare_rule
     # functions.
     logs.execute_queries(executor)
@@ -412,41 +661,160 @@ class LintRuleRepository:
     # Run the "prefetch_rule" functions with multiple worker threads to speed up
     # execution of the "run_rule" executions later.
     for rule in self.list_rules(include, exclude):
-      if rule.prefetch_rule_f:
-        rule.prefetch_rule_future = executor.submit(rule.prefetch_rule_f,
-                                                    context)
+      if rule.prefetch_rule_f and rule not in prepare_skipped:
+        rule.prefetch_rule_future = executor.submit(
+            tracing.traced(rule.prefetch_rule_f, str(rule), 'prefetch_rule'),
+            context)
 
     # While the prefetch_rule functions are still being executed in multiple
-    # threads, start executing the rules, but block and wait in case the
-    # prefetch for a specific rule is still running.
-    for rule in self.list_rules(include, exclude):
-      rule_report = report.rule_start(rule, context)
-
-      try:
-        if rule.prefetch_rule_future:
-          if rule.prefetch_rule_future.running():
-            logging.info('waiting for query results')
-          rule.prefetch_rule_future.result()
-
-        rule.run_rule_f(context, rule_report)
-      except (utils.GcpApiError, googleapiclient.errors.HttpError) as err:
-        if isinstance(err, googleapiclient.errors.HttpError):
-          err = utils.GcpApiError(err)
-        logging.warning('%s: %s while processing rule: %s',
-                        type(err).__name__, err, rule)
-        report.add_skipped(rule, context, None, f'API error: {err}', None)
-      except (RuntimeError, ValueError, KeyError) as err:
-        logging.warning('%s: %s while processing rule: %s',
-                        type(err).__name__, err, rule)
-        report.add_skipped(rule, context, None, f'Error: {err}', None)
-      
-      # print(report.rules_report)
-      report.rule_end(rule, context)
+    # threads, start executing the rules concurrently: every rule is started as
+    # soon as its queries and prefetch_rule function are done. The rules use
+    # their own thread pool, so that rules waiting for logs results never
+    # occupy the threads of the executor that those need.
+    # The results (and log messages) of every rule are buffered and reported
+    # in the order of the rules, so that the output is the same as if the
+    # rules were executed one after the other.
+    log_filter = _RuleLogFilter()
+    log_handlers = list(logging.getLogger().handlers)
+    for handler in log_handlers:
+      handler.addFilter(log_filter)
+    # Rules that exceed their deadline (or the run deadline) are reported as
+    # skipped without waiting for them: their thread stops at the next
+    # deadlines.check() done by the query functions.
+    rules_executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=config.MAX_WORKERS)
+    try:
+      rule_futures = []
+      for rule in self.list_rules(include, exclude):
+        buffer = _RuleResultsBuffer()
+        if rule in prepare_skipped:
+          future = concurrent.futures.Future()
+          future.set_result(prepare_skipped[rule])
+          rule_futures.append((rule, future, buffer))
+          continue
+        future = _submit_after(rules_executor,
+                               rule_queries[rule] + [rule.prefetch_rule_future],
+                               self._run_rule, rule, context, buffer)
+        rule_futures.append((rule, future, buffer))
+      for rule, future, buffer in rule_futures:
+        rule_report = report.rule_start(rule, context)
+        if not future.done():
+          logging.info('waiting for rule results')
+        self._wait_for_rule(rule, future, buffer).flush(rule_report)
+        report.rule_end(rule, context)
+    finally:
+      for handler in log_handlers:
+        handler.removeFilter(log_filter)
+      rules_executor.shutdown(wait=False, cancel_futures=True)
+      if deadlines.run_expired():
+        logging.debug('run deadline exceeded, cancelling pending queries')
+        scheduler.cancel()
+        for rule in self.list_rules(include, exclude):
+          if rule.prefetch_rule_future:
+            rule.prefetch_rule_future.cancel()
 
     # print(f"==========================================={report.list_with_rules}")  
+    cache_stats_file = config.get('cache_stats_file')
+    if cache_stats_file:
+      with open(cache_stats_file, 'w', encoding='utf-8') as f:
+        json.dump(caching.get_stats(), f, indent=2)
+      logging.debug('cache statistics written to %s', cache_stats_file)
+
+    if trace_file:
+      tracing.save(trace_file)
+      tracing.stop()
+      logging.debug('trace written to %s', trace_file)
+
+    if run_phase_calls_file:
+      call_audit.save(run_phase_calls_file)
+      call_audit.stop()
+      logging.debug('run phase API calls written to %s', run_phase_calls_file)
+
     data = report.list_with_rules
     return report.finish(context), data
 
+  @staticmethod
+  def _wait_for_rule(rule: LintRule, future: concurrent.futures.Future,
+                     buffer: _RuleResultsBuffer) -> _RuleResultsBuffer:
+    """Wait for the results of a rule until its deadline (or the deadline of
+    the run) and return them, or return a skipped result if it timed out."""
+    rule_timeout = config.get('rule_timeout_seconds')
+    while not future.done():
+      deadline = deadlines.earliest(deadlines.get_run_deadline(),
+                                    buffer.deadline)
+      timeout = None if deadline is None else deadline - time.monotonic()
+      if timeout is not None and timeout <= 0:
+        break
+      if rule_timeout and buffer.deadline is None:
+        # The rule isn't running yet: check again once it is.
+        timeout = min(timeout or _RULE_START_POLL_SECONDS,
+                      _RULE_START_POLL_SECONDS)
+      concurrent.futures.wait([future], timeout)
+    else:
+      return future.result()
+
+    future.cancel()
+    if buffer.deadline is not None and time.monotonic() >= buffer.deadline:
+      reason = 'rule deadline exceeded'
+    else:
+      reason = 'run deadline exceeded'
+    logging.warning('%s while processing rule: %s', reason, rule)
+    timed_out = _RuleResultsBuffer()
+    timed_out.add_skipped(None, f'Timeout: {reason}', None)
+    return timed_out
+
+  @staticmethod
+  def _prepare_rule(rule: LintRule, prepare_rule_f: Callable,
+                    context: models.Context, buffer: _RuleResultsBuffer,
+                    run_deadline: Optional[float]) -> _RuleResultsBuffer:
+    """Run the prepare_rule function of a rule and return buffer, with a
+    skipped result if the function exceeded its deadline."""
+    buffer.deadline = deadlines.after(config.get('rule_timeout_seconds'))
+    try:
+      # The run deadline is captured, so that the function still stops if it
+      # outlives this run.
+      with deadlines.rule_deadline(
+          deadlines.earliest(buffer.deadline, run_deadline)):
+        prepare_rule_f(context)
+    except deadlines.DeadlineExceededError as err:
+      logging.warning('%s while preparing rule: %s', err, rule)
+      buffer.add_skipped(None, f'Timeout: {err}', None)
+    return buffer
+
+  def _run_rule(self, rule: LintRule, context: models.Context,
+                buffer: _RuleResultsBuffer) -> _RuleResultsBuffer:
+    """Run a rule (waiting for its prefetch first) and return its results."""
+    buffer.deadline = deadlines.after(config.get('rule_timeout_seconds'))
+    _rule_buffers.current = buffer
+    try:
+      # The run deadline is captured, so that the rule still stops if it
+      # outlives this run.
+      with deadlines.rule_deadline(
+          deadlines.earliest(buffer.deadline, deadlines.get_run_deadline())):
+        deadlines.check()
+        if rule.prefetch_rule_future:
+          rule.prefetch_rule_future.result()
+
+        with tracing.span(str(rule), 'run_rule'), \
+            call_audit.run_phase(str(rule)):
+          rule.run_rule_f(context, buffer)
+    except deadlines.DeadlineExceededError as err:
+      logging.warning('%s while processing rule: %s', err, rule)
+      buffer.add_skipped(None, f'Timeout: {err}', None)
+    except (utils.GcpApiError, googleapiclient.errors.HttpError) as err:
+      if isinstance(err, googleapiclient.errors.HttpError):
+        err = utils.GcpApiError(err)
+      logging.warning('%s: %s while processing rule: %s',
+                      type(err).__name__, err, rule)
+      buffer.add_skipped(None, f'API error: {err}', None)
+    except (RuntimeError, ValueError, KeyError) as err:
+      logging.warning('%s: %s while processing rule: %s',
+                      type(err).__name__, err, rule)
+      buffer.add_skipped(None, f'Error: {err}', None)
+    finally:
+      _rule_buffers.current = None
+    return buffer
+
   def list_rules(
       self,
       include: Iterable[LintRulesPattern] = None,
@@ -20,6 +20,8 @@ the Apigee Service Agent role on the project.
 from gcpdiag import lint, models
 from gcpdiag.queries import apigee, crm, iam
 
+QUERIES = [lint.QueryNode(iam.get_project_policy, lint.project_id_args)]
+
 SA = 'service-{project_number}@gcp-sa-apigee.iam.gserviceaccount.com'
 ROLE = 'roles/apigee.serviceAgent'
 
@@ -25,7 +25,7 @@ import os
 
 from gcpdiag import config, hooks, lint, models
 from gcpdiag.lint import report_csv, report_json, report_terminal
-from gcpdiag.queries import apis
+from gcpdiag.queries import apis, apis_snapshot
 
 dict_with_vals = {
                   'auth_adc': True, 
@@ -47,6 +47,15 @@ dict_with_vals = {
                   'logging_page_size': None, 
                   'logging_fetch_max_entries': None, 
                   'logging_fetch_max_time_seconds': None, 
+                  'run_timeout_seconds': None,
+                  'rule_timeout_seconds': None,
+                  'cpu_workers': None,
+                  'cache_serve_stale': None,
+                  'cache_stats_file': None,
+                  'trace_file': None,
+                  'run_phase_calls_file': None,
+                  'snapshot_record': None,
+                  'snapshot_replay': None,
                   'output': 'json'
                   }
 
@@ -176,6 +185,67 @@ def _init_args_parser():
       help=('Configure timeout for logging queries (default:'
             f" {config.get('logging_fetch_max_time_seconds')} seconds)"))
 
+  parser.add_argument(
+      '--run-timeout-seconds',
+      metavar='S',
+      type=float,
+      help=('Report the rules that didn\'t finish S seconds after the start of '
+            'the run as skipped (default: no limit)'))
+
+  parser.add_argument(
+      '--rule-timeout-seconds',
+      metavar='S',
+      type=float,
+      help=('Report the rules that run for more than S seconds as skipped '
+            '(default: no limit)'))
+
+  parser.add_argument(
+      '--cpu-workers',
+      metavar='N',
+      type=int,
+      help=('Scan log entries in N worker processes for rules that process '
+            'many log entries (default: scan in the rule thread)'))
+
+  parser.add_argument(
+      '--cache-serve-stale',
+      help=('Use cached resources up to one hour old and refresh them in the '
+            'background, instead of fetching them again after one minute'),
+      action='store_true')
+
+  parser.add_argument(
+      '--cache-stats-file',
+      metavar='FILE',
+      type=str,
+      help=('Write API cache statistics (hits, misses, latencies per query '
+            'function) as JSON to FILE'))
+
+  parser.add_argument(
+      '--trace-file',
+      metavar='FILE',
+      type=str,
+      help=('Write a timeline of the run (rules, queries, logs jobs, API calls, '
+            'cache lock waits) as Chrome trace-event JSON to FILE'))
+
+  parser.add_argument(
+      '--run-phase-calls-file',
+      metavar='FILE',
+      type=str,
+      help=('Write the cache misses and API requests done by the run_rule '
+            'functions, with their stack locations, as JSON to FILE'))
+
+  parser.add_argument(
+      '--snapshot-record',
+      metavar='FILE',
+      type=str,
+      help='Record all API responses of this run to the snapshot FILE')
+
+  parser.add_argument(
+      '--snapshot-replay',
+      metavar='FILE',
+      type=str,
+      help=('Answer all API requests from the snapshot FILE (recorded with '
+            '--snapshot-record), without any network access'))
+
   parser.add_argument(
       '--output',
       metavar='FORMATTER',
@@ -293,15 +363,33 @@ def run(project) -> int:
   report.banner()
   report.lint_start(context)
 
-  # Verify that we have access and that the CRM API is enabled
-  apis.verify_access(context.project_id)
-
-  # Run the tests.
-  exit_code, data = repo.run_rules(context, report, include_patterns,
-                             exclude_patterns) # context (Class with project name)
-                                               # report output_formatter (json class)
-                                               # repo (storage of rules)
-  # hooks.post_lint_hook(report)
+  # Record or replay a snapshot of all API responses.
+  if config.get('snapshot_record') and config.get('snapshot_replay'):
+    logger.error('--snapshot-record and --snapshot-replay are mutually exclusive')
+    sys.exit(1)
+  # The snapshot mode is process-wide: it must be stopped even if the run
+  # fails (e.g. with SnapshotMissError), so that later runs of the same
+  # process (e.g. in the webhook server) use the API again.
+  try:
+    if config.get('snapshot_record'):
+      apis_snapshot.start_recording()
+    elif config.get('snapshot_replay'):
+      apis_snapshot.start_replay(config.get('snapshot_replay'))
+
+    # Verify that we have access and that the CRM API is enabled
+    apis.verify_access(context.project_id)
+
+    # Run the tests.
+    exit_code, data = repo.run_rules(context, report, include_patterns,
+                               exclude_patterns) # context (Class with project name)
+                                                 # report output_formatter (json class)
+                                                 # repo (storage of rules)
+    # hooks.post_lint_hook(report)
+
+    if config.get('snapshot_record'):
+      apis_snapshot.save(config.get('snapshot_record'))
+  finally:
+    apis_snapshot.stop()
 
   # Exit 0 if there are no failed rules.
   return data
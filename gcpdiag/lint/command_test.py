@@ -13,8 +13,16 @@
 # limitations under the License.
 """Test code in command.py."""
 
-from gcpdiag import lint
+import gzip
+import json
+import logging
+from unittest import mock
+
+import pytest
+
+from gcpdiag import config, lint
 from gcpdiag.lint import command
+from gcpdiag.queries import apis_snapshot
 
 
 class Test:
@@ -51,6 +59,15 @@ class Test:
     assert args.logging_page_size is None
     assert args.logging_fetch_max_entries is None
     assert args.logging_fetch_max_time_seconds is None
+    assert args.run_timeout_seconds is None
+    assert args.rule_timeout_seconds is None
+    assert args.cpu_workers is None
+    assert args.cache_serve_stale is False
+    assert args.cache_stats_file is None
+    assert args.trace_file is None
+    assert args.run_phase_calls_file is None
+    assert args.snapshot_record is None
+    assert args.snapshot_replay is None
     assert args.output == 'terminal'
 
   # pylint: disable=protected-access
@@ -83,3 +100,27 @@ class Test:
     assert 'gcs' in modules
     assert 'vpc' in modules
     assert 'gcf' in modules
+
+  def test_run_stops_snapshot_replay_on_error(self, tmp_path):
+    snapshot = tmp_path / 'snapshot.json.gz'
+    with gzip.open(snapshot, 'wt', encoding='utf-8') as f:
+      json.dump(
+          {
+              'version': apis_snapshot.SNAPSHOT_FORMAT_VERSION,
+              'responses': {}
+          }, f)
+    logger = logging.getLogger()
+    handlers, level = logger.handlers, logger.level
+    try:
+      with mock.patch.dict(command.dict_with_vals,
+                           {'snapshot_replay': str(snapshot)}), \
+          mock.patch.object(config, '_args', {}), \
+          mock.patch('gcpdiag.queries.apis.verify_access',
+                     side_effect=apis_snapshot.SnapshotMissError('GET x')), \
+          pytest.raises(apis_snapshot.SnapshotMissError):
+        command.run('p1')
+    finally:
+      logger.handlers = handlers
+      logger.setLevel(level)
+    # later runs of the process use the API again.
+    assert not apis_snapshot.is_replaying()
@@ -20,6 +20,8 @@ Agent role on the project.
 from gcpdiag import lint, models
 from gcpdiag.queries import crm, dataproc, iam
 
+QUERIES = [lint.QueryNode(iam.get_project_policy, lint.project_id_args)]
+
 ROLE = 'roles/dataproc.serviceAgent'
 ALT_ROLE = 'roles/editor'
 
@@ -35,6 +35,7 @@ SECURE_BOOT_ERR_MESSAGES = [
     'Verification failed: (0x1A) Security Violation',
 ]
 
+CPU_HEAVY = True
 logs_by_project = {}
 
 
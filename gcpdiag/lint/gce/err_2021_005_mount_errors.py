@@ -32,6 +32,7 @@ MOUNT_ERROR_MESSAGES = [
     'Unrecognized mount option',
 ]
 
+CPU_HEAVY = True
 logs_by_project = {}
 
 
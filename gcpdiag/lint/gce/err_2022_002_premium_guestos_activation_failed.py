@@ -36,6 +36,7 @@ GUEST_OS_ACTIVATION_ERR_MESSAGES = [
     'Exiting without registration'  # SLES
 ]
 
+CPU_HEAVY = True
 logs_by_project = {}
 
 
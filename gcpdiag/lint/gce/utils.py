@@ -16,12 +16,13 @@
 """Various utility functions for GCE linters."""
 
 import datetime
+import functools
 import re
-from typing import Dict, Iterable, Optional
+from typing import Dict, Iterable, Optional, Tuple
 
 from boltons.iterutils import get_path
 
-from gcpdiag import models
+from gcpdiag import executor, models
 from gcpdiag.queries import logs
 
 
@@ -47,6 +48,14 @@ class LogEntryShort:
     return self._timestamp.astimezone().isoformat(sep=' ', timespec='seconds')
 
 
+def _serial_output_matches(search_strings: Tuple[str, ...], raw_entry) -> bool:
+  if not get_path(raw_entry, ('resource', 'labels', 'instance_id'),
+                  default=None):
+    return False
+  text = get_path(raw_entry, ('textPayload',), default='')
+  return any(f in text for f in search_strings)
+
+
 class SerialOutputSearch:
   """ Search any of strings in instance's serial output """
 
@@ -71,16 +80,12 @@ class SerialOutputSearch:
 
   def get_last_match(self, instance_id: str) -> Optional[LogEntryShort]:
     if not self.search_is_done:
-      for raw_entry in self.query.entries:
-        entry_id = get_path(raw_entry, ('resource', 'labels', 'instance_id'),
-                            default=None)
-
-        if not entry_id:
-          continue
-        entry = LogEntryShort(raw_entry)
-
-        if any(f in entry.text for f in self.search_strings):
-          self.instances_with_match[entry_id] = entry
+      matches = executor.filter_records(
+          functools.partial(_serial_output_matches, tuple(self.search_strings)),
+          self.query.entries)
+      for raw_entry in matches:
+        entry_id = get_path(raw_entry, ('resource', 'labels', 'instance_id'))
+        self.instances_with_match[entry_id] = LogEntryShort(raw_entry)
 
       self.search_is_done = True
 
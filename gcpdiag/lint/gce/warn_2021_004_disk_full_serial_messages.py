@@ -31,6 +31,7 @@ NO_SPACE_LEFT_MESSAGES = [
     'No usable temporary directory found'
 ]
 
+CPU_HEAVY = True
 logs_by_project = {}
 
 
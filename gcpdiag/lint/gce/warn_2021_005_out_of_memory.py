@@ -33,6 +33,7 @@ OOM_MESSAGES = [
     'Memory cgroup out of memory'
 ]
 
+CPU_HEAVY = True
 logs_by_project = {}
 
 
@@ -28,6 +28,7 @@ PANIC_MESSAGES = [
     'Kernel panic',  #
 ]
 
+CPU_HEAVY = True
 logs_by_project = {}
 
 
@@ -30,6 +30,7 @@ PANIC_MESSAGES = [
     'pvpanic.sys'
 ]
 
+CPU_HEAVY = True
 logs_by_project = {}
 
 
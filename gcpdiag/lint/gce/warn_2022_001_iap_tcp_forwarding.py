@@ -22,6 +22,8 @@ import ipaddress
 from gcpdiag import lint, models
 from gcpdiag.queries import gce
 
+QUERIES = [lint.QueryNode(gce.get_instances)]
+
 VERIFY_PORTS = {  #
     'ssh': 22,
     'rdp': 3389
@@ -27,6 +27,8 @@ from gcpdiag import lint, models
 from gcpdiag.lint.gce import utils
 from gcpdiag.queries import apis, gce, network
 
+QUERIES = [lint.QueryNode(gce.get_instances)]
+
 DOCKER_BRIDGE_NETWORK = ipaddress.ip_network('172.17.0.0/16')
 
 
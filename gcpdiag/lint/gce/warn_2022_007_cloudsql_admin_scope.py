@@ -26,6 +26,8 @@ from gcpdiag import lint, models
 from gcpdiag.lint.gce import utils
 from gcpdiag.queries import apis, gce, iam, network
 
+QUERIES = [lint.QueryNode(gce.get_instances)]
+
 ROLE = 'roles/cloudsql.client'
 CLOUDSQL_ADMIN_SCOPES = [
     'https://www.googleapis.com/auth/cloud-platform',
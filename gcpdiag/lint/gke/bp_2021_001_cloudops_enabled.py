@@ -20,6 +20,8 @@ ability to troubleshoot any issues that you might have.
 from gcpdiag import lint, models
 from gcpdiag.queries import gke
 
+QUERIES = [lint.QueryNode(gke.get_clusters)]
+
 
 def run_rule(context: models.Context, report: lint.LintReportRuleInterface):
   clusters = gke.get_clusters(context)
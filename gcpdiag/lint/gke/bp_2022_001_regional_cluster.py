@@ -21,6 +21,8 @@ recommended to use regional clusters for the production workload.
 from gcpdiag import lint, models
 from gcpdiag.queries import gke
 
+QUERIES = [lint.QueryNode(gke.get_clusters)]
+
 
 def run_rule(context: models.Context, report: lint.LintReportRuleInterface):
   clusters = gke.get_clusters(context)
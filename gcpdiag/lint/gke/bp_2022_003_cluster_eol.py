@@ -23,6 +23,8 @@ from datetime import datetime, timedelta
 from gcpdiag import lint, models
 from gcpdiag.queries import gke
 
+QUERIES = [lint.QueryNode(gke.get_clusters)]
+
 # this should be updated regularly from:
 # https://cloud.google.com/kubernetes-engine/docs/release-schedule#schedule_for_static_no_channel_versions
 EOL_SCHEDULE = {
@@ -9,6 +9,8 @@ will be stuck in the deleting state.
 from gcpdiag import lint, models
 from gcpdiag.queries import gke
 
+QUERIES = [lint.QueryNode(gke.get_clusters)]
+
 
 def run_rule(context: models.Context, report: lint.LintReportRuleInterface):
   clusters = gke.get_clusters(context)
@@ -20,6 +20,11 @@ role, otherwise ingestion of metrics won't work.
 from gcpdiag import lint, models
 from gcpdiag.queries import gke, iam
 
+QUERIES = [
+    lint.QueryNode(gke.get_clusters),
+    lint.QueryNode(iam.get_project_policy, lint.project_id_args),
+]
+
 ROLE = 'roles/monitoring.metricWriter'
 
 
@@ -20,6 +20,8 @@ for application-level secrets encryption.
 from gcpdiag import lint, models
 from gcpdiag.queries import gke, kms
 
+QUERIES = [lint.QueryNode(gke.get_clusters)]
+
 
 def run_rule(context: models.Context, report: lint.LintReportRuleInterface):
   clusters = gke.get_clusters(context)
@@ -23,6 +23,7 @@ from gcpdiag.lint.gke import util
 from gcpdiag.queries import apis, gke, logs
 
 MATCH_STR = 'Failed to connect to apiserver'
+CPU_HEAVY = True
 logs_by_project = {}
 
 
@@ -36,6 +37,13 @@ def prepare_rule(context: models.Context):
         filter_str=f'jsonPayload.MESSAGE:"{MATCH_STR}"')
 
 
+def filter_f(log_entry):
+  try:
+    return MATCH_STR in log_entry['jsonPayload']['MESSAGE']
+  except KeyError:
+    return False
+
+
 def run_rule(context: models.Context, report: lint.LintReportRuleInterface):
   # skip entire rule is logging disabled
   if not apis.is_enabled(context.project_id, 'logging'):
@@ -47,13 +55,6 @@ def run_rule(context: models.Context, report: lint.LintReportRuleInterface):
   if not clusters:
     report.add_skipped(None, 'no clusters found')
 
-  # Search the logs.
-  def filter_f(log_entry):
-    try:
-      return MATCH_STR in log_entry['jsonPayload']['MESSAGE']
-    except KeyError:
-      return False
-
   bad_nodes_by_cluster = util.gke_logs_find_bad_nodes(
       context=context, logs_by_project=logs_by_project, filter_f=filter_f)
 
@@ -19,6 +19,11 @@ the Kubernetes Engine Service Agent role on the project.
 from gcpdiag import lint, models
 from gcpdiag.queries import crm, gke, iam
 
+QUERIES = [
+    lint.QueryNode(gke.get_clusters),
+    lint.QueryNode(iam.get_project_policy, lint.project_id_args),
+]
+
 # defining role
 ROLE = 'roles/container.serviceAgent'
 
@@ -20,6 +20,8 @@ than 2 minor versions.
 from gcpdiag import lint, models
 from gcpdiag.queries import gke
 
+QUERIES = [lint.QueryNode(gke.get_clusters)]
+
 fail_reason_template = (
     "Difference between versions of the node pool ({np_ver}) and cluster ({c_ver}) is"
     " more than two minor versions")
@@ -22,6 +22,7 @@ from gcpdiag.queries import apis, gke, logs
 
 MATCH_STR_1 = 'INTERNAL_FORWARDING_RULES_WITH_PEERING_LIMITS_EXCEEDED'
 MATCH_STR_2 = 'SyncLoadBalancerFailed'
+CPU_HEAVY = True
 logs_by_project = {}
 
 
@@ -35,6 +36,15 @@ def prepare_rule(context: models.Context):
   )
 
 
+def filter_f(log_entry):
+  try:
+    if (MATCH_STR_1 in log_entry['jsonPayload']['message']) and (
+        MATCH_STR_2 in log_entry['jsonPayload']['reason']):
+      return True
+  except KeyError:
+    return False
+
+
 def run_rule(context: models.Context, report: lint.LintReportRuleInterface):
   # skip entire rule is logging disabled
   if not apis.is_enabled(context.project_id, 'logging'):
@@ -46,15 +56,6 @@ def run_rule(context: models.Context, report: lint.LintReportRuleInterface):
   if not clusters:
     report.add_skipped(None, 'no clusters found')
 
-    # Search the logs.
-  def filter_f(log_entry):
-    try:
-      if (MATCH_STR_1 in log_entry['jsonPayload']['message']) and (
-          MATCH_STR_2 in log_entry['jsonPayload']['reason']):
-        return True
-    except KeyError:
-      return False
-
   bad_clusters = util.gke_logs_find_bad_clusters(
       context=context, logs_by_project=logs_by_project, filter_f=filter_f)
 
@@ -24,6 +24,7 @@ from gcpdiag.lint.gke import util
 from gcpdiag.queries import apis, gke, logs
 
 IP_MASQ_AGENT_CONTAINER_NAME = 'ip-masq-agent'
+CPU_HEAVY = True
 
 # k8s_container
 ip_masq_container_errors = {}
@@ -38,6 +39,16 @@ def prepare_rule(context: models.Context):
       f'resource.labels.container_name="{IP_MASQ_AGENT_CONTAINER_NAME}"')
 
 
+def filter_f(log_entry):
+  try:
+    container_name = log_entry['resource']['labels']['container_name']
+    if (log_entry['severity'] == 'ERROR' and
+        container_name == IP_MASQ_AGENT_CONTAINER_NAME):
+      return True
+  except KeyError:
+    return False
+
+
 def run_rule(context: models.Context, report: lint.LintReportRuleInterface):
   # skip entire rule is logging disabled
   if not apis.is_enabled(context.project_id, 'logging'):
@@ -48,15 +59,6 @@ def run_rule(context: models.Context, report: lint.LintReportRuleInterface):
   if not clusters:
     report.add_skipped(None, 'no clusters found')
 
-  def filter_f(log_entry):
-    try:
-      container_name = log_entry['resource']['labels']['container_name']
-      if (log_entry['severity'] == 'ERROR' and
-          container_name == IP_MASQ_AGENT_CONTAINER_NAME):
-        return True
-    except KeyError:
-      return False
-
   clusters_with_errors = util.gke_logs_find_bad_clusters(
       context=context,
       logs_by_project=ip_masq_container_errors,
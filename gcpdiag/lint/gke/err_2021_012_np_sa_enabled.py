@@ -21,6 +21,8 @@ service account that was specified when the node pool was created.
 from gcpdiag import lint, models
 from gcpdiag.queries import gke, iam
 
+QUERIES = [lint.QueryNode(gke.get_clusters)]
+
 
 def run_rule(context: models.Context, report: lint.LintReportRuleInterface):
   # Find all clusters.
@@ -26,6 +26,8 @@ are present.
 from gcpdiag import lint, models
 from gcpdiag.queries import gke
 
+QUERIES = [lint.QueryNode(gke.get_clusters)]
+
 
 def _run_rule_cluster(report: lint.LintReportRuleInterface, c: gke.Cluster):
   try:
@@ -19,6 +19,8 @@ Masters must be allowed to reach the nodes via tcp:443 and tcp10250.
 from gcpdiag import lint, models
 from gcpdiag.queries import gke
 
+QUERIES = [lint.QueryNode(gke.get_clusters)]
+
 
 def _run_rule_cluster(report: lint.LintReportRuleInterface, c: gke.Cluster):
   network = c.network
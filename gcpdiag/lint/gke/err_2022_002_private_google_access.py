@@ -19,6 +19,8 @@ cluster is deployed.
 from gcpdiag import lint, models
 from gcpdiag.queries import gke, network
 
+QUERIES = [lint.QueryNode(gke.get_clusters)]
+
 
 def run_rule(context: models.Context, report: lint.LintReportRuleInterface):
   clusters = gke.get_clusters(context)
@@ -22,6 +22,8 @@ from gcpdiag import lint, models
 from gcpdiag.queries import gke
 from gcpdiag.queries.network import VpcFirewallRule
 
+QUERIES = [lint.QueryNode(gke.get_clusters)]
+
 FIREWALL_RULE_NAME_PATTERN = re.compile(r'k8s-fw-l7-.*')
 
 
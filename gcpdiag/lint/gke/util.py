@@ -19,7 +19,7 @@ import collections
 import logging
 from typing import Any, Callable, Dict, Set, Tuple
 
-from gcpdiag import models
+from gcpdiag import executor, models
 from gcpdiag.queries import gce, gke, logs
 
 
@@ -125,12 +125,9 @@ def gke_logs_find_bad_nodes(context: models.Context,
   # Process the log entries.
   bad_nodes_by_cluster = collections.defaultdict(set)
   for query in logs_by_project.values():
-    for log_entry in query.entries:
-      # Retrieved logs are not guaranteed to only contain what we defined as
-      # "filter_str", so we need to filter out what isn't ours.
-      if not filter_f(log_entry):
-        continue
-
+    # Retrieved logs are not guaranteed to only contain what we defined as
+    # "filter_str", so we need to filter out what isn't ours.
+    for log_entry in executor.filter_records(filter_f, query.entries):
       try:
         (c, node_name) = _gke_node_of_log_entry(context, log_entry)
         bad_nodes_by_cluster[c].add(node_name)
@@ -152,12 +149,9 @@ def gke_logs_find_bad_clusters(context: models.Context,
   # Process the log entries.
   bad_clusters = {}
   for query in logs_by_project.values():
-    for log_entry in query.entries:
-      # Retrieved logs are not guaranteed to only contain what we defined as
-      # "filter_str", so we need to filter out what isn't ours.
-      if not filter_f(log_entry):
-        continue
-
+    # Retrieved logs are not guaranteed to only contain what we defined as
+    # "filter_str", so we need to filter out what isn't ours.
+    for log_entry in executor.filter_records(filter_f, query.entries):
       try:
         c = _gke_cluster_of_log_entry(context, log_entry)
         if c in bad_clusters:
@@ -25,6 +25,8 @@ CIDR.
 from gcpdiag import lint, models
 from gcpdiag.queries import gke
 
+QUERIES = [lint.QueryNode(gke.get_clusters)]
+
 #test will fail if node usage is above FAIL_THRSHOLD of the max allowed by the pod CIDR.
 FAIL_THRESHOLD_RATIO = .9
 
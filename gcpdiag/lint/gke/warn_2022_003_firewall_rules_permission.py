@@ -21,6 +21,8 @@ in the current or host project with Shared VPC.
 from gcpdiag import lint, models
 from gcpdiag.queries import crm, gke, iam
 
+QUERIES = [lint.QueryNode(gke.get_clusters)]
+
 # defining permissions
 PERMISSIONS = [
     'compute.firewalls.create',
@@ -20,6 +20,8 @@ and Node logs won't be ingested, and thus, won't be visible in Logs Explorer.
 from gcpdiag import lint, models
 from gcpdiag.queries import apis, gke
 
+QUERIES = [lint.QueryNode(gke.get_clusters)]
+
 
 def run_rule(context: models.Context, report: lint.LintReportRuleInterface):
   clusters = gke.get_clusters(context)
@@ -22,6 +22,8 @@ or `401 Unauthorized` if they cannot pull from a private repositories.
 from gcpdiag import lint, models
 from gcpdiag.queries import gke
 
+QUERIES = [lint.QueryNode(gke.get_clusters)]
+
 required_storage_scope = [
     'https://www.googleapis.com/auth/devstorage.read_only',
     'https://www.googleapis.com/auth/devstorage.read_write',
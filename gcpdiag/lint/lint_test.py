@@ -0,0 +1,407 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Test code in lint/__init__.py."""
+
+import concurrent.futures
+import io
+import json
+import logging
+import threading
+import time
+from unittest import mock
+
+from gcpdiag import caching, config, deadlines, lint, models, tracing
+from gcpdiag.lint import report_terminal
+
+
+class FakeResource(models.Resource):
+
+  def __init__(self, name):
+    super().__init__(project_id='p1')
+    self.name = name
+
+  @property
+  def full_path(self) -> str:
+    return f'projects/p1/fakes/{self.name}'
+
+
+def _make_rule(rule_id, run_rule_f):
+  return lint.LintRule(product='fake',
+                       rule_class=lint.LintRuleClass.WARN,
+                       rule_id=rule_id,
+                       short_desc=f'rule {rule_id}',
+                       long_desc=f'long description of rule {rule_id}',
+                       run_rule_f=run_rule_f)
+
+
+class TestRunRules:
+  """Test LintRuleRepository.run_rules."""
+
+  def test_concurrent_rules_reported_in_order(self):
+    second_rule_done = threading.Event()
+
+    def run_first(context, report):
+      del context
+      # the second rule runs (and finishes) while this one is still running
+      assert second_rule_done.wait(10)
+      logging.warning('first rule warning')
+      report.add_failed(FakeResource('r1'), 'broken')
+
+    def run_second(context, report):
+      del context
+      logging.warning('second rule warning')
+      report.add_ok(FakeResource('r2'))
+      second_rule_done.set()
+
+    def run_third(context, report):
+      del context, report
+      raise RuntimeError('third rule error')
+
+    repo = lint.LintRuleRepository()
+    for rule in [
+        _make_rule('2022_003', run_third),
+        _make_rule('2022_001', run_first),
+        _make_rule('2022_002', run_second)
+    ]:
+      repo.register_rule(rule)
+    output = io.StringIO()
+    report = report_terminal.LintReportTerminal(file=output, show_skipped=True)
+    logger = logging.getLogger()
+    handler = report.get_logging_handler()
+    logger.addHandler(handler)
+    try:
+      exit_code, _ = repo.run_rules(models.Context(project_id='p1'), report)
+    finally:
+      logger.removeHandler(handler)
+    assert exit_code == 2
+    lines = [l for l in output.getvalue().splitlines() if l.strip()]
+    assert [
+        l for l in lines if l.startswith(('*', '[WARNING] f', '[WARNING] s'))
+    ] == [
+        '*  fake/WARN/2022_001: rule 2022_001',
+        '[WARNING] first rule warning ',
+        '*  fake/WARN/2022_002: rule 2022_002',
+        '[WARNING] second rule warning ',
+        '*  fake/WARN/2022_003: rule 2022_003',
+    ]
+    assert any('third rule error' in l for l in lines)
+
+  def test_trace_file(self, tmp_path):
+
+    def query(context):
+      del context
+
+    def run_rule(context, report):
+      del context
+      report.add_ok(FakeResource('r1'))
+
+    repo = lint.LintRuleRepository()
+    rule = _make_rule('2022_001', run_rule)
+    rule.prepare_rule_f = lambda context: None
+    rule.prefetch_rule_f = lambda context: None
+    rule.queries.append(lint.QueryNode(query))
+    repo.register_rule(rule)
+    trace_file = tmp_path / 'trace.json'
+    report = report_terminal.LintReportTerminal(file=io.StringIO())
+    with mock.patch.dict(config._defaults, {'trace_file': str(trace_file)}):
+      repo.run_rules(models.Context(project_id='p1'), report)
+    assert not tracing.is_enabled()
+    events = json.loads(trace_file.read_text())['traceEvents']
+    spans = {(e['cat'], e['name']) for e in events if e['ph'] == 'X'}
+    assert spans == {('query', f'{__name__}.{query.__qualname__}'),
+                     ('prepare_rule', str(rule)), ('prefetch_rule', str(rule)),
+                     ('run_rule', str(rule))}
+
+  def test_prepare_rules_in_parallel(self):
+    # every prepare_rule function waits until all of them are started
+    barrier = threading.Barrier(3, timeout=10)
+
+    def prepare_rule(context):
+      del context
+      barrier.wait()
+
+    def run_rule(context, report):
+      del context
+      report.add_ok(FakeResource('r1'))
+
+    repo = lint.LintRuleRepository()
+    for rule_id in ['2022_001', '2022_002', '2022_003']:
+      rule = _make_rule(rule_id, run_rule)
+      rule.prepare_rule_f = prepare_rule
+      repo.register_rule(rule)
+    report = report_terminal.LintReportTerminal(file=io.StringIO())
+    exit_code, _ = repo.run_rules(models.Context(project_id='p1'), report)
+    assert exit_code == 0
+
+  def test_run_phase_calls_file(self, tmp_path):
+
+    @caching.cached_api_call(in_memory=True)
+    def prefetched_query(context):
+      del context
+
+    @caching.cached_api_call(in_memory=True)
+    def run_phase_query(context):
+      del context
+
+    def run_rule(context, report):
+      prefetched_query(context)
+      run_phase_query(context)
+      report.add_ok(FakeResource('r1'))
+
+    repo = lint.LintRuleRepository()
+    rule = _make_rule('2022_001', run_rule)
+    rule.queries.append(lint.QueryNode(prefetched_query))
+    repo.register_rule(rule)
+    calls_file = tmp_path / 'calls.json'
+    report = report_terminal.LintReportTerminal(file=io.StringIO())
+    with mock.patch.dict(config._defaults,
+                         {'run_phase_calls_file': str(calls_file)}):
+      repo.run_rules(models.Context(project_id='p1'), report)
+    calls = json.loads(calls_file.read_text())
+    (call,) = calls[str(rule)]
+    assert call['kind'] == 'cache miss'
+    assert call['name'].endswith('.run_phase_query')
+    assert call['stack'][-1].endswith(' in run_rule')
+
+  def test_negative_cache_cleared(self):
+    caching.get_negative_cache().set(b'key',
+                                     RuntimeError('denied'),
+                                     1,
+                                     expire=300)
+
+    def run_rule(context, report):
+      del context
+      assert caching.get_negative_cache().get(b'key') is None
+      report.add_ok(FakeResource('r1'))
+
+    repo = lint.LintRuleRepository()
+    repo.register_rule(_make_rule('2022_001', run_rule))
+    report = report_terminal.LintReportTerminal(file=io.StringIO())
+    exit_code, _ = repo.run_rules(models.Context(project_id='p1'), report)
+    assert exit_code == 0
+
+
+class TestQueryScheduler:
+  """Test lint.QueryScheduler."""
+
+  def test_deduplication(self):
+    calls = []
+    lock = threading.Lock()
+
+    def query_a(context):
+      with lock:
+        calls.append(('a', context.project_id))
+
+    def query_b(project_id):
+      with lock:
+        calls.append(('b', project_id))
+
+    node_a = lint.QueryNode(query_a)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+      scheduler = lint.QueryScheduler(executor, models.Context(project_id='p1'))
+      futures = [
+          scheduler.add(lint.QueryNode(query_b, lint.project_id_args)),
+          scheduler.add(lint.QueryNode(query_a)),
+          scheduler.add(node_a)
+      ]
+      concurrent.futures.wait(futures)
+    # query_a is executed only once
+    assert sorted(calls) == [('a', 'p1'), ('b', 'p1')]
+    assert scheduler.node_count == 2
+
+  def test_failed_query(self):
+
+    def failing_query(context):
+      del context
+      raise RuntimeError('failed')
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+      scheduler = lint.QueryScheduler(executor, models.Context(project_id='p1'))
+      # the error is raised again when the rule calls the query.
+      assert scheduler.add(lint.QueryNode(failing_query)).result() is None
+
+  def test_rule_started_after_queries(self):
+    done = []
+
+    def slow_query(context):
+      del context
+      time.sleep(0.1)
+      done.append('query')
+
+    def run_rule(context, report):
+      del context
+      assert done == ['query']
+      report.add_ok(FakeResource('r1'))
+
+    repo = lint.LintRuleRepository()
+    rule = _make_rule('2022_001', run_rule)
+    rule.queries.append(lint.QueryNode(slow_query))
+    repo.register_rule(rule)
+    report = report_terminal.LintReportTerminal(file=io.StringIO())
+    exit_code, _ = repo.run_rules(models.Context(project_id='p1'), report)
+    assert exit_code == 0
+    assert report.rules_report[rule]['overall_status'] == 'ok'
+
+
+class TestDeadlines:
+  """Test the rule and run deadlines of LintRuleRepository.run_rules."""
+
+  def setup_method(self):
+    self.release = threading.Event()
+
+  def teardown_method(self):
+    self.release.set()
+    deadlines.set_run_timeout(None)
+
+  def _run(self, rules):
+    repo = lint.LintRuleRepository()
+    for rule in rules:
+      repo.register_rule(rule)
+    output = io.StringIO()
+    report = report_terminal.LintReportTerminal(file=output, show_skipped=True)
+    start_time = time.monotonic()
+    repo.run_rules(models.Context(project_id='p1'), report)
+    return report, output.getvalue(), time.monotonic() - start_time
+
+  def run_cooperative(self, context, report):
+    del context, report
+    while True:
+      deadlines.check()
+      time.sleep(0.01)
+
+  def run_blocking(self, context, report):
+    del context, report
+    self.release.wait(30)
+
+  def run_ok(self, context, report):
+    del context
+    report.add_ok(FakeResource('r1'))
+
+  @mock.patch.dict(config._defaults, {'rule_timeout_seconds': 0.2})
+  def test_rule_timeout(self):
+    rules = [
+        _make_rule('2022_001', self.run_cooperative),
+        _make_rule('2022_002', self.run_blocking),
+        _make_rule('2022_003', self.run_ok)
+    ]
+    report, output, run_time = self._run(rules)
+    assert run_time < 10
+    assert [report.rules_report[r]['overall_status'] for r in rules
+           ] == ['skipped', 'skipped', 'ok']
+    assert output.count('Timeout: rule deadline exceeded') == 2
+
+  @mock.patch.dict(config._defaults, {'rule_timeout_seconds': 1})
+  def test_rule_timeout_shared_query(self):
+    calls = []
+
+    @caching.cached_api_call(in_memory=True)
+    def shared_query(context):
+      del context
+      calls.append(1)
+      # the first call only stops at the deadline of its rule.
+      while len(calls) == 1:
+        deadlines.check()
+        time.sleep(0.01)
+
+    def delay_query(context):
+      del context
+      time.sleep(0.5)
+
+    def run_rule(context, report):
+      shared_query(context)
+      report.add_ok(FakeResource('r1'))
+
+    # the second rule starts later, while the first one executes shared_query,
+    # and its deadline is after the deadline of the first rule.
+    late_rule = _make_rule('2022_002', run_rule)
+    late_rule.queries.append(lint.QueryNode(delay_query))
+    rules = [_make_rule('2022_001', run_rule), late_rule]
+    report, output, run_time = self._run(rules)
+    assert run_time < 10
+    assert [report.rules_report[r]['overall_status'] for r in rules
+           ] == ['skipped', 'ok']
+    assert output.count('Timeout: rule deadline exceeded') == 1
+    assert len(calls) == 2
+
+  @mock.patch.dict(config._defaults, {'run_timeout_seconds': 0.3})
+  def test_run_timeout(self):
+    query_started = threading.Event()
+    query_done = threading.Event()
+    late_query_started = threading.Event()
+
+    def blocking_query(context):
+      del context
+      query_started.set()
+      self.release.wait(30)
+      query_done.set()
+
+    def not_started_query(context):
+      del context
+      late_query_started.set()
+
+    blocked_rule = _make_rule('2022_002', self.run_ok)
+    blocked_rule.queries.append(lint.QueryNode(blocking_query))
+    blocked_rule.queries.append(lint.QueryNode(not_started_query))
+    rules = [
+        _make_rule('2022_001', self.run_cooperative), blocked_rule,
+        _make_rule('2022_003', self.run_ok)
+    ]
+    # a single worker thread: not_started_query waits for blocking_query.
+    query_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    with mock.patch('gcpdiag.lint.get_executor', return_value=query_executor):
+      report, output, run_time = self._run(rules)
+    assert run_time < 10
+    assert query_started.is_set()
+    assert [report.rules_report[r]['overall_status'] for r in rules
+           ] == ['skipped', 'skipped', 'ok']
+    assert output.count('Timeout: run deadline exceeded') == 2
+    # the queries that weren't started yet were cancelled.
+    self.release.set()
+    assert query_done.wait(10)
+    assert not late_query_started.wait(0.2)
+    query_executor.shutdown()
+
+  @mock.patch.dict(config._defaults, {'rule_timeout_seconds': 0.3})
+  def test_prepare_timeout(self):
+    rule_started = threading.Event()
+
+    def prepare_cooperative(context):
+      del context
+      while True:
+        deadlines.check()
+        time.sleep(0.01)
+
+    def prepare_blocking(context):
+      del context
+      self.release.wait(30)
+
+    def run_rule(context, report):
+      del context, report
+      rule_started.set()
+
+    rules = [
+        _make_rule('2022_001', run_rule),
+        _make_rule('2022_002', run_rule),
+        _make_rule('2022_003', self.run_ok)
+    ]
+    rules[0].prepare_rule_f = prepare_cooperative
+    rules[1].prepare_rule_f = prepare_blocking
+    rules[1].prefetch_rule_f = run_rule
+    report, output, run_time = self._run(rules)
+    assert run_time < 10
+    assert not rule_started.is_set()
+    # only the rules whose prepare_rule function timed out are skipped.
+    assert [report.rules_report[r]['overall_status'] for r in rules
+           ] == ['skipped', 'skipped', 'ok']
+    assert output.count('Timeout: rule deadline exceeded') == 2
@@ -17,7 +17,10 @@
 
 import abc
 import dataclasses
-from typing import Iterable, List, Mapping, Optional
+import logging
+import re
+import threading
+from typing import Callable, Iterable, List, Mapping, Optional, Tuple
 
 from gcpdiag import utils
 
@@ -94,16 +97,27 @@ class Context:
   def __hash__(self):
     return self.__str__().__hash__()
 
-  def match_project_resource(self, location: Optional[str],
-                             labels: Optional[Mapping[str, str]]) -> bool:
-    """Return true if a resource in a project matches with this context."""
+  def cache_key(self) -> str:
+    """Stable identifier used by caching.cached_api_call instead of pickling
+    the whole object."""
+    return str(self)
 
-    # Match location.
+  def match_project_location(self, location: Optional[str]) -> bool:
+    """Return true if a location (region or zone) matches with this context."""
     if self.regions:
       if not location:
         return False
       if not any(location.startswith(reg) for reg in self.regions):
         return False
+    return True
+
+  def match_project_resource(self, location: Optional[str],
+                             labels: Optional[Mapping[str, str]]) -> bool:
+    """Return true if a resource in a project matches with this context."""
+
+    # Match location.
+    if not self.match_project_location(location):
+      return False
 
     # Match labels.
     if self.labels:
@@ -122,6 +136,10 @@ class Context:
 class Resource(abc.ABC):
   """Represents a single resource in GCP."""
   _project_id: str
+  # JSON paths of the resource data used by the class (e.g. 'properties/tags'),
+  # so that the query functions can fetch only those fields. None if the
+  # class doesn't declare them (and the full resource is fetched).
+  RESOURCE_FIELDS: Optional[Tuple[str, ...]] = None
 
   def __init__(self, project_id):
     self._project_id = project_id
@@ -135,6 +153,11 @@ class Resource(abc.ABC):
   def __lt__(self, other):
     return self.full_path < other.full_path
 
+  def cache_key(self) -> str:
+    """Stable identifier used by caching.cached_api_call instead of pickling
+    the whole object (including its resource data)."""
+    return self.full_path
+
   def __eq__(self, other):
     if self.__class__ == other.__class__:
       return self.full_path == other.full_path
@@ -164,3 +187,59 @@ class Resource(abc.ABC):
     Example: 'gke1'
     """
     return self.full_path
+
+
+class PartialResourceData(dict):
+  """Resource data fetched with a field mask, i.e. only with the fields of
+  Resource.RESOURCE_FIELDS.
+
+  When a key that is not part of the fields is accessed, the full resource is
+  fetched with fetch_full() (once), so that a missing declaration is only a
+  performance issue. Note that only the top-level keys are checked: a nested
+  field that isn't declared (e.g. 'properties/disks' when only
+  'properties/tags' is) is not detected.
+  """
+
+  def __init__(self, data: dict, fields: Iterable[str],
+               fetch_full: Callable[[], dict]):
+    super().__init__(data)
+    self._fields = tuple(fields)
+    self._keys = frozenset(re.split(r'[/(]', f, 1)[0] for f in self._fields)
+    self._fetch_full = fetch_full
+    self._complete = False
+    self._lock = threading.Lock()
+
+  def _fetch_missing(self, key):
+    if self._complete or key in self._keys:
+      return
+    with self._lock:
+      if self._complete:
+        return
+      logging.debug('fetching full resource data (%s is not in the fields)',
+                    key)
+      self.update(self._fetch_full())
+      self._complete = True
+
+  def __getitem__(self, key):
+    if not super().__contains__(key):
+      self._fetch_missing(key)
+    return super().__getitem__(key)
+
+  def __contains__(self, key):
+    if super().__contains__(key):
+      return True
+    self._fetch_missing(key)
+    return super().__contains__(key)
+
+  def get(self, key, default=None):
+    if not super().__contains__(key):
+      self._fetch_missing(key)
+    return super().get(key, default)
+
+  def __reduce__(self):
+    # the lock can't be pickled (e.g. for the disk cache), and fetch_full
+    # isn't needed anymore once the full resource was fetched.
+    if self._complete:
+      return (dict, (dict.copy(self),))
+    return (PartialResourceData, (dict.copy(self), self._fields,
+                                  self._fetch_full))
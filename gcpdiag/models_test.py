@@ -15,6 +15,9 @@
 # Lint as: python3
 """Unit tests for test.py."""
 
+import functools
+import pickle
+
 import pytest
 
 from gcpdiag import models
@@ -52,3 +55,66 @@ def test_context_to_string():
                          'X': 'Y'
                      }])
   assert str(c) == 'project: project1, regions: us-central1, labels: {X=Y}'
+
+
+def test_context_match_project_location():
+  c = models.Context(project_id='project1')
+  assert c.match_project_location('us-central1-b')
+  assert c.match_project_location(None)
+
+  c = models.Context(project_id='project1', regions=['us-central1'])
+  assert c.match_project_location('us-central1-b')
+  assert c.match_project_location('us-central1')
+  assert not c.match_project_location('europe-west1-b')
+  assert not c.match_project_location(None)
+
+
+def test_partial_resource_data():
+  fetch_full = functools.partial(dict, name='r1', tags=['a'], status='RUNNING')
+  data = models.PartialResourceData({
+      'name': 'r1',
+      'tags': ['a']
+  }, ('name', 'tags/items', 'labels'), fetch_full)
+  # missing declared fields don't fetch the full resource.
+  assert data['name'] == 'r1'
+  assert 'labels' not in data
+  assert data.get('labels') is None
+  # the other fields are fetched with fetch_full()
+  assert data.get('status') == 'RUNNING'
+  assert 'status' in data
+  assert 'other' not in data
+  with pytest.raises(KeyError):
+    _ = data['other']
+
+
+def test_partial_resource_data_fetch_once():
+  fetches = []
+
+  def fetch_full():
+    fetches.append(1)
+    return {'name': 'r1', 'status': 'RUNNING'}
+
+  data = models.PartialResourceData({'name': 'r1'}, ('name',), fetch_full)
+  assert data.get('labels') is None
+  assert 'other' not in data
+  assert data['status'] == 'RUNNING'
+  assert len(fetches) == 1
+
+
+def test_partial_resource_data_pickle():
+  fetch_full = functools.partial(dict, name='r1', status='RUNNING')
+  data = models.PartialResourceData({'name': 'r1'}, ('name',), fetch_full)
+  data = pickle.loads(pickle.dumps(data))
+  assert isinstance(data, models.PartialResourceData)
+  assert data['status'] == 'RUNNING'
+  # once the full resource was fetched, it is pickled as a plain dict.
+  data = pickle.loads(pickle.dumps(data))
+  assert type(data) is dict  # pylint: disable=unidiomatic-typecheck
+  assert data == {'name': 'r1', 'status': 'RUNNING'}
+
+
+def test_partial_resource_data_field_paths():
+  data = models.PartialResourceData({}, ('', 'tags(items)', 'disks/licenses'),
+                                    dict)
+  assert data.get('tags') is None
+  assert 'disks' not in data
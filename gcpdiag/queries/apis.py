@@ -19,19 +19,23 @@ import json
 import logging
 import os
 import sys
-from typing import Optional, Set
+from typing import Any, Dict, Optional, Set
 
 import google.auth
+import google.auth.credentials
 import google_auth_httplib2
 import googleapiclient.http
 import httplib2
 from google.auth import exceptions
 from google_auth_oauthlib import flow
-from googleapiclient import discovery
+from googleapiclient import discovery, discovery_cache
 
 from gcpdiag import caching, config, hooks, utils
+from gcpdiag.queries import apis_snapshot, apis_utils
 
 _credentials = None
+# Keep-alive connections shared by all the API requests.
+_http_pool = apis_utils.PooledHttp(config.API_HTTP_POOL_MAX_IDLE)
 
 AUTH_SCOPES = [
     'openid',
@@ -104,6 +108,9 @@ def _oauth_flow_prompt(client_config):
 
 
 def _get_credentials():
+  if apis_snapshot.is_replaying():
+    # all responses come from the snapshot: no authentication needed.
+    return google.auth.credentials.AnonymousCredentials()
   if _auth_method() == 'adc':
     return _get_credentials_adc()
   elif _auth_method() == 'key':
@@ -138,12 +145,46 @@ def get_user_email() -> str:
   return data['email']
 
 
+@caching.cached_api_call(expire=config.DISCOVERY_DOCUMENTS_EXPIRY_SECONDS)
+def _fetch_discovery_doc(service_name: str, version: str) -> str:
+  """Download the discovery document of an API not bundled with
+  googleapiclient (the result is cached on disk)."""
+  logging.debug('downloading discovery document of %s %s', service_name,
+                version)
+  for uri in [discovery.DISCOVERY_URI, discovery.V2_DISCOVERY_URI]:
+    resp, content = _http_pool.request(
+        uri.format(api=service_name, apiVersion=version))
+    if resp.status < 400:
+      return content.decode('utf-8')
+  raise googleapiclient.errors.UnknownApiNameOrVersion(
+      f'name: {service_name}  version: {version}')
+
+
 @caching.cached_api_call(in_memory=True)
+def _get_discovery_doc(service_name: str, version: str) -> Dict[str, Any]:
+  """Return the parsed discovery document of an API.
+
+  The document is parsed once per process and shared by all the API objects
+  of that service and version."""
+  content = (discovery_cache.get_static_doc(service_name, version) or
+             _fetch_discovery_doc(service_name, version))
+  return json.loads(content)
+
+
 def get_api(service_name: str, version: str, project_id: Optional[str] = None):
   """Get an API object, as returned by googleapiclient.discovery.build.
 
   If project_id is specified, this will be used as the billed project, and usually
   you should put there the project id of the project that you are inspecting."""
+  # The API objects only differ by the billed project (the x-goog-user-project
+  # header), so with a billing project one object is used for all projects.
+  return _get_api(
+      service_name, version,
+      _get_project_or_billing_id(project_id) if project_id else None)
+
+
+@caching.cached_api_call(in_memory=True)
+def _get_api(service_name: str, version: str, billed_project_id: Optional[str]):
   credentials = _get_credentials()
 
   def _request_builder(http, *args, **kwargs):
@@ -155,22 +196,23 @@ def get_api(service_name: str, version: str, project_id: Optional[str] = None):
 
       headers = kwargs.get('headers', {})
       headers['user-agent'] = f'gcpdiag/{config.VERSION} (gzip)'
-      if project_id:
-        headers['x-goog-user-project'] = _get_project_or_billing_id(project_id)
+      if billed_project_id:
+        headers['x-goog-user-project'] = billed_project_id
 
     hooks.request_builder_hook(*args, **kwargs)
 
-    # thread safety: create a new AuthorizedHttp object for every request
+    # thread safety: create a new AuthorizedHttp object for every request,
+    # using the (thread-safe) pool of httplib2.Http objects.
     # https://github.com/googleapis/google-api-python-client/blob/master/docs/thread_safety.md
-    new_http = google_auth_httplib2.AuthorizedHttp(credentials,
-                                                   http=httplib2.Http())
-    return googleapiclient.http.HttpRequest(new_http, *args, **kwargs)
-
-  api = discovery.build(service_name,
-                        version,
-                        cache_discovery=False,
-                        credentials=credentials,
-                        requestBuilder=_request_builder)
+    new_http = google_auth_httplib2.AuthorizedHttp(credentials, http=_http_pool)
+    return googleapiclient.http.HttpRequest(
+        apis_utils.ConcurrencyLimitedHttp(apis_snapshot.wrap_http(new_http)),
+        *args, **kwargs)
+
+  api = discovery.build_from_document(_get_discovery_doc(service_name, version),
+                                      credentials=credentials,
+                                      requestBuilder=_request_builder)
+  apis_snapshot.patch_batch_requests(api)
   return api
 
 
@@ -0,0 +1,246 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Record API responses to a snapshot file and replay them offline.
+
+When recording, every HTTP response received by the API objects returned by
+apis.get_api() is captured (including the individual responses of batch
+requests). The snapshot can later be replayed, in which case all requests are
+answered from the snapshot and no network call is done at all. This makes it
+possible to re-evaluate rules against the state of a project at the time of
+the recording, similarly to apis_stub but for any project.
+
+Timestamps in request URIs and bodies (e.g. in logging filters) are ignored
+when matching requests, so that queries relative to the current time can be
+replayed.
+
+Note that recording and replaying are process-wide settings.
+"""
+
+import base64
+import gzip
+import hashlib
+import json
+import logging
+import re
+import threading
+from typing import Dict, Optional
+
+import googleapiclient.errors
+import httplib2
+
+from gcpdiag import caching
+
+SNAPSHOT_FORMAT_VERSION = 1
+
+_TIMESTAMP_MATCH = re.compile(
+    r'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(?:\.\d+)?(?:Z|[+-]\d\d:\d\d)?'
+    r'|\d{4}/\d\d/\d\d-\d\d:\d\d:\d\d(?:[+-]\d\d:\d\d)?')
+
+_lock = threading.Lock()
+_mode: Optional[str] = None
+_responses: Dict[str, dict] = {}
+
+
+class SnapshotMissError(RuntimeError):
+  """Raised when replaying a request that isn't in the snapshot."""
+
+
+def request_key(uri: str, method: str, body) -> str:
+  """Key used to match requests (timestamps are ignored)."""
+  if isinstance(body, bytes):
+    body = body.decode('utf-8', errors='replace')
+  body_hash = hashlib.sha256(
+      _TIMESTAMP_MATCH.sub('*', body or '').encode('utf-8')).hexdigest()
+  return f'{method} {_TIMESTAMP_MATCH.sub("*", uri)} {body_hash}'
+
+
+def _record(key: str, status: int, headers: dict, content: bytes):
+  response = {'status': status, 'headers': headers}
+  try:
+    response['content'] = content.decode('utf-8')
+  except UnicodeDecodeError:
+    response['content_b64'] = base64.b64encode(content).decode('ascii')
+  with _lock:
+    _responses[key] = response
+
+
+def start_recording():
+  """Record all API responses from now on.
+
+  An empty cache is used until stop(), so that every response that the rules
+  use ends up in the snapshot."""
+  global _mode
+  with _lock:
+    _mode = 'record'
+    _responses.clear()
+  caching.use_isolated_cache()
+
+
+def start_replay(filename: str):
+  """Answer all API requests from the snapshot in filename."""
+  global _mode
+  with gzip.open(filename, 'rt', encoding='utf-8') as f:
+    snapshot = json.load(f)
+  if snapshot.get('version') != SNAPSHOT_FORMAT_VERSION:
+    raise ValueError(f'unsupported snapshot version in {filename}')
+  with _lock:
+    _mode = 'replay'
+    _responses.clear()
+    _responses.update(snapshot['responses'])
+  # cached results would hide what is in the snapshot, and the results computed
+  # from the snapshot must not be cached for later (live) runs.
+  caching.use_isolated_cache()
+  logging.debug('loaded %d API responses from snapshot %s', len(_responses),
+                filename)
+
+
+def stop():
+  """Go back to normal operation (API requests use the network)."""
+  global _mode
+  with _lock:
+    _mode = None
+    _responses.clear()
+  # go back to the shared cache, without the results (and API objects without
+  # credentials) that were cached while recording or replaying.
+  caching.use_shared_cache()
+
+
+def save(filename: str):
+  """Write the responses recorded so far to filename."""
+  with _lock:
+    responses = dict(sorted(_responses.items()))
+  with gzip.open(filename, 'wt', encoding='utf-8') as f:
+    json.dump({'version': SNAPSHOT_FORMAT_VERSION, 'responses': responses}, f)
+  logging.debug('saved %d API responses to snapshot %s', len(responses),
+                filename)
+
+
+def is_recording() -> bool:
+  return _mode == 'record'
+
+
+def is_replaying() -> bool:
+  return _mode == 'replay'
+
+
+class _RecordingHttp:
+  """httplib2.Http wrapper that records all responses."""
+
+  def __init__(self, http):
+    self._http = http
+
+  def __getattr__(self, name):
+    # e.g. credentials, used by BatchHttpRequest to refresh the token.
+    return getattr(self._http, name)
+
+  def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+    resp, content = self._http.request(uri,
+                                       method=method,
+                                       body=body,
+                                       headers=headers,
+                                       **kwargs)
+    # batch requests are recorded individually by _RecordingBatch.
+    content_type = (headers or {}).get('content-type', '')
+    if not content_type.startswith('multipart/mixed'):
+      _record(request_key(uri, method, body), resp.status, dict(resp), content)
+    return resp, content
+
+
+class ReplayHttp:
+  """httplib2.Http replacement that answers requests from the snapshot."""
+
+  def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+    del headers, kwargs
+    key = request_key(uri, method, body)
+    with _lock:
+      response = _responses.get(key)
+    if response is None:
+      raise SnapshotMissError(f'request not found in snapshot: {method} {uri}')
+    headers = dict(response['headers'])
+    headers['status'] = str(response['status'])
+    if 'content_b64' in response:
+      content = base64.b64decode(response['content_b64'])
+    else:
+      content = response['content'].encode('utf-8')
+    return httplib2.Response(headers), content
+
+
+def wrap_http(http):
+  """Return the http object that should be used to execute a request."""
+  if _mode == 'record':
+    return _RecordingHttp(http)
+  elif _mode == 'replay':
+    return ReplayHttp()
+  return http
+
+
+class _SequentialBatch:
+  """Executes the requests of a batch one by one (used when replaying)."""
+
+  def __init__(self, callback=None):
+    self._callback = callback
+    self._queue = []
+
+  def add(self, request, callback=None, request_id=None):
+    self._queue.append((request, callback or self._callback, request_id))
+
+  def execute(self):
+    for request, callback, request_id in self._queue:
+      try:
+        response = request.execute()
+      except googleapiclient.errors.HttpError as err:
+        callback(request_id, None, err)
+      else:
+        callback(request_id, response, None)
+
+
+class _RecordingBatch:
+  """Wrapper of BatchHttpRequest that records each individual response."""
+
+  def __init__(self, batch):
+    self._batch = batch
+
+  def add(self, request, callback=None, request_id=None):
+    key = request_key(request.uri, request.method, request.body)
+
+    def _recording_callback(request_id, response, exception):
+      if isinstance(exception, googleapiclient.errors.HttpError):
+        _record(key, exception.resp.status, dict(exception.resp),
+                exception.content)
+      elif exception is None:
+        _record(key, 200, {'content-type': 'application/json'},
+                json.dumps(response).encode('utf-8'))
+      (callback or self._batch._callback)(request_id, response, exception)  # pylint: disable=protected-access
+
+    self._batch.add(request,
+                    callback=_recording_callback,
+                    request_id=request_id)
+
+  def execute(self, *args, **kwargs):
+    return self._batch.execute(*args, **kwargs)
+
+
+def patch_batch_requests(api):
+  """Make new_batch_http_request() of api record/replay individual requests."""
+  new_batch_http_request = api.new_batch_http_request
+
+  def _new_batch_http_request(callback=None):
+    if _mode == 'replay':
+      return _SequentialBatch(callback)
+    batch = new_batch_http_request(callback=callback)
+    if _mode == 'record':
+      return _RecordingBatch(batch)
+    return batch
+
+  api.new_batch_http_request = _new_batch_http_request
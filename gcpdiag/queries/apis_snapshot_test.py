@@ -0,0 +1,128 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+"""Test code in apis_snapshot.py."""
+
+import json
+from unittest import mock
+
+import diskcache
+import googleapiclient.errors
+import googleapiclient.http
+import httplib2
+import pytest
+
+from gcpdiag.queries import apis_snapshot
+
+_disk_cache = diskcache.Cache()
+
+
+class FakeHttp:
+  """httplib2.Http replacement returning canned responses."""
+
+  def __init__(self, responses):
+    self.responses = responses
+    self.requests = []
+
+  def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+    del headers, kwargs
+    self.requests.append((method, uri, body))
+    status, content = self.responses[uri]
+    return httplib2.Response({'status': str(status)}), content
+
+
+def _make_request(http, uri, body=None):
+  return googleapiclient.http.HttpRequest(
+      http,
+      lambda resp, content: json.loads(content),
+      uri,
+      method='POST' if body else 'GET',
+      body=body)
+
+
+@mock.patch('gcpdiag.caching.get_cache', new=lambda: _disk_cache)
+class TestSnapshot:
+  """Test recording and replaying of API responses."""
+
+  def teardown_method(self):
+    apis_snapshot.stop()
+
+  def test_record_and_replay(self, tmp_path):
+    http = FakeHttp({
+        'https://example.com/v1/a': (200, b'{"a": 1}'),
+        'https://example.com/v1/missing': (404, b'{"error": "not found"}'),
+    })
+    apis_snapshot.start_recording()
+    assert _make_request(apis_snapshot.wrap_http(http),
+                         'https://example.com/v1/a').execute() == {
+                             'a': 1
+                         }
+    with pytest.raises(googleapiclient.errors.HttpError):
+      _make_request(apis_snapshot.wrap_http(http),
+                    'https://example.com/v1/missing').execute()
+    snapshot_file = tmp_path / 'snapshot.json.gz'
+    apis_snapshot.save(str(snapshot_file))
+    apis_snapshot.stop()
+
+    apis_snapshot.start_replay(str(snapshot_file))
+    assert apis_snapshot.is_replaying()
+    # no request must reach the real http object
+    offline_http = FakeHttp({})
+    assert _make_request(apis_snapshot.wrap_http(offline_http),
+                         'https://example.com/v1/a').execute() == {
+                             'a': 1
+                         }
+    with pytest.raises(googleapiclient.errors.HttpError) as excinfo:
+      _make_request(apis_snapshot.wrap_http(offline_http),
+                    'https://example.com/v1/missing').execute()
+    assert excinfo.value.resp.status == 404
+    with pytest.raises(apis_snapshot.SnapshotMissError):
+      _make_request(apis_snapshot.wrap_http(offline_http),
+                    'https://example.com/v1/b').execute()
+    assert not offline_http.requests
+
+  def test_timestamps_ignored(self):
+    key1 = apis_snapshot.request_key(
+        'https://example.com/v1/entries', 'POST',
+        '{"filter": "timestamp > \\"2022-03-01T10:00:00.123Z\\""}')
+    key2 = apis_snapshot.request_key(
+        'https://example.com/v1/entries', 'POST',
+        '{"filter": "timestamp > \\"2022-03-02T11:00:00.456Z\\""}')
+    key3 = apis_snapshot.request_key('https://example.com/v1/entries', 'POST',
+                                     '{"filter": "severity=ERROR"}')
+    assert key1 == key2
+    assert key1 != key3
+
+  def test_batch_replay(self, tmp_path):
+    http = FakeHttp({'https://example.com/v1/a': (200, b'{"a": 1}')})
+    apis_snapshot.start_recording()
+    _make_request(apis_snapshot.wrap_http(http),
+                  'https://example.com/v1/a').execute()
+    snapshot_file = tmp_path / 'snapshot.json.gz'
+    apis_snapshot.save(str(snapshot_file))
+    apis_snapshot.stop()
+
+    apis_snapshot.start_replay(str(snapshot_file))
+    api = mock.Mock()
+    apis_snapshot.patch_batch_requests(api)
+    results = []
+    batch = api.new_batch_http_request(
+        callback=lambda request_id, response, exception: results.append(
+            (request_id, response, exception)))
+    batch.add(_make_request(apis_snapshot.wrap_http(None),
+                            'https://example.com/v1/a'),
+              request_id='1')
+    batch.execute()
+    assert results == [('1', {'a': 1}, None)]
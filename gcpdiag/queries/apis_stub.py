@@ -13,13 +13,15 @@
 # limitations under the License.
 """Stub API calls used in apis.py for testing."""
 
+import inspect
 import json
 import pathlib
 import re
-from typing import Optional
+from typing import Any, Callable, Dict, List, Optional
 
 import googleapiclient.errors
 import httplib2
+from googleapiclient import discovery_cache
 
 # pylint: disable=unused-argument
 
@@ -76,6 +78,108 @@ def get_json_dir(project_id: str):
   return JSON_PROJECT_DIR[project_id]
 
 
+def _parse_fields(tokens: List[str]) -> dict:
+  """Parse the tokens of a `fields` parameter as a tree: {key: subtree}, with
+  None as subtree when the whole field is selected."""
+  tree: dict = {}
+  while tokens and tokens[0] != ')':
+    path = [tokens.pop(0)]
+    while tokens and tokens[0] == '/':
+      tokens.pop(0)
+      path.append(tokens.pop(0))
+    subtree = None
+    if tokens and tokens[0] == '(':
+      tokens.pop(0)
+      subtree = _parse_fields(tokens)
+      tokens.pop(0)
+    node: Optional[dict] = tree
+    for key in path[:-1]:
+      if node is None:
+        break
+      node = node.setdefault(key, {})
+    if node is not None:
+      if subtree is None or node.get(path[-1], {}) is None:
+        node[path[-1]] = None
+      else:
+        node.setdefault(path[-1], {}).update(subtree)
+    if tokens and tokens[0] == ',':
+      tokens.pop(0)
+  return tree
+
+
+def _select_fields(data, tree: Optional[dict]):
+  if tree is None:
+    return data
+  if isinstance(data, list):
+    return [_select_fields(v, tree) for v in data]
+  if not isinstance(data, dict):
+    return data
+  result = {}
+  for key, value in data.items():
+    if key in tree:
+      result[key] = _select_fields(value, tree[key])
+    elif '*' in tree:
+      result[key] = _select_fields(value, tree['*'])
+  return result
+
+
+def apply_fields_mask(data: dict, fields: str) -> dict:
+  """Return data with only the fields selected by a `fields` parameter
+  (partial response), e.g. 'items/*/instances(name,tags/items),nextPageToken'."""
+  tokens = re.findall(r'[^,/()\s]+|[,/()]', fields)
+  return _select_fields(data, _parse_fields(tokens))
+
+
+def get_fields_not_in_schema(resource_class, service: str, version: str,
+                             schema_name: str) -> List[str]:
+  """Return the RESOURCE_FIELDS of resource_class that are not in the API
+  schema of the resource (the API would reject the field mask)."""
+  schemas = json.loads(discovery_cache.get_static_doc(service,
+                                                      version))['schemas']
+
+  def resolve(schema):
+    while True:
+      if '$ref' in schema:
+        schema = schemas[schema['$ref']]
+      elif schema.get('type') == 'array':
+        schema = schema['items']
+      else:
+        return schema
+
+  missing = []
+  for field in resource_class.RESOURCE_FIELDS:
+    schema = schemas[schema_name]
+    for key in field.split('/'):
+      properties = resolve(schema).get('properties', {})
+      if key not in properties:
+        missing.append(field)
+        break
+      schema = properties[key]
+  return missing
+
+
+def get_accessor_values(resource) -> Dict[str, Any]:
+  """Return the values of the public properties of a resource object and of
+  its methods without arguments (or the exception that they raise), e.g. to
+  verify that the RESOURCE_FIELDS of its class are enough."""
+  values: Dict[str, Any] = {}
+  for name, attr in inspect.getmembers(type(resource)):
+    if name.startswith('_') or name.isupper():
+      continue
+    if isinstance(attr, property) and attr.fget:
+      func = attr.fget
+    elif inspect.isfunction(attr) and len(
+        inspect.signature(attr).parameters) == 1:
+      func = attr
+    else:
+      continue
+    try:
+      values[name] = func(resource)
+    except Exception as err:  # pylint: disable=broad-except
+      values[name] = (type(err), str(err))
+  return values
+
+
 class ApiStub:
   """Base class for "API Stubs", i.e. objects that mock what is returned
   by the googleapiclient modules. This base class makes it easier to
@@ -111,7 +215,8 @@ class RestCallStub(ApiStub):
                page: int = 1,
                default: Optional[dict] = None,
                default_json_basename: Optional[str] = None,
-               request_uri: str = ''):
+               request_uri: str = '',
+               fields: Optional[str] = None):
     self.project_id = project_id
     self.json_dir = get_json_dir(project_id)
     self.json_basename = json_basename
@@ -119,8 +224,15 @@ class RestCallStub(ApiStub):
     self.default = default
     self.default_json_basename = default_json_basename
     self.uri = request_uri
+    self.fields = fields
 
   def execute(self, num_retries: int = 0) -> dict:
+    response = self._load()
+    if self.fields:
+      return apply_fields_mask(response, self.fields)
+    return response
+
+  def _load(self) -> dict:
     self._maybe_raise_api_exception()
     try:
       filename = str(self.json_dir / self.json_basename)
@@ -139,6 +251,49 @@ class RestCallStub(ApiStub):
       raise
 
 
+def _find_item(data, match: Callable[[dict], bool]) -> Optional[dict]:
+  if isinstance(data, dict):
+    if match(data):
+      return data
+    values = list(data.values())
+  elif isinstance(data, list):
+    values = data
+  else:
+    return None
+  for value in values:
+    item = _find_item(value, match)
+    if item is not None:
+      return item
+  return None
+
+
+class ListItemCallStub(ApiStub):
+  """Mock object to simulate a get request, returning the item of a list JSON
+  dump (or one of its pages) for which `match` is true."""
+
+  def __init__(self, project_id: str, json_basename: str,
+               match: Callable[[dict], bool]):
+    self.project_id = project_id
+    self.json_basename = json_basename
+    self.match = match
+
+  def execute(self, num_retries: int = 0) -> dict:
+    self._maybe_raise_api_exception()
+    page = 1
+    while True:
+      try:
+        response = RestCallStub(self.project_id, self.json_basename,
+                                page=page).execute()
+      except FileNotFoundError:
+        break
+      item = _find_item(response, self.match)
+      if item is not None:
+        return item
+      page += 1
+    raise googleapiclient.errors.HttpError(httplib2.Response({'status': 404}),
+                                           b'resource not found')
+
+
 class ServiceUsageApiStub(ApiStub):
   """Mock object to simulate api calls."""
 
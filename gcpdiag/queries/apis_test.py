@@ -13,16 +13,89 @@
 # limitations under the License.
 """Test code in apis.py."""
 
+# pylint: disable=protected-access
+
 from unittest import mock
 
+import diskcache
+import google.auth.credentials
+import httplib2
+from googleapiclient import discovery_cache
+
+from gcpdiag import config
 from gcpdiag.queries import apis, apis_stub
 
 DUMMY_PROJECT_NAME = 'gcpdiag-gke1-aaaa'
 
 
+def get_cache_stub():
+  """Use a temporary directory instead of the user cache for testing."""
+  return diskcache.Cache()
+
+
+class DiscoveryHttpStub:
+  """Serve the discovery documents of the given services."""
+
+  def __init__(self, docs):
+    self.docs = docs
+    self.uris = []
+
+  def request(self, uri, **kwargs):
+    del kwargs
+    self.uris.append(uri)
+    for name, content in self.docs.items():
+      if f'/{name}/' in uri:
+        return httplib2.Response({'status': '200'}), content.encode()
+    return httplib2.Response({'status': '404'}), b''
+
+
 @mock.patch('gcpdiag.queries.apis.get_api', new=apis_stub.get_api_stub)
 class Test:
 
   def test_is_enabled(self):
     assert apis.is_enabled(DUMMY_PROJECT_NAME, 'container')
     assert not apis.is_enabled(DUMMY_PROJECT_NAME, 'containerxyz')
+
+
+@mock.patch('gcpdiag.queries.apis._get_credentials',
+            new=google.auth.credentials.AnonymousCredentials)
+@mock.patch('gcpdiag.caching.get_cache', new=get_cache_stub)
+class TestGetApi:
+  """Test building of the API objects from the discovery documents."""
+
+  def setup_method(self):
+    config.init({}, None)
+
+  def teardown_method(self):
+    config.init({}, None)
+
+  def test_discovery_doc_shared(self):
+    api1 = apis.get_api('compute', 'v1', 'gcpdiag-test-1')
+    api2 = apis.get_api('compute', 'v1', 'gcpdiag-test-2')
+    doc = apis._get_discovery_doc('compute', 'v1')
+    assert api1 is not api2
+    assert api1._rootDesc is api2._rootDesc is doc
+    assert apis.get_api('compute', 'v1', 'gcpdiag-test-1') is api1
+
+  def test_billed_project(self):
+    request = apis.get_api('compute', 'v1', 'gcpdiag-test-1').instances().list(
+        project='gcpdiag-test-1', zone='europe-west4-a')
+    assert request.headers['x-goog-user-project'] == 'gcpdiag-test-1'
+
+  def test_billing_project(self):
+    config.init({'billing_project': 'gcpdiag-billing'}, None)
+    api = apis.get_api('compute', 'v1', 'gcpdiag-test-3')
+    assert apis.get_api('compute', 'v1', 'gcpdiag-test-4') is api
+    request = api.instances().list(project='gcpdiag-test-4',
+                                   zone='europe-west4-a')
+    assert request.headers['x-goog-user-project'] == 'gcpdiag-billing'
+
+  def test_downloaded_doc(self):
+    http = DiscoveryHttpStub(
+        {'container': discovery_cache.get_static_doc('container', 'v1')})
+    with mock.patch('gcpdiag.queries.apis._http_pool', new=http):
+      doc = apis._get_discovery_doc('container', 'v1beta98')
+      assert doc['name'] == 'container'
+      # the downloaded document is cached
+      assert apis._fetch_discovery_doc('container', 'v1beta98')
+    assert len(http.uris) == 1
@@ -15,13 +15,30 @@
 
 import logging
 import random
+import threading
 import time
-from typing import Any, Callable, Iterator, List, Optional, Tuple
+import urllib.parse
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Optional,
+                    Tuple)
 
 import googleapiclient.errors
 import httplib2
 
-from gcpdiag import config, utils
+from gcpdiag import call_audit, config, deadlines, executor, tracing, utils
+
+
+def fields_mask(resource_fields: Iterable[str],
+                items_path: str = 'items',
+                paged: bool = True) -> str:
+  """Return the `fields` parameter of a list request that selects only
+  resource_fields (e.g. models.Resource.RESOURCE_FIELDS) of the items, e.g.:
+  'items(name,properties/tags),nextPageToken'.
+
+  For aggregatedList requests, items_path is e.g. 'items/*/instances'."""
+  mask = f'{items_path}({",".join(resource_fields)})'
+  if paged:
+    mask += ',nextPageToken'
+  return mask
 
 
 def list_all(request,
@@ -32,6 +49,7 @@ def list_all(request,
   the results are under a `items` key."""
 
   while True:
+    deadlines.check()
     try:
       response = request.execute(num_retries=config.API_RETRIES)
     except googleapiclient.errors.HttpError as err:
@@ -47,6 +65,30 @@ def list_all(request,
       break
 
 
+def aggregated_list_all(request, next_function: Callable,
+                        response_keyword: str) -> Iterator[Tuple[str, Any]]:
+  """Like list_all, but for aggregatedList requests (e.g. of the Compute API),
+  whose items are grouped by scope: yield (scope, item) tuples, e.g. with
+  response_keyword='instances': ('zones/europe-west1-b', instance)."""
+
+  while True:
+    deadlines.check()
+    try:
+      response = request.execute(num_retries=config.API_RETRIES)
+    except googleapiclient.errors.HttpError as err:
+      raise utils.GcpApiError(err) from err
+
+    # Scopes without items only have a warning
+    for scope, scoped_list in response.get('items', {}).items():
+      for item in scoped_list.get(response_keyword, []):
+        yield scope, item
+
+    request = next_function(previous_request=request,
+                            previous_response=response)
+    if request is None:
+      break
+
+
 def batch_list_all(api, requests: list, next_function: Callable, log_text: str):
   """Similar to list_all but using batch API."""
   pending_requests = requests
@@ -84,18 +126,226 @@ def _should_retry(resp_status):
   return False
 
 
-def batch_execute_all(api, requests: list):
-  """Execute all `requests` using the batch API and yield (request,response,exception)
-  tuples."""
-  # results: (request, result, exception) tuples
+class ConcurrencyLimiter:
+  """Limit the number of concurrent requests to an API with AIMD.
+
+  The limit is raised additively (by about one request per round-trip) as long
+  as requests succeed with a latency that doesn't exceed
+  config.API_CONCURRENCY_LATENCY_FACTOR times the usual latency, and is
+  multiplied by config.API_CONCURRENCY_BACKOFF when the API answers with 429
+  or 5xx. Only requests started after the last backoff can trigger a new one,
+  so that a burst of errors for the same in-flight requests backs off once."""
+
+  def __init__(self, name: str, initial: int, minimum: int, maximum: int):
+    self.name = name
+    self._minimum = minimum
+    self._maximum = maximum
+    self._limit = float(initial)
+    self._in_flight = 0
+    self._last_backoff = 0.0
+    self._latency: Optional[float] = None
+    self._cond = threading.Condition()
+
+  @property
+  def limit(self) -> int:
+    return int(self._limit)
+
+  def acquire(self) -> float:
+    """Wait for a free slot and return the start time of the request.
+
+    Raises deadlines.DeadlineExceededError if the deadline of the current
+    thread is exceeded while waiting."""
+    with self._cond:
+      while self._in_flight >= int(self._limit):
+        self._cond.wait(deadlines.remaining())
+        deadlines.check()
+      self._in_flight += 1
+    return time.monotonic()
+
+  def release(self, start_time: float, status: Optional[int]):
+    """Free the slot taken with acquire() and adjust the limit based on the
+    HTTP `status` of the response (None if no response was received)."""
+    with self._cond:
+      self._in_flight -= 1
+      if status is not None:
+        if _should_retry(status):
+          self._backoff(start_time)
+        elif status < 400:
+          self._increase(time.monotonic() - start_time)
+      self._cond.notify_all()
+
+  def report_overload(self, start_time: float):
+    """Back off because of a 429/5xx error received for a request started at
+    `start_time`, without taking a slot (e.g. for items of a batch)."""
+    with self._cond:
+      self._backoff(start_time)
+      self._cond.notify_all()
+
+  def _increase(self, latency: float):
+    if self._latency is None:
+      self._latency = latency
+    healthy = latency <= self._latency * config.API_CONCURRENCY_LATENCY_FACTOR
+    self._latency = 0.9 * self._latency + 0.1 * latency
+    if healthy:
+      self._limit = min(self._maximum, self._limit + 1 / self._limit)
+
+  def _backoff(self, start_time: float):
+    if start_time < self._last_backoff:
+      return
+    self._last_backoff = time.monotonic()
+    self._limit = max(self._minimum,
+                      self._limit * config.API_CONCURRENCY_BACKOFF)
+    logging.debug('%s API overloaded, reducing concurrency to %d', self.name,
+                  self.limit)
+
+
+_limiters: Dict[str, ConcurrencyLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(service: str) -> ConcurrencyLimiter:
+  """Return the ConcurrencyLimiter of an API service (e.g. 'compute')."""
+  with _limiters_lock:
+    if service not in _limiters:
+      _limiters[service] = ConcurrencyLimiter(
+          service,
+          initial=config.API_CONCURRENCY_INITIAL,
+          minimum=config.API_CONCURRENCY_MIN,
+          maximum=config.API_CONCURRENCY_MAX)
+    return _limiters[service]
+
+
+def service_name(uri: str) -> str:
+  """Return the API service name of a request URI, e.g. 'compute' for
+  https://compute.googleapis.com/compute/v1/projects/... ."""
+  parsed = urllib.parse.urlparse(uri)
+  host = parsed.hostname or ''
+  if host in ('www.googleapis.com', 'googleapis.com'):
+    # e.g. /compute/v1/... or /batch/compute/v1
+    path = [p for p in parsed.path.split('/') if p]
+    if path and path[0] == 'batch':
+      path = path[1:]
+    return path[0] if path else host
+  return host.split('.')[0]
+
+
+class ConcurrencyLimitedHttp:
+  """httplib2.Http wrapper limiting the concurrency of requests per API with
+  the ConcurrencyLimiter of the service."""
+
+  def __init__(self, http):
+    self._http = http
+
+  def __getattr__(self, name):
+    # e.g. credentials, used by BatchHttpRequest to refresh the token.
+    return getattr(self._http, name)
+
+  def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+    deadlines.check()
+    service = service_name(uri)
+    limiter = get_limiter(service)
+    with tracing.span(f'{method} {service}', 'api', uri=uri) as span, \
+        call_audit.api_request(method, uri):
+      start_time = limiter.acquire()
+      status = None
+      try:
+        resp, content = self._http.request(uri,
+                                           method=method,
+                                           body=body,
+                                           headers=headers,
+                                           **kwargs)
+        status = resp.status
+        return resp, content
+      finally:
+        limiter.release(start_time, status)
+        span.set(status=status)
+
+
+class PooledHttp:
+  """Thread-safe httplib2.Http replacement reusing keep-alive connections.
+
+  httplib2.Http objects can't be used by multiple threads at the same time,
+  but they keep their connections open between requests. Every request checks
+  out an httplib2.Http object from the pool (or creates a new one) and returns
+  it afterwards, so that subsequent requests don't need a new TCP connection
+  and TLS handshake. At most max_idle objects are kept in the pool.
+  """
+
+  def __init__(self,
+               max_idle: int,
+               http_factory: Callable[[], httplib2.Http] = httplib2.Http):
+    self._max_idle = max_idle
+    self._http_factory = http_factory
+    self._idle: List[httplib2.Http] = []
+    self._lock = threading.Lock()
+    self.created = 0
+
+  def _checkout(self) -> httplib2.Http:
+    with self._lock:
+      if self._idle:
+        # the most recently used object is the most likely to have a live
+        # connection to the same host.
+        return self._idle.pop()
+      self.created += 1
+    return self._http_factory()
+
+  def _checkin(self, http: httplib2.Http):
+    with self._lock:
+      if len(self._idle) < self._max_idle:
+        self._idle.append(http)
+        return
+    http.close()
+
+  def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+    http = self._checkout()
+    try:
+      result = http.request(uri,
+                            method=method,
+                            body=body,
+                            headers=headers,
+                            **kwargs)
+    except BaseException:
+      # the state of the connection is unknown.
+      http.close()
+      raise
+    self._checkin(http)
+    return result
+
+  def close(self):
+    """Close the idle connections."""
+    with self._lock:
+      idle = self._idle
+      self._idle = []
+    for http in idle:
+      http.close()
+
+
+def _retry_delay(retry_count: int) -> float:
+  # Retry delay: 20% is random, progression: 1, 1.4, 2.0, 2.7, ... 28.9 (10 retries)
+  return (1 - random.random() * 0.2) * 1.4**retry_count
+
+
+def _batch_max_requests(requests: list) -> int:
+  uri = getattr(requests[0], 'uri', None)
+  if uri:
+    return config.API_BATCH_MAX_REQUESTS_PER_SERVICE.get(
+        service_name(uri), config.API_BATCH_MAX_REQUESTS)
+  return config.API_BATCH_MAX_REQUESTS
+
+
+def _execute_batch(api, requests: List[Tuple[Any, int]],
+                   limiter: Optional[ConcurrencyLimiter]):
+  """Execute one batch of (request, retry count) tuples with the batch API.
+
+  Returns the (request, response, exception) tuples of the requests that are
+  done, and the (request, retry count) tuples of the requests to retry."""
   results: List[Tuple[Any, Optional[Any], Optional[Exception]]] = []
-  requests_todo = requests
-  requests_in_flight: List = []
-  retry_count = 0
+  retries: List[Tuple[Any, int]] = []
+  batch_start_time = time.monotonic()
 
   def fetch_all_cb(request_id, response, exception):
     try:
-      request = requests_in_flight[int(request_id)]
+      request, retry_count = requests[int(request_id)]
     except (IndexError, ValueError, TypeError):
       logging.debug(
           'BUG: Cannot find request %r in list of pending requests, dropping request.',
@@ -108,7 +358,9 @@ def batch_execute_all(api, requests: list):
         retry_count < config.API_RETRIES:
         logging.debug('received HTTP error status code %d from API, retrying',
                       exception.status_code)
-        requests_todo.append(request)
+        if limiter:
+          limiter.report_overload(batch_start_time)
+        retries.append((request, retry_count + 1))
       else:
         results.append((request, None, utils.GcpApiError(exception)))
       return
@@ -118,41 +370,102 @@ def batch_execute_all(api, requests: list):
 
     results.append((request, response, None))
 
+  try:
+    batch = api.new_batch_http_request()
+    for i, (req, _) in enumerate(requests):
+      batch.add(req, callback=fetch_all_cb, request_id=str(i))
+    batch.execute()
+  except (googleapiclient.errors.HttpError, httplib2.HttpLib2Error) as err:
+    if isinstance(err, googleapiclient.errors.HttpError):
+      if not _should_retry(err.status_code):
+        raise utils.GcpApiError(err) from err
+      error_msg = f'received HTTP error status code {err.status_code} from Batch API, retrying'
+    else:
+      error_msg = f'received exception from Batch API: {err}, retrying'
+    if any(retry_count >= config.API_RETRIES for _, retry_count in requests):
+      raise utils.GcpApiError(err) from err
+    logging.debug(error_msg)
+    # retry all the requests of the batch
+    return [], [(request, retry_count + 1) for request, retry_count in requests]
+  return results, retries
+
+
+def batch_execute_all(api, requests: list):
+  """Execute all `requests` using the batch API and yield (request,response,exception)
+  tuples.
+
+  The requests are split in batches of config.API_BATCH_MAX_REQUESTS requests
+  (or less, see API_BATCH_MAX_REQUESTS_PER_SERVICE) that are executed
+  concurrently with the shared executor, and the results are yielded batch by
+  batch as they are done. Requests that failed with a retryable error are
+  retried (in new batches, after a delay), each with its own retry count."""
+  if not requests:
+    return
+  # the batch request itself goes through ConcurrencyLimitedHttp, but errors
+  # of individual requests must be reported to the limiter here.
+  limiter = None
+  if getattr(requests[0], 'uri', None):
+    limiter = get_limiter(service_name(requests[0].uri))
+  max_requests = _batch_max_requests(requests)
+  # (request, retry count) tuples of the requests to execute
+  requests_todo: List[Tuple[Any, int]] = [(r, 0) for r in requests]
+
+  def execute_batch(batch_requests):
+    return _execute_batch(api, batch_requests, limiter)
+
   while True:
-    requests_in_flight = requests_todo
+    deadlines.check()
+    batches = [
+        requests_todo[i:i + max_requests]
+        for i in range(0, len(requests_todo), max_requests)
+    ]
     requests_todo = []
-    results = []
-
-    # Do the batch API request
-    try:
-      batch = api.new_batch_http_request()
-      for i, req in enumerate(requests_in_flight):
-        batch.add(req, callback=fetch_all_cb, request_id=str(i))
-      batch.execute()
-    except (googleapiclient.errors.HttpError, httplib2.HttpLib2Error) as err:
-      if isinstance(err, googleapiclient.errors.HttpError):
-        error_msg = f'received HTTP error status code {err.status_code} from Batch API, retrying'
-      else:
-        error_msg = f'received exception from Batch API: {err}, retrying'
-      if (not isinstance(err, googleapiclient.errors.HttpError) or \
-          _should_retry(err.status_code)) \
-          and retry_count < config.API_RETRIES:
-        logging.debug(error_msg)
-        requests_todo = requests_in_flight
-        results = []
-      else:
-        raise utils.GcpApiError(err) from err
+    if len(batches) > 1:
+      batch_results = executor.get_executor().map(execute_batch, batches)
+    else:
+      batch_results = map(execute_batch, batches)
 
     # Yield results
-    yield from results
+    for results, retries in batch_results:
+      yield from results
+      requests_todo += retries
 
     # If no requests_todo, means we are done.
     if not requests_todo:
       break
 
-    # Retry delay: 20% is random, progression: 1, 1.4, 2.0, 2.7, ... 28.9 (10 retries)
-    sleep_time = (1 - random.random() * 0.2) * 1.4**retry_count
+    retry_count = min(retry_count for _, retry_count in requests_todo)
+    sleep_time = _retry_delay(retry_count - 1)
     logging.debug('sleeping %.2f seconds before retry #%d', sleep_time,
-                  retry_count + 1)
+                  retry_count)
+    remaining = deadlines.remaining()
+    if remaining is not None:
+      sleep_time = min(sleep_time, remaining)
     time.sleep(sleep_time)
-    retry_count += 1
+
+
+def execute_concurrently(requests: list):
+  """Execute all `requests` concurrently with the shared executor and yield
+  (request,response,exception) tuples, in the order of `requests`.
+
+  This is for requests that can't be grouped with the batch API, e.g. the list
+  requests of every region. Retryable errors (429, 5xx) are retried by
+  request.execute()."""
+  # the deadline of the rule is thread-local: it is passed to the workers.
+  deadline = deadlines.current()
+
+  def execute(request):
+    with deadlines.rule_deadline(deadline):
+      try:
+        return request, request.execute(num_retries=config.API_RETRIES), None
+      except Exception as err:  # pylint: disable=broad-except
+        return request, None, _wrap_error(err)
+
+  if requests:
+    yield from executor.get_executor().map(execute, requests)
+
+
+def _wrap_error(err: Exception) -> Exception:
+  if isinstance(err, googleapiclient.errors.HttpError):
+    return utils.GcpApiError(err)
+  return err
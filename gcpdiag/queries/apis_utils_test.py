@@ -13,9 +13,14 @@
 # limitations under the License.
 """Test code in apis_utils.py."""
 
+import threading
+import time
 from unittest import mock
 
-from gcpdiag import config, utils
+import httplib2
+import pytest
+
+from gcpdiag import config, deadlines, executor, tracing, utils
 from gcpdiag.queries import apis_stub, apis_utils
 
 
@@ -38,6 +43,43 @@ class RequestMock(apis_stub.ApiStub):
       return {'items': ['e']}
 
 
+class UriRequestMock(RequestMock):
+  """RequestMock with the uri attribute of googleapiclient.http.HttpRequest."""
+
+  uri = 'https://compute.googleapis.com/compute/v1/projects/p1/zones'
+
+
+class AggregatedRequestMock:
+  """Mock an aggregatedList request of the Compute API."""
+
+  def __init__(self, page: int):
+    self.page = page
+
+  def execute(self, num_retries: int = 0):
+    del num_retries
+    if self.page == 1:
+      return {
+          'items': {
+              'zones/a': {
+                  'instances': ['a1', 'a2']
+              },
+              'zones/b': {
+                  'warning': {
+                      'code': 'NO_RESULTS_ON_PAGE'
+                  }
+              }
+          },
+          'nextPageToken': 'page2'
+      }
+    return {'items': {'zones/a': {'instances': ['a3']}, 'regions/c': {}}}
+
+
+def aggregated_next_function_mock(previous_request, previous_response):
+  if previous_response.get('nextPageToken'):
+    return AggregatedRequestMock(previous_request.page + 1)
+  return None
+
+
 def next_function_mock(previous_request, previous_response):
   del previous_response
   if previous_request.n == 1:
@@ -61,6 +103,27 @@ class Test:
     results = list(apis_utils.list_all(RequestMock(1), next_function_mock))
     assert (results == ['a', 'b', 'c', 'd'])
 
+  def test_fields_mask(self):
+    assert apis_utils.fields_mask(
+        ('name', 'tags/items')) == 'items(name,tags/items),nextPageToken'
+    assert apis_utils.fields_mask(
+        ('name',),
+        'items/*/instances') == 'items/*/instances(name),nextPageToken'
+    assert apis_utils.fields_mask(('name',), 'clusters',
+                                  paged=False) == 'clusters(name)'
+
+  def test_aggregated_list_all(self):
+    results = list(
+        apis_utils.aggregated_list_all(AggregatedRequestMock(1),
+                                       aggregated_next_function_mock,
+                                       'instances'))
+    assert results == [('zones/a', 'a1'), ('zones/a', 'a2'), ('zones/a', 'a3')]
+
+  def test_list_all_deadline(self):
+    with deadlines.rule_deadline(time.monotonic()):
+      with pytest.raises(deadlines.DeadlineExceededError):
+        list(apis_utils.list_all(RequestMock(1), next_function_mock))
+
   def test_batch_list_all(self):
     api = apis_stub.get_api_stub('compute', 'v1')
     results = list(
@@ -134,3 +197,244 @@ class Test:
     assert [x[0].n for x in results] == [1, 3]
     # responses
     assert [x[1] for x in results] == [{'items': ['a', 'b']}, {'items': ['e']}]
+
+  @mock.patch('gcpdiag.config.API_BATCH_MAX_REQUESTS', new=2)
+  def test_batch_execute_all_chunks(self):
+    api = BatchCountingApiStub()
+    results = list(
+        apis_utils.batch_execute_all(
+            api, [RequestMock(i % 3 + 1) for i in range(5)]))
+    assert [x[0].n for x in results] == [1, 2, 3, 1, 2]
+    # (the batches are executed concurrently)
+    assert sorted(api.batch_sizes) == [1, 2, 2]
+
+  @mock.patch('gcpdiag.config.API_BATCH_MAX_REQUESTS', new=2)
+  def test_batch_execute_all_concurrent_batches(self):
+    barrier = threading.Barrier(2, timeout=10)
+
+    class BarrierRequestMock(RequestMock):
+
+      def execute(self, num_retries: int = 0):
+        barrier.wait()
+        return super().execute(num_retries)
+
+    api = apis_stub.get_api_stub('compute', 'v1')
+    # the second request of each batch only completes when the other batch is
+    # executed at the same time.
+    results = list(
+        apis_utils.batch_execute_all(api, [
+            RequestMock(1),
+            BarrierRequestMock(2),
+            RequestMock(3),
+            BarrierRequestMock(1)
+        ]))
+    assert [x[0].n for x in results] == [1, 2, 3, 1]
+
+  @mock.patch('gcpdiag.config.API_BATCH_MAX_REQUESTS', new=2)
+  def test_batch_execute_all_blocked_workers(self):
+    # e.g. all the workers wait for a singleflight call executed by the
+    # calling thread, which then executes the batches itself.
+    release = threading.Event()
+    with executor.NestedThreadPoolExecutor(max_workers=1) as pool, \
+        mock.patch('gcpdiag.executor.get_executor', return_value=pool):
+      blocker = pool.submit(release.wait, 30)
+      results = list(
+          apis_utils.batch_execute_all(
+              BatchCountingApiStub(),
+              [RequestMock(i % 3 + 1) for i in range(5)]))
+      release.set()
+      assert blocker.result(timeout=30)
+    assert [x[0].n for x in results] == [1, 2, 3, 1, 2]
+
+  @mock.patch('gcpdiag.config.API_BATCH_MAX_REQUESTS', new=2)
+  def test_batch_execute_all_retry_per_request(self):
+    global mock_sleep_slept_time
+    mock_sleep_slept_time = []
+    api = BatchCountingApiStub()
+    results = list(
+        apis_utils.batch_execute_all(api, [
+            RequestMock(1, fail_count=config.API_RETRIES, fail_status=429),
+            RequestMock(2),
+            RequestMock(3, fail_count=1, fail_status=503),
+        ]))
+    assert len(mock_sleep_slept_time) == config.API_RETRIES
+    # only the failed requests are retried, each with its own retry count
+    assert [x[0].n for x in results] == [2, 3, 1]
+    assert all(x[2] is None for x in results)
+    assert sorted(api.batch_sizes[:2]) == [1, 2]
+    assert api.batch_sizes[2:] == [2] + [1] * (config.API_RETRIES - 1)
+
+
+class BatchCountingApiStub:
+  """API stub recording the number of requests of every batch."""
+
+  def __init__(self):
+    self.batch_sizes = []
+
+  def new_batch_http_request(self):
+    api = self
+
+    class CountingBatchRequestStub(apis_stub.BatchRequestStub):
+
+      def execute(self):
+        api.batch_sizes.append(len(self.queue))
+        super().execute()
+
+    return CountingBatchRequestStub()
+
+
+class FakeHttp:
+  """httplib2.Http replacement answering all requests with `status`."""
+
+  def __init__(self, status):
+    self.status = status
+
+  def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+    del uri, method, body, headers, kwargs
+    return httplib2.Response({'status': str(self.status)}), b'{}'
+
+
+def _request_started(seconds_ago: float = 0.1) -> float:
+  return time.monotonic() - seconds_ago
+
+
+class TestConcurrencyLimiter:
+  """Test ConcurrencyLimiter and ConcurrencyLimitedHttp."""
+
+  def test_service_name(self):
+    assert apis_utils.service_name(
+        'https://compute.googleapis.com/compute/v1/projects/p1') == 'compute'
+    assert apis_utils.service_name(
+        'https://www.googleapis.com/compute/v1/projects/p1') == 'compute'
+    assert apis_utils.service_name(
+        'https://www.googleapis.com/batch/compute/v1') == 'compute'
+    assert apis_utils.service_name(
+        'https://logging.googleapis.com/v2/entries:list') == 'logging'
+
+  def test_additive_increase(self):
+    limiter = apis_utils.ConcurrencyLimiter('test', 4, 1, 6)
+    for _ in range(5):
+      limiter.acquire()
+      limiter.release(_request_started(), 200)
+    # +1/limit per successful request: about one per round-trip
+    assert limiter.limit == 5
+    for _ in range(100):
+      limiter.acquire()
+      limiter.release(_request_started(), 200)
+    assert limiter.limit == 6
+
+  def test_no_increase_when_slow(self):
+    limiter = apis_utils.ConcurrencyLimiter('test', 4, 1, 8)
+    limiter.acquire()
+    limiter.release(_request_started(0.1), 200)
+    for _ in range(10):
+      limiter.acquire()
+      limiter.release(_request_started(10), 200)
+    assert limiter.limit == 4
+
+  def test_multiplicative_decrease(self):
+    limiter = apis_utils.ConcurrencyLimiter('test', 8, 1, 8)
+    started = [limiter.acquire() for _ in range(3)]
+    limiter.release(started[0], 429)
+    assert limiter.limit == 4
+    # errors of requests started before the backoff are ignored
+    limiter.release(started[1], 503)
+    assert limiter.limit == 4
+    # 4xx errors other than 429 don't change the limit
+    limiter.release(started[2], 403)
+    assert limiter.limit == 4
+    limiter.acquire()
+    limiter.release(limiter.acquire(), 429)
+    assert limiter.limit == 2
+    for _ in range(10):
+      limiter.report_overload(time.monotonic())
+    assert limiter.limit == 1
+
+  def test_acquire_waits_for_free_slot(self):
+    limiter = apis_utils.ConcurrencyLimiter('test', 1, 1, 1)
+    start_time = limiter.acquire()
+    acquired = threading.Event()
+
+    def acquire():
+      limiter.release(limiter.acquire(), None)
+      acquired.set()
+
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    assert not acquired.wait(0.1)
+    limiter.release(start_time, 200)
+    assert acquired.wait(10)
+    thread.join()
+
+  def test_limited_http(self):
+    limiter = apis_utils.ConcurrencyLimiter('test', 4, 1, 4)
+    http = apis_utils.ConcurrencyLimitedHttp(FakeHttp(429))
+    with mock.patch('gcpdiag.queries.apis_utils.get_limiter',
+                    return_value=limiter):
+      resp, _ = http.request('https://compute.googleapis.com/compute/v1/x')
+    assert resp.status == 429
+    assert limiter.limit == 2
+
+  def test_limited_http_traced(self):
+    http = apis_utils.ConcurrencyLimitedHttp(FakeHttp(200))
+    tracing.start()
+    try:
+      http.request('https://compute.googleapis.com/compute/v1/x')
+      events = tracing.get_trace()['traceEvents']
+    finally:
+      tracing.stop()
+    span, = [e for e in events if e['ph'] == 'X']
+    assert span['name'] == 'GET compute'
+    assert span['cat'] == 'api'
+    assert span['args'] == {
+        'uri': 'https://compute.googleapis.com/compute/v1/x',
+        'status': 200
+    }
+
+  @mock.patch('time.sleep', new=mock_sleep)
+  def test_batch_execute_all_reports_overload(self):
+    limiter = apis_utils.ConcurrencyLimiter('compute', 8, 1, 8)
+    api = apis_stub.get_api_stub('compute', 'v1')
+    with mock.patch('gcpdiag.queries.apis_utils.get_limiter',
+                    return_value=limiter):
+      results = list(
+          apis_utils.batch_execute_all(api, [
+              UriRequestMock(1, fail_count=2, fail_status=429),
+              UriRequestMock(3)
+          ]))
+    assert len(results) == 2
+    # one backoff per failed batch
+    assert limiter.limit == 2
+
+
+class TestExecuteConcurrently:
+  """Test execute_concurrently."""
+
+  def test_execute_concurrently(self):
+    results = list(
+        apis_utils.execute_concurrently([
+            RequestMock(1),
+            RequestMock(3, fail_count=1, fail_status=403),
+            RequestMock(3)
+        ]))
+    assert [x[0].n for x in results] == [1, 3, 3]
+    assert results[0][1] == {'items': ['a', 'b']}
+    assert isinstance(results[1][2], utils.GcpApiError) and \
+        results[1][2].status == 403
+    assert results[2][1] == {'items': ['e']}
+
+  def test_execute_concurrently_deadline(self):
+
+    class DeadlineRequestMock(RequestMock):
+      deadline = None
+
+      def execute(self, num_retries: int = 0):
+        self.deadline = deadlines.current()
+        return super().execute(num_retries)
+
+    request = DeadlineRequestMock(1)
+    deadline = time.monotonic() + 60
+    with deadlines.rule_deadline(deadline):
+      list(apis_utils.execute_concurrently([request]))
+    # executed in another thread, with the deadline of the calling thread.
+    assert request.deadline == deadline
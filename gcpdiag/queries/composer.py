@@ -16,9 +16,8 @@
 import re
 from typing import Iterable, List, Tuple
 
-from gcpdiag import caching, config, models
-from gcpdiag.lint import get_executor
-from gcpdiag.queries import apis, crm
+from gcpdiag import caching, models
+from gcpdiag.queries import apis, apis_utils, crm
 
 
 class Environment(models.Resource):
@@ -80,19 +79,17 @@ COMPOSER_REGIONS = [
 ]
 
 
-def _query_region_envs(region, api, project_id):
-  query = api.projects().locations().environments().list(
-      parent=f'projects/{project_id}/locations/{region}')
-  resp = query.execute(num_retries=config.API_RETRIES)
-  return resp.get('environments', [])
-
-
 def _query_regions_envs(regions, api, project_id):
+  requests = [
+      api.projects().locations().environments().list(
+          parent=f'projects/{project_id}/locations/{region}')
+      for region in regions
+  ]
   result: List[Environment] = []
-  executor = get_executor()
-  for descriptions in executor.map(
-      lambda r: _query_region_envs(r, api, project_id), regions):
-    result += descriptions
+  for _, response, exception in apis_utils.execute_concurrently(requests):
+    if exception:
+      raise exception
+    result += response.get('environments', [])
   return result
 
 
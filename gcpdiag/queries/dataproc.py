@@ -16,8 +16,7 @@
 from typing import Iterable, List
 
 from gcpdiag import caching, config, models
-from gcpdiag.lint import get_executor
-from gcpdiag.queries import apis, crm, gce
+from gcpdiag.queries import apis, apis_utils, crm, gce
 
 
 class Cluster(models.Resource):
@@ -92,20 +91,20 @@ class Region:
     self.region = region
 
   def get_clusters(self) -> Iterable[Cluster]:
-    r = []
-    for cluster in self.query_api():
-      c = Cluster(name=cluster['clusterName'],
-                  project_id=self.project_id,
-                  resource_data=cluster)
-      r.append(c)
-    return r
+    return self.clusters_from_response(
+        self.list_request().execute(num_retries=config.API_RETRIES))
 
-  def query_api(self) -> Iterable[dict]:
+  def list_request(self):
     api = apis.get_api('dataproc', 'v1', self.project_id)
-    query = api.projects().regions().clusters().list(projectId=self.project_id,
-                                                     region=self.region)
-    resp = query.execute(num_retries=config.API_RETRIES)
-    return resp.get('clusters', [])
+    return api.projects().regions().clusters().list(projectId=self.project_id,
+                                                    region=self.region)
+
+  def clusters_from_response(self, resp: dict) -> List[Cluster]:
+    return [
+        Cluster(name=cluster['clusterName'],
+                project_id=self.project_id,
+                resource_data=cluster) for cluster in resp.get('clusters', [])
+    ]
 
 
 class Dataproc:
@@ -131,8 +130,11 @@ def get_clusters(context: models.Context) -> Iterable[Cluster]:
   dataproc = Dataproc(context.project_id)
   if not dataproc.is_api_enabled():
     return r
-  executor = get_executor()
-  for clusters in executor.map(lambda r: r.get_clusters(),
-                               dataproc.get_regions()):
-    r += clusters
+  regions = dataproc.get_regions()
+  results = apis_utils.execute_concurrently(
+      [region.list_request() for region in regions])
+  for region, (_, response, exception) in zip(regions, results):
+    if exception:
+      raise exception
+    r += region.clusters_from_response(response)
   return r
@@ -15,11 +15,13 @@
 # Lint as: python3
 """Queries related to GCP Kubernetes Engine clusters."""
 
+import functools
 import ipaddress
 import logging
 import re
 from datetime import datetime, timezone
-from typing import Dict, Iterable, List, Mapping, Optional, Set
+from typing import (Dict, Iterable, Iterator, List, Mapping, Optional, Set,
+                    Tuple, Type)
 
 import googleapiclient.errors
 
@@ -31,6 +33,9 @@ from gcpdiag.queries import network as network_q
 class InstanceTemplate(models.Resource):
   """Represents a GCE Instance Template."""
   _resource_data: dict
+  RESOURCE_FIELDS = ('name', 'selfLink', 'properties/tags',
+                     'properties/networkInterfaces',
+                     'properties/serviceAccounts')
 
   def __init__(self, project_id, resource_data):
     super().__init__(project_id=project_id)
@@ -88,6 +93,7 @@ class InstanceTemplate(models.Resource):
 class InstanceGroup(models.Resource):
   """Represents a GCE instance group."""
   _resource_data: dict
+  RESOURCE_FIELDS = ('name', 'selfLink', 'namedPorts')
 
   def __init__(self, project_id, resource_data):
     super().__init__(project_id=project_id)
@@ -131,6 +137,8 @@ class ManagedInstanceGroup(models.Resource):
   """Represents a GCE managed instance group."""
   _resource_data: dict
   _region: Optional[str]
+  RESOURCE_FIELDS = ('id', 'name', 'selfLink', 'region', 'zone',
+                     'baseInstanceName', 'instanceTemplate')
 
   def __init__(self, project_id, resource_data):
     super().__init__(project_id=project_id)
@@ -219,6 +227,11 @@ class Instance(models.Resource):
   """Represents a GCE instance."""
   _resource_data: dict
   _region: Optional[str]
+  RESOURCE_FIELDS = ('id', 'name', 'selfLink', 'creationTimestamp', 'zone',
+                     'labels', 'disks/guestOsFeatures',
+                     'networkInterfaces/network', 'networkInterfaces/networkIP',
+                     'shieldedInstanceConfig/enableSecureBoot',
+                     'serviceAccounts', 'tags/items', 'metadata/items')
 
   def __init__(self, project_id, resource_data):
     super().__init__(project_id=project_id)
@@ -334,12 +347,15 @@ class Instance(models.Resource):
 
   def get_metadata(self, key: str) -> str:
     if not self._metadata_dict:
-      self._metadata_dict = {}
+      # build the dict before setting it, so that concurrent callers don't
+      # get a partial dict.
+      metadata_dict = {}
       if 'metadata' in self._resource_data and 'items' in self._resource_data[
           'metadata']:
         for item in self._resource_data['metadata']['items']:
           if 'key' in item and 'value' in item:
-            self._metadata_dict[item['key']] = item['value']
+            metadata_dict[item['key']] = item['value']
+      self._metadata_dict = metadata_dict
     project_metadata = get_project_metadata(self.project_id)
     return self._metadata_dict.get(key, project_metadata.get(key))
 
@@ -382,6 +398,8 @@ class Instance(models.Resource):
 class Disk(models.Resource):
   """Represents a GCE disk."""
   _resource_data: dict
+  RESOURCE_FIELDS = ('id', 'name', 'selfLink', 'zone', 'guestOsFeatures',
+                     'users')
 
   def __init__(self, project_id, resource_data):
     super().__init__(project_id=project_id)
@@ -439,6 +457,61 @@ def get_gce_zones(project_id: str) -> Set[str]:
     raise utils.GcpApiError(err) from err
 
 
+def _get_resource_data(project_id: str, collection: str, zone: Optional[str],
+                       name: str) -> dict:
+  """Fetch the full data of a resource that was listed with a field mask."""
+  gce_api = apis.get_api('compute', 'v1', project_id)
+  # the resource parameter is the singular of the collection, e.g. 'instance'.
+  kwargs = {collection[:-1]: name}
+  if zone:
+    kwargs['zone'] = zone
+  request = getattr(gce_api, collection)().get(project=project_id, **kwargs)
+  try:
+    return request.execute(num_retries=config.API_RETRIES)
+  except googleapiclient.errors.HttpError as err:
+    raise utils.GcpApiError(err) from err
+
+
+def _partial_resource_data(resource_class: Type[models.Resource],
+                           project_id: str, collection: str,
+                           zone: Optional[str],
+                           item: dict) -> models.PartialResourceData:
+  return models.PartialResourceData(
+      item, resource_class.RESOURCE_FIELDS or (),
+      functools.partial(_get_resource_data, project_id, collection, zone,
+                        item['name']))
+
+
+def _list_zonal_resources(
+    project_id: str,
+    collection: str,
+    resource_class: Type[models.Resource],
+    log_text: str,
+    context: Optional[models.Context] = None) -> Iterator[Tuple[str, dict]]:
+  """List the resources of `collection` (e.g. 'instances') in all the zones
+  with a single aggregatedList request (and its pages), instead of one request
+  per zone, and yield (zone, resource) tuples.
+
+  Only the RESOURCE_FIELDS of `resource_class` are fetched (the resource data
+  is a models.PartialResourceData). Regional resources are skipped, as well as
+  the zones that don't match the regions of `context`."""
+  gce_api = apis.get_api('compute', 'v1', project_id)
+  collection_api = getattr(gce_api, collection)()
+  logging.info(log_text)
+  fields = apis_utils.fields_mask(resource_class.RESOURCE_FIELDS or (),
+                                  f'items/*/{collection}')
+  request = collection_api.aggregatedList(project=project_id, fields=fields)
+  for scope, item in apis_utils.aggregated_list_all(
+      request, collection_api.aggregatedList_next, collection):
+    if not scope.startswith('zones/'):
+      continue
+    zone = scope[len('zones/'):]
+    if context and not context.match_project_location(zone):
+      continue
+    yield zone, _partial_resource_data(resource_class, project_id, collection,
+                                       zone, item)
+
+
 @caching.cached_api_call(in_memory=True)
 def get_instances(context: models.Context) -> Mapping[str, Instance]:
   """Get a list of Instance matching the given context, indexed by instance id."""
@@ -446,25 +519,9 @@ def get_instances(context: models.Context) -> Mapping[str, Instance]:
   instances: Dict[str, Instance] = {}
   if not apis.is_enabled(context.project_id, 'compute'):
     return instances
-  gce_api = apis.get_api('compute', 'v1', context.project_id)
-  requests = [
-      gce_api.instances().list(project=context.project_id, zone=zone)
-      for zone in get_gce_zones(context.project_id)
-  ]
-  items = apis_utils.batch_list_all(
-      api=gce_api,
-      requests=requests,
-      next_function=gce_api.instances().list_next,
-      log_text=f'listing gce instances of project {context.project_id}')
-  for i in items:
-    result = re.match(
-        r'https://www.googleapis.com/compute/v1/projects/[^/]+/zones/([^/]+)/',
-        i['selfLink'])
-    if not result:
-      logging.error('instance %s selfLink didn\'t match regexp: %s', i['id'],
-                    i['selfLink'])
-      continue
-    zone = result.group(1)
+  for zone, i in _list_zonal_resources(
+      context.project_id, 'instances', Instance,
+      f'listing gce instances of project {context.project_id}', context):
     labels = i.get('labels', {})
     if not context.match_project_resource(location=zone, labels=labels):
       continue
@@ -479,17 +536,9 @@ def get_instance_groups(context: models.Context) -> Mapping[str, InstanceGroup]:
   groups: Dict[str, InstanceGroup] = {}
   if not apis.is_enabled(context.project_id, 'compute'):
     return groups
-  gce_api = apis.get_api('compute', 'v1', context.project_id)
-  requests = [
-      gce_api.instanceGroups().list(project=context.project_id, zone=zone)
-      for zone in get_gce_zones(context.project_id)
-  ]
-  items = apis_utils.batch_list_all(
-      api=gce_api,
-      requests=requests,
-      next_function=gce_api.instanceGroups().list_next,
-      log_text=f'listing gce instances of project {context.project_id}')
-  for i in items:
+  for _, i in _list_zonal_resources(
+      context.project_id, 'instanceGroups', InstanceGroup,
+      f'listing gce instance groups of project {context.project_id}', context):
     groups[i['name']] = InstanceGroup(context.project_id, i)
   return groups
 
@@ -502,36 +551,21 @@ def get_managed_instance_groups(
   migs: Dict[int, ManagedInstanceGroup] = {}
   if not apis.is_enabled(context.project_id, 'compute'):
     return migs
-  gce_api = apis.get_api('compute', 'v1', context.project_id)
-  requests = [
-      gce_api.instanceGroupManagers().list(project=context.project_id,
-                                           zone=zone)
-      for zone in get_gce_zones(context.project_id)
-  ]
-  items = apis_utils.batch_list_all(
-      api=gce_api,
-      requests=requests,
-      next_function=gce_api.instanceGroupManagers().list_next,
-      log_text=f'listing managed instance groups of project {context.project_id}'
-  )
-  for i in items:
-    result = re.match(
-        r'https://www.googleapis.com/compute/v1/projects/[^/]+/(?:regions|zones)/([^/]+)/',
-        i['selfLink'])
-    if not result:
-      logging.error('mig %s selfLink didn\'t match regexp: %s', i['name'],
-                    i['selfLink'])
-      continue
-    location = result.group(1)
-    labels = i.get('labels', {})
-    if not context.match_project_resource(location=location, labels=labels):
+  for zone, i in _list_zonal_resources(
+      context.project_id, 'instanceGroupManagers', ManagedInstanceGroup,
+      f'listing managed instance groups of project {context.project_id}',
+      context):
+    # instance group managers have no labels (and reading a key that isn't in
+    # RESOURCE_FIELDS would fetch the full resource).
+    if not context.match_project_resource(location=zone, labels={}):
       continue
     migs[i['id']] = ManagedInstanceGroup(project_id=context.project_id,
                                          resource_data=i)
   return migs
 
 
-@caching.cached_api_call
+@caching.cached_api_call(expire=config.CACHE_STALE_EXPIRY_SECONDS,
+                         revalidate_after=config.CACHE_REVALIDATE_AFTER_SECONDS)
 def get_instance_templates(project_id: str) -> Mapping[str, InstanceTemplate]:
   logging.info('fetching instance templates')
   templates = {}
@@ -539,18 +573,20 @@ def get_instance_templates(project_id: str) -> Mapping[str, InstanceTemplate]:
   request = gce_api.instanceTemplates().list(
       project=project_id,
       returnPartialSuccess=True,
-      # Fetch only a subset of the fields to improve performance.
-      fields=
-      ('items/name, items/properties/tags, items/properties/networkInterfaces, '
-       'items/properties/serviceAccounts'),
+      # Fetch only the fields used by InstanceTemplate to improve performance.
+      fields=apis_utils.fields_mask(InstanceTemplate.RESOURCE_FIELDS),
   )
   for t in apis_utils.list_all(
       request, next_function=gce_api.instanceTemplates().list_next):
-    templates[t['name']] = InstanceTemplate(project_id, t)
+    templates[t['name']] = InstanceTemplate(
+        project_id,
+        _partial_resource_data(InstanceTemplate, project_id,
+                               'instanceTemplates', None, t))
   return templates
 
 
-@caching.cached_api_call
+@caching.cached_api_call(expire=config.CACHE_STALE_EXPIRY_SECONDS,
+                         revalidate_after=config.CACHE_REVALIDATE_AFTER_SECONDS)
 def get_project_metadata(project_id) -> Mapping[str, str]:
   gce_api = apis.get_api('compute', 'v1', project_id)
   logging.info('fetching metadata of project %s', project_id)
@@ -642,19 +678,8 @@ def get_regions_with_instances(context: models.Context) -> Iterable[Region]:
 
 @caching.cached_api_call
 def get_all_disks(project_id: str) -> Iterable[Disk]:
-  try:
-    gce_api = apis.get_api('compute', 'v1', project_id)
-    requests = [
-        gce_api.disks().list(project=project_id, zone=zone)
-        for zone in get_gce_zones(project_id)
-    ]
-    items = apis_utils.batch_list_all(
-        api=gce_api,
-        requests=requests,
-        next_function=gce_api.disks().list_next,
-        log_text=f'listing gce disks of project {project_id}')
-
-    return {Disk(project_id, item) for item in items}
-
-  except googleapiclient.errors.HttpError as err:
-    raise utils.GcpApiError(err) from err
+  return {
+      Disk(project_id, item) for _, item in _list_zonal_resources(
+          project_id, 'disks', Disk,
+          f'listing gce disks of project {project_id}')
+  }
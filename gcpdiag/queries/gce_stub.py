@@ -30,11 +30,14 @@ class ComputeEngineApiStub(apis_stub.ApiStub):
   # mocked methods:
   # gce_api.zones().list(project=project_id).execute()
   # gce_api.zones().list_next(request, response)
-  # op1=gce_api.instances().list(project=pid, zone=z)
+  # gce_api.instances().aggregatedList(project=project_id)
+  # gce_api.instances().aggregatedList_next(request, response)
+  # gce_api.instanceGroupManagers().aggregatedList(project=project_id)
+  # gce_api.instanceGroups().aggregatedList(project=project_id)
+  # gce_api.disks().aggregatedList(project=project_id)
+  # gce_api.instances().get(project=project_id, zone=zone, instance=name)
+  # gce_api.instanceTemplates().get(project=project_id, instanceTemplate=name)
   # gce_api.new_batch_http_request().add(op1, callback=cb, request_id=id).execute()
-  # gce_api.instanceGroupManagers().list(project=project_id, zone=zone)
-  # gce_api.instanceGroups().list(project=project_id, zone=zone)
-  # gce_api.disks().list(project=project_id, zone=zone)
 
   def __init__(self, mock_state='init', project_id=None, zone=None, page=1):
     self.mock_state = mock_state
@@ -52,26 +55,37 @@ class ComputeEngineApiStub(apis_stub.ApiStub):
     return ComputeEngineApiStub('disks')
 
   def list(self, project, zone=None, returnPartialSuccess=None, fields=None):
-    # TODO: implement fields filtering
-    if self.mock_state in ['igs', 'instances', 'migs', 'disks']:
+    if self.mock_state in ['regions', 'templates', 'zones']:
       return apis_stub.RestCallStub(project,
-                                    f'compute-{self.mock_state}-{zone}',
-                                    default=f'compute-{self.mock_state}-empty')
-    elif self.mock_state in ['regions', 'templates', 'zones']:
-      return apis_stub.RestCallStub(project, f'compute-{self.mock_state}')
+                                    f'compute-{self.mock_state}',
+                                    fields=fields)
     else:
       raise RuntimeError(f"can't list for mock state {self.mock_state}")
 
+  def aggregatedList(self, project, returnPartialSuccess=None, fields=None):
+    if self.mock_state in ['igs', 'instances', 'migs', 'disks']:
+      return apis_stub.RestCallStub(project,
+                                    f'compute-{self.mock_state}-aggregated',
+                                    default={},
+                                    fields=fields)
+    else:
+      raise RuntimeError(
+          f"can't list aggregated for mock state {self.mock_state}")
+
   def list_next(self, previous_request, previous_response):
     if isinstance(previous_response,
                   dict) and previous_response.get('nextPageToken'):
       return apis_stub.RestCallStub(
           project_id=previous_request.project_id,
           json_basename=previous_request.json_basename,
-          page=previous_request.page + 1)
+          page=previous_request.page + 1,
+          fields=previous_request.fields)
     else:
       return None
 
+  def aggregatedList_next(self, previous_request, previous_response):
+    return self.list_next(previous_request, previous_response)
+
   def instances(self):
     return ComputeEngineApiStub('instances')
 
@@ -91,9 +105,21 @@ class ComputeEngineApiStub(apis_stub.ApiStub):
       self._fail_count = 0
     return batch_api
 
-  def get(self, project):
+  def get(self, project, zone=None, **kwargs):
     if self.mock_state == 'projects':
       return apis_stub.RestCallStub(project, 'compute-project')
+    # resource name, e.g. instance=name
+    (name,) = kwargs.values()
+
+    def match(item):
+      return item.get('name') == name and (zone is None or item.get(
+          'zone', '').endswith(f'/zones/{zone}'))
+
+    if self.mock_state == 'templates':
+      return apis_stub.ListItemCallStub(project, 'compute-templates', match)
+    return apis_stub.ListItemCallStub(project,
+                                      f'compute-{self.mock_state}-aggregated',
+                                      match)
 
   def projects(self):
     return ComputeEngineApiStub('projects')
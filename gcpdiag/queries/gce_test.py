@@ -19,7 +19,7 @@ import re
 from unittest import mock
 
 from gcpdiag import models
-from gcpdiag.queries import apis_stub, gce
+from gcpdiag.queries import apis_stub, apis_utils, gce
 
 DUMMY_REGION = 'europe-west4'
 DUMMY_ZONE = 'europe-west4-a'
@@ -32,6 +32,25 @@ DUMMY_INSTANCE2_NAME = 'gce2'
 DUMMY_INSTANCE3_LABELS = {'gcp_doctor_test': 'gke'}
 
 
+def _list_items(json_basename, collection, fields=None):
+  """Return the items of a (possibly aggregated) list JSON dump and pages."""
+  items = []
+  for page in range(1, 10):
+    try:
+      response = apis_stub.RestCallStub(DUMMY_PROJECT_NAME,
+                                        json_basename,
+                                        page=page,
+                                        fields=fields).execute()
+    except FileNotFoundError:
+      break
+    if isinstance(response['items'], list):
+      items += response['items']
+    else:
+      for scoped_list in response['items'].values():
+        items += scoped_list.get(collection, [])
+  return items
+
+
 @mock.patch('gcpdiag.queries.apis.get_api', new=apis_stub.get_api_stub)
 class TestGce:
   """Test code in gce.py"""
@@ -156,6 +175,12 @@ class TestGce:
         p['name'] for p in groups['instance-group-1'].named_ports
     ]
 
+  def test_get_instance_groups_by_other_region(self):
+    context = models.Context(project_id=DUMMY_PROJECT_NAME,
+                             regions=['europe-west1'])
+    groups = gce.get_instance_groups(context)
+    assert list(groups) == ['gke-gke1-default-pool-35923fbc-grp']
+
   def test_get_managed_instance_groups(self):
     context = models.Context(project_id=DUMMY_PROJECT_NAME,
                              regions=['europe-west4'])
@@ -222,8 +247,55 @@ class TestGce:
     for n in {i.mig for i in gce.get_instances(context).values()}:
       assert n.template.name.startswith('gke-')
 
+  def test_resource_fields(self):
+    """RESOURCE_FIELDS must be valid API fields and include all the fields
+    used by the resource classes."""
+    for resource_class, schema, json_basename, collection in [
+        (gce.Instance, 'Instance', 'compute-instances-aggregated', 'instances'),
+        (gce.Disk, 'Disk', 'compute-disks-aggregated', 'disks'),
+        (gce.InstanceGroup, 'InstanceGroup', 'compute-igs-aggregated',
+         'instanceGroups'),
+        (gce.ManagedInstanceGroup, 'InstanceGroupManager',
+         'compute-migs-aggregated', 'instanceGroupManagers'),
+        (gce.InstanceTemplate, 'InstanceTemplate', 'compute-templates',
+         'items'),
+    ]:
+      assert not apis_stub.get_fields_not_in_schema(resource_class, 'compute',
+                                                    'v1', schema)
+      fields = apis_utils.fields_mask(resource_class.RESOURCE_FIELDS,
+                                      f'items/*/{collection}')
+      if collection == 'items':
+        fields = apis_utils.fields_mask(resource_class.RESOURCE_FIELDS)
+      full_items = _list_items(json_basename, collection)
+      masked_items = _list_items(json_basename, collection, fields)
+      assert full_items and len(full_items) == len(masked_items)
+      for full, masked in zip(full_items, masked_items):
+        fetch_full = mock.Mock(return_value=full)
+        partial = models.PartialResourceData(masked,
+                                             resource_class.RESOURCE_FIELDS,
+                                             fetch_full)
+        assert apis_stub.get_accessor_values(
+            resource_class(DUMMY_PROJECT_NAME, partial)) == \
+            apis_stub.get_accessor_values(
+                resource_class(DUMMY_PROJECT_NAME, full))
+        fetch_full.assert_not_called()
+
+  def test_resource_fields_fallback(self):
+    """Fields that are not in RESOURCE_FIELDS are fetched with a get request."""
+    context = models.Context(project_id=DUMMY_PROJECT_NAME,
+                             regions=[DUMMY_REGION],
+                             labels=[DUMMY_INSTANCE1_LABELS])
+    with mock.patch.object(gce.Instance, 'RESOURCE_FIELDS',
+                           ('id', 'name', 'selfLink')):
+      instances = gce.get_instances(context)
+    (instance,) = instances.values()
+    assert instance.name == DUMMY_INSTANCE1_NAME
+    assert instance.region == DUMMY_REGION
+    assert instance.network.name == DUMMY_DEFAULT_NAME
+
   def test_get_all_disks(self):
     disks = gce.get_all_disks(DUMMY_PROJECT_NAME)
+    assert len(disks) == 9
     for d in disks:
       assert d.bootable is True
       if 'unattached-disk' == d.name:
@@ -25,7 +25,7 @@ import googleapiclient.errors
 from boltons.iterutils import get_path
 
 from gcpdiag import caching, config, models, utils
-from gcpdiag.queries import apis, crm, gce, network
+from gcpdiag.queries import apis, apis_utils, crm, gce, network
 from gcpdiag.utils import Version
 
 
@@ -173,6 +173,15 @@ class Cluster(models.Resource):
   """
   _resource_data: dict
   master_version: Version
+  RESOURCE_FIELDS = ('id', 'name', 'location', 'locations', 'resourceLabels',
+                     'currentMasterVersion', 'currentNodeCount',
+                     'clusterIpv4Cidr', 'releaseChannel',
+                     'autoscaling/autoprovisioningNodePoolDefaults/imageType',
+                     'databaseEncryption', 'loggingService',
+                     'monitoringService', 'authenticatorGroupsConfig',
+                     'workloadIdentityConfig', 'addonsConfig/httpLoadBalancing',
+                     'networkConfig', 'privateClusterConfig', 'autopilot',
+                     'nodePools')
 
   def __init__(self, project_id, resource_data):
     super().__init__(project_id=project_id)
@@ -266,9 +275,11 @@ class Cluster(models.Resource):
   @property
   def nodepools(self) -> Iterable[NodePool]:
     if self._nodepools is None:
-      self._nodepools = []
-      for n in self._resource_data.get('nodePools', []):
-        self._nodepools.append(NodePool(self, n))
+      # build the list before setting it, so that concurrent callers don't
+      # get a partial list.
+      self._nodepools = [
+          NodePool(self, n) for n in self._resource_data.get('nodePools', [])
+      ]
     return self._nodepools
 
   @property
@@ -338,6 +349,17 @@ class Cluster(models.Resource):
     raise UndefinedClusterPropertyError('no id')
 
 
+def _get_cluster_data(project_id: str, location: str, name: str) -> dict:
+  """Fetch the full data of a cluster that was listed with a field mask."""
+  container_api = apis.get_api('container', 'v1', project_id)
+  query = container_api.projects().locations().clusters().get(
+      name=f'projects/{project_id}/locations/{location}/clusters/{name}')
+  try:
+    return query.execute(num_retries=config.API_RETRIES)
+  except googleapiclient.errors.HttpError as err:
+    raise utils.GcpApiError(err) from err
+
+
 @caching.cached_api_call
 def get_clusters(context: models.Context) -> Mapping[str, Cluster]:
   """Get a list of Cluster matching the given context, indexed by cluster full path."""
@@ -348,7 +370,11 @@ def get_clusters(context: models.Context) -> Mapping[str, Cluster]:
   logging.info('fetching list of GKE clusters in project %s',
                context.project_id)
   query = container_api.projects().locations().clusters().list(
-      parent=f'projects/{context.project_id}/locations/-')
+      parent=f'projects/{context.project_id}/locations/-',
+      # Fetch only the fields used by Cluster to improve performance.
+      fields=apis_utils.fields_mask(Cluster.RESOURCE_FIELDS,
+                                    'clusters',
+                                    paged=False))
   try:
     resp = query.execute(num_retries=config.API_RETRIES)
     if 'clusters' not in resp:
@@ -361,7 +387,11 @@ def get_clusters(context: models.Context) -> Mapping[str, Cluster]:
       if not context.match_project_resource(
           location=resp_c['location'], labels=resp_c.get('resourceLabels')):
         continue
-      c = Cluster(project_id=context.project_id, resource_data=resp_c)
+      resource_data = models.PartialResourceData(
+          resp_c, Cluster.RESOURCE_FIELDS,
+          functools.partial(_get_cluster_data, context.project_id,
+                            resp_c['location'], resp_c['name']))
+      c = Cluster(project_id=context.project_id, resource_data=resource_data)
       clusters[c.full_path] = c
   except googleapiclient.errors.HttpError as err:
     raise utils.GcpApiError(err) from err
@@ -49,7 +49,19 @@ class ContainerApiStub(apis_stub.ApiStub):
     return apis_stub.RestCallStub(project_id,
                                   f'container-server-config-{region}')
 
-  def list(self, parent):
+  def list(self, parent, fields=None):
     m = re.match(r'projects/([^/]+)/', parent)
     project_id = m.group(1)
-    return apis_stub.RestCallStub(project_id, 'container-clusters')
+    return apis_stub.RestCallStub(project_id,
+                                  'container-clusters',
+                                  fields=fields)
+
+  def get(self, name):
+    m = re.match(r'projects/([^/]+)/locations/([^/]+)/clusters/([^/]+)$', name)
+    project_id, location, cluster_name = m.group(1), m.group(2), m.group(3)
+
+    def match(item):
+      return item.get('name') == cluster_name and item.get(
+          'location') == location
+
+    return apis_stub.ListItemCallStub(project_id, 'container-clusters', match)
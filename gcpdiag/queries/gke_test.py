@@ -23,7 +23,7 @@ import pytest
 from packaging.version import LegacyVersion
 
 from gcpdiag import models
-from gcpdiag.queries import apis_stub, gce, gke
+from gcpdiag.queries import apis_stub, apis_utils, gce, gke
 from gcpdiag.queries.gke import Version
 
 DUMMY_PROJECT_NAME = 'gcpdiag-gke1-aaaa'
@@ -72,6 +72,42 @@ class TestCluster:
     assert c.name == 'gke4'
     assert c.release_channel == 'REGULAR'
 
+  def test_resource_fields(self):
+    """RESOURCE_FIELDS must be valid API fields and include all the fields
+    used by Cluster."""
+    assert not apis_stub.get_fields_not_in_schema(gke.Cluster, 'container',
+                                                  'v1', 'Cluster')
+    fields = apis_utils.fields_mask(gke.Cluster.RESOURCE_FIELDS,
+                                    'clusters',
+                                    paged=False)
+    full = apis_stub.RestCallStub(DUMMY_PROJECT_NAME,
+                                  'container-clusters').execute()
+    masked = apis_stub.RestCallStub(DUMMY_PROJECT_NAME,
+                                    'container-clusters',
+                                    fields=fields).execute()
+    for full_c, masked_c in zip(full['clusters'], masked['clusters']):
+      fetch_full = mock.Mock(return_value=full_c)
+      partial = models.PartialResourceData(masked_c,
+                                           gke.Cluster.RESOURCE_FIELDS,
+                                           fetch_full)
+      assert apis_stub.get_accessor_values(
+          gke.Cluster(DUMMY_PROJECT_NAME, partial)) == \
+          apis_stub.get_accessor_values(gke.Cluster(DUMMY_PROJECT_NAME, full_c))
+      fetch_full.assert_not_called()
+
+  def test_resource_fields_fallback(self):
+    """Fields that are not in RESOURCE_FIELDS are fetched with a get request."""
+    context = models.Context(project_id=DUMMY_PROJECT_NAME,
+                             regions=['europe-west4'],
+                             labels=[DUMMY_CLUSTER1_LABELS])
+    with mock.patch.object(
+        gke.Cluster, 'RESOURCE_FIELDS',
+        ('name', 'location', 'resourceLabels', 'currentMasterVersion')):
+      clusters = gke.get_clusters(context)
+    c = clusters[DUMMY_CLUSTER1_NAME]
+    assert c.pod_ipv4_cidr.prefixlen > 0
+    assert [np.name for np in c.nodepools] == ['default-pool']
+
   def test_get_path_regional(self):
     """full_path and short_path should return correct results with regional clusters."""
     context = models.Context(project_id=DUMMY_PROJECT_NAME)
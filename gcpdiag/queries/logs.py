@@ -40,12 +40,13 @@ import concurrent.futures
 import dataclasses
 import datetime
 import logging
+import threading
 from typing import Any, Dict, Mapping, Optional, Sequence, Set, Tuple
 
 import dateutil.parser
 import ratelimit
 
-from gcpdiag import caching, config
+from gcpdiag import caching, config, deadlines, tracing
 from gcpdiag.queries import apis
 
 
@@ -79,6 +80,8 @@ class LogsQuery:
     return self.job.future.result()
 
 
+# query() is called concurrently by the prepare_rule functions.
+_jobs_lock = threading.Lock()
 jobs_todo: Dict[Tuple[str, str, str], _LogsQueryJob] = {}
 
 
@@ -86,15 +89,17 @@ def query(project_id: str, resource_type: str, log_name: str,
           filter_str: str) -> LogsQuery:
   # Aggregate by project_id, resource_type, log_name
   job_key = (project_id, resource_type, log_name)
-  job = jobs_todo.setdefault(
-      job_key,
-      _LogsQueryJob(
+  with _jobs_lock:
+    job = jobs_todo.get(job_key)
+    if job is None:
+      job = _LogsQueryJob(
           project_id=project_id,
           resource_type=resource_type,
           log_name=log_name,
           filters=set(),
-      ))
-  job.filters.add(filter_str)
+      )
+      jobs_todo[job_key] = job
+    job.filters.add(filter_str)
   return LogsQuery(job=job)
 
 
@@ -106,7 +111,7 @@ def _ratelimited_execute(req):
   return req.execute(num_retries=config.API_RETRIES)
 
 
-def _execute_query_job(job: _LogsQueryJob):
+def _execute_query_job(job: _LogsQueryJob, store: caching.SegmentStore):
   logging_api = apis.get_api('logging', 'v2', job.project_id)
 
   # Convert "within" relative time to an absolute timestamp.
@@ -130,8 +135,9 @@ def _execute_query_job(job: _LogsQueryJob):
   filter_str = '\n'.join(filter_lines)
   logging.info('searching logs in project %s (resource type: %s)',
                job.project_id, job.resource_type)
-  # Fetch all logs and put the results in temporary storage (diskcache.Deque)
-  deque = caching.get_tmp_deque('tmp-logs-')
+  # Fetch all logs and put the results in temporary storage (one segment file
+  # shared by all the jobs, written one page at a time).
+  deque = store.new_sequence()
   req = logging_api.entries().list(
       body={
           'resourceNames': [f'projects/{job.project_id}'],
@@ -143,12 +149,12 @@ def _execute_query_job(job: _LogsQueryJob):
   query_pages = 0
   query_start_time = datetime.datetime.now()
   while req is not None:
+    deadlines.check()
     query_pages += 1
     res = _ratelimited_execute(req)
     if 'entries' in res:
-      for e in res['entries']:
-        fetched_entries_count += 1
-        deque.appendleft(e)
+      fetched_entries_count += len(res['entries'])
+      deque.extendleft(res['entries'])
 
     # Verify that we aren't above limits, exit otherwise.
     if fetched_entries_count > config.get('logging_fetch_max_entries'):
@@ -180,10 +186,15 @@ def _execute_query_job(job: _LogsQueryJob):
 
 def execute_queries(executor: concurrent.futures.Executor):
   global jobs_todo
-  jobs_executing = jobs_todo
-  jobs_todo = {}
+  with _jobs_lock:
+    jobs_executing = jobs_todo
+    jobs_todo = {}
+  store = caching.SegmentStore('tmp-logs-')
   for job in jobs_executing.values():
-    job.future = executor.submit(_execute_query_job, job)
+    job.future = executor.submit(
+        tracing.traced(_execute_query_job,
+                       f'logs {job.project_id} {job.resource_type}', 'logs'),
+        job, store)
 
 
 def log_entry_timestamp(log_entry: Mapping[str, Any]) -> datetime.datetime:
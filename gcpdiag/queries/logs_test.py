@@ -70,6 +70,23 @@ class TestLogs:
         'projects/gcpdiag-gke1-aaaa'
     ]
 
+  @mock.patch.object(logs, 'jobs_todo', {})
+  def test_concurrent_queries(self):
+    """Verify that query() can be called from multiple threads."""
+
+    def add_queries(i):
+      for n in range(100):
+        logs.query(project_id=DUMMY_PROJECT_ID,
+                   resource_type=f'type{n % 2}',
+                   log_name='fake.log',
+                   filter_str=f'filter-{i}-{n}')
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+      list(executor.map(add_queries, range(8)))
+    assert sorted(logs.jobs_todo) == [(DUMMY_PROJECT_ID, 'type0', 'fake.log'),
+                                      (DUMMY_PROJECT_ID, 'type1', 'fake.log')]
+    assert sum(len(job.filters) for job in logs.jobs_todo.values()) == 800
+
   def test_format_log_entry(self):
     with mock.patch.dict('os.environ', {'TZ': 'America/Los_Angeles'}):
       time.tzset()
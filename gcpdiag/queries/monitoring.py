@@ -23,7 +23,7 @@ from typing import Any, List, Mapping
 
 import googleapiclient.errors
 
-from gcpdiag import config, utils
+from gcpdiag import config, deadlines, utils
 from gcpdiag.queries import apis
 
 
@@ -174,6 +174,7 @@ def query(project_id: str, query_str: str) -> TimeSeriesCollection:
     pages = 0
     start_time = datetime.datetime.now()
     while request:
+      deadlines.check()
       pages += 1
       response = request.execute(num_retries=config.API_RETRIES)
       time_series.add_api_response(response)
@@ -631,7 +631,8 @@ class EffectiveFirewalls:
     return self._vpc_firewall.verify_ingress_rule_exists(name)
 
 
-@caching.cached_api_call()
+@caching.cached_api_call(expire=config.CACHE_STALE_EXPIRY_SECONDS,
+                         revalidate_after=config.CACHE_REVALIDATE_AFTER_SECONDS)
 def _get_effective_firewalls(network: Network):
   compute = apis.get_api('compute', 'v1', network.project_id)
   request = compute.networks().getEffectiveFirewalls(project=network.project_id,
@@ -640,7 +641,8 @@ def _get_effective_firewalls(network: Network):
   return EffectiveFirewalls(network, response)
 
 
-@caching.cached_api_call(in_memory=True)
+@caching.cached_api_call(expire=config.CACHE_STALE_EXPIRY_SECONDS,
+                         revalidate_after=config.CACHE_REVALIDATE_AFTER_SECONDS)
 def get_network(project_id: str, network_name: str) -> Network:
   logging.info('fetching network: %s/%s', project_id, network_name)
   compute = apis.get_api('compute', 'v1', project_id)
@@ -659,7 +661,8 @@ def get_network_from_url(url: str) -> Network:
   return get_network(project_id, network_name)
 
 
-@caching.cached_api_call(in_memory=True)
+@caching.cached_api_call(expire=config.CACHE_STALE_EXPIRY_SECONDS,
+                         revalidate_after=config.CACHE_REVALIDATE_AFTER_SECONDS)
 def get_networks(project_id: str) -> List[Network]:
   logging.info('fetching network: %s', project_id)
   compute = apis.get_api('compute', 'v1', project_id)
@@ -0,0 +1,173 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+"""Timeline tracing of a lint run.
+
+When tracing is started, spans (rule functions, queries, logs jobs, API calls,
+cache lock waits) are recorded with the thread that executed them, and can be
+saved as Chrome trace-event JSON, which can be opened with
+https://ui.perfetto.dev or chrome://tracing.
+
+When tracing is not started, span() returns a no-op object, so that the
+instrumented code doesn't need to check whether tracing is enabled.
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+_lock = threading.Lock()
+# Recorded events, or None when tracing is not started.
+_events: Optional[List[Dict[str, Any]]] = None
+_thread_names: Dict[int, str] = {}
+_start_time = 0.0
+
+
+def _now_us() -> float:
+  return (time.perf_counter() - _start_time) * 1e6
+
+
+def _add_event(event: Dict[str, Any]):
+  tid = threading.get_native_id()
+  event['pid'] = os.getpid()
+  event['tid'] = tid
+  with _lock:
+    if _events is None:
+      return
+    _events.append(event)
+    if tid not in _thread_names:
+      _thread_names[tid] = threading.current_thread().name
+
+
+class _Span:
+  """Complete event ("X") recorded when the context manager exits."""
+
+  def __init__(self, name: str, category: str, args: Dict[str, Any]):
+    self.name = name
+    self.category = category
+    self.args = args
+    self._start_us = 0.0
+
+  def set(self, **args):
+    """Add arguments to the span, e.g. a result only known at the end."""
+    self.args.update(args)
+
+  def __enter__(self):
+    self._start_us = _now_us()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is not None:
+      self.args['error'] = exc_type.__name__
+    _add_event({
+        'name': self.name,
+        'cat': self.category,
+        'ph': 'X',
+        'ts': self._start_us,
+        'dur': _now_us() - self._start_us,
+        'args': self.args
+    })
+    return False
+
+
+class _NullSpan:
+  """Span returned when tracing is not started."""
+
+  def set(self, **args):
+    pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def start():
+  """Start recording spans (and forget any previously recorded span)."""
+  global _events, _start_time
+  with _lock:
+    _events = []
+    _thread_names.clear()
+    _start_time = time.perf_counter()
+
+
+def stop():
+  global _events
+  with _lock:
+    _events = None
+    _thread_names.clear()
+
+
+def is_enabled() -> bool:
+  return _events is not None
+
+
+def span(name: str, category: str, **args):
+  """Context manager recording the time spent in its block as a span."""
+  if _events is None:
+    return _NULL_SPAN
+  return _Span(name, category, args)
+
+
+def traced(func: Callable, name: str, category: str) -> Callable:
+  """Return func, recording every call as a span if tracing is started."""
+  if _events is None:
+    return func
+
+  @functools.wraps(func)
+  def _traced_func(*args, **kwargs):
+    with span(name, category):
+      return func(*args, **kwargs)
+
+  return _traced_func
+
+
+def get_trace() -> Dict[str, Any]:
+  """Return the recorded spans in the Chrome trace-event format."""
+  with _lock:
+    events = list(_events or [])
+    thread_names = dict(_thread_names)
+  pid = os.getpid()
+  metadata = [{
+      'name': 'process_name',
+      'ph': 'M',
+      'pid': pid,
+      'tid': 0,
+      'args': {
+          'name': 'gcpdiag'
+      }
+  }]
+  metadata += [{
+      'name': 'thread_name',
+      'ph': 'M',
+      'pid': pid,
+      'tid': tid,
+      'args': {
+          'name': thread_name
+      }
+  } for tid, thread_name in sorted(thread_names.items())]
+  return {'traceEvents': metadata + events, 'displayTimeUnit': 'ms'}
+
+
+def save(path: str):
+  with open(path, 'w', encoding='utf-8') as f:
+    json.dump(get_trace(), f)
@@ -0,0 +1,92 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+"""Test code in tracing.py."""
+
+import json
+import threading
+
+import pytest
+
+from gcpdiag import tracing
+
+
+class TestTracing:
+  """Test tracing spans and the Chrome trace-event export."""
+
+  def setup_method(self):
+    tracing.start()
+
+  def teardown_method(self):
+    tracing.stop()
+
+  def _events(self, phase):
+    return [e for e in tracing.get_trace()['traceEvents'] if e['ph'] == phase]
+
+  def test_disabled(self):
+    tracing.stop()
+    with tracing.span('a', 'test') as span:
+      span.set(x=1)
+    assert not tracing.is_enabled()
+    assert tracing.get_trace()['traceEvents'][1:] == []
+
+    def func():
+      pass
+
+    assert tracing.traced(func, 'f', 'test') is func
+
+  def test_nested_spans(self):
+    with tracing.span('outer', 'test', a=1) as span:
+      with tracing.span('inner', 'test'):
+        pass
+      span.set(b=2)
+    inner, outer = self._events('X')
+    assert (outer['name'], outer['cat'], outer['args']) == ('outer', 'test', {
+        'a': 1,
+        'b': 2
+    })
+    assert inner['name'] == 'inner'
+    assert outer['ts'] <= inner['ts']
+    assert inner['ts'] + inner['dur'] <= outer['ts'] + outer['dur']
+    assert inner['tid'] == outer['tid'] == threading.get_native_id()
+
+  def test_error(self):
+    with pytest.raises(ValueError):
+      with tracing.span('a', 'test'):
+        raise ValueError()
+    event, = self._events('X')
+    assert event['args'] == {'error': 'ValueError'}
+
+  def test_thread_names(self):
+    thread = threading.Thread(target=tracing.traced(lambda: None, 'f', 'test'),
+                              name='test-thread')
+    thread.start()
+    thread.join()
+    event, = self._events('X')
+    thread_names = {
+        e['tid']: e['args']['name']
+        for e in self._events('M')
+        if e['name'] == 'thread_name'
+    }
+    assert thread_names[event['tid']] == 'test-thread'
+
+  def test_save(self, tmp_path):
+    with tracing.span('a', 'test'):
+      pass
+    path = tmp_path / 'trace.json'
+    tracing.save(str(path))
+    trace = json.loads(path.read_text())
+    assert trace['displayTimeUnit'] == 'ms'
+    assert [e['name'] for e in trace['traceEvents'] if e['ph'] == 'X'] == ['a']